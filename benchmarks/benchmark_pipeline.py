@@ -0,0 +1,219 @@
+"""
+Benchmarks every stage of the DyTrAno pipeline on the bundled datasets and on
+synthetic datasets of growing size and dimension, and compares result files.
+
+Usage:
+    python -m benchmarks.benchmark_pipeline --sizes 1000,10000 --dimensions 2,8
+    python -m benchmarks.benchmark_pipeline --compare baseline.json current.json
+"""
+
+import argparse
+from contextlib import redirect_stderr, redirect_stdout
+import datetime
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from data import create_dataset
+from utils import constants, data_utils, pruning_utils, clustering_utils, filtration_utils, \
+    merge_clusters, icd_utils
+from validation import check_tree_structure
+
+STAGES = ('pruning', 'density', 'tree_clustering', 'filtration', 'validation', 'merge')
+RESULTS_DIRECTORY = os.path.join('benchmarks', 'results')
+# Relative slowdown above which a stage is reported as a regression
+REGRESSION_THRESHOLD = 0.2
+
+
+class StageRecorder:  # pylint: disable=R0903
+    """
+    Runs the pipeline stages one by one and records their wall-clock time,
+    and their peak traced memory when memory tracing is enabled
+    """
+
+    def __init__(self, trace_memory):
+        """
+        Initializes an empty record
+        """
+        self.trace_memory = trace_memory
+        self.seconds = {}
+        self.peak_bytes = {}
+
+    def run(self, stage, function, *args, **kwargs):
+        """
+        Runs one stage with its output silenced and returns its result
+        """
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            result = function(*args, **kwargs)
+        self.seconds[stage] = time.perf_counter() - start
+        if self.trace_memory:
+            self.peak_bytes[stage] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return result
+
+
+def run_pipeline(data, k, recorder):
+    """
+    Runs the stages of main.py on the points, recording each of them
+    """
+    dataset = data_utils.Dataset(data)
+    random_state = np.random.RandomState(90)  # pylint: disable=E1101
+    pruned_neighbors, pruned_distances = recorder.run(
+        'pruning', pruning_utils.optimal_neighborhood_selection,
+        k, constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE, constants.SIGMA,
+        return_distances=True, dataset=dataset, random_state=random_state)
+    densities = recorder.run('density', clustering_utils.calculate_density,
+                             dataset.data, pruned_neighbors, pruned_distances)
+    labels, forest = recorder.run('tree_clustering', clustering_utils.grow_cluster_trees,
+                                  pruned_neighbors, densities, constants.DELTA, constants.BETA,
+                                  as_forest=True)
+    icd_cache = icd_utils.ICDCache(dataset.data)
+    filtered_labels = recorder.run('filtration', filtration_utils.filter_potential_anomalies,
+                                   labels, forest, densities, icd_cache, dataset)
+    recorder.run('validation', check_tree_structure.check_tree_structure, forest)
+    merged_labels, _ = recorder.run('merge', merge_clusters.process_different_cluster_neighbors,
+                                    filtered_labels, pruned_neighbors, forest, densities,
+                                    icd_cache=icd_cache, dataset=dataset)
+    merged_labels = np.asarray(merged_labels)
+    return {'clusters': len(np.unique(merged_labels[merged_labels > 0])),
+            'anomalies': int(np.sum(merged_labels == -1))}
+
+
+def benchmark(name, data, k, trace_memory):
+    """
+    Benchmarks the pipeline on one dataset and returns its result row.
+    Time and memory are measured in separate runs, as tracing memory
+    slows down the Python-level stages.
+    """
+    timing = StageRecorder(trace_memory=False)
+    counts = run_pipeline(data, k, timing)
+    row = {'dataset': name, 'num_points': len(data), 'dimension': data.shape[1], 'k': k,
+           'seconds': timing.seconds, 'total_seconds': sum(timing.seconds.values())}
+    row.update(counts)
+    if trace_memory:
+        memory = StageRecorder(trace_memory=True)
+        run_pipeline(data, k, memory)
+        row['peak_bytes'] = memory.peak_bytes
+    return row
+
+
+def get_environment():
+    """
+    Returns the commit and the versions the benchmark ran with
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def compare_results(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """
+    Returns the (dataset, num_points, dimension, stage, baseline seconds,
+    current seconds) of every stage that got slower by more than threshold
+    """
+    baseline_rows = {(row['dataset'], row['num_points'], row['dimension']): row
+                     for row in baseline['results']}
+    regressions = []
+    for row in current['results']:
+        key = (row['dataset'], row['num_points'], row['dimension'])
+        if key not in baseline_rows:
+            continue
+        for stage in STAGES:
+            before = baseline_rows[key]['seconds'].get(stage)
+            after = row['seconds'].get(stage)
+            if before and after and after > before * (1 + threshold):
+                regressions.append(key + (stage, before, after))
+    return regressions
+
+
+def parse_arguments():
+    """
+    This is used to parse the arguments passed from the CML
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--numNeigh', type=int, default=constants.NUMBER_OF_NEIGHBORS,
+                        help='Number of Neighbors Estimate')
+    parser.add_argument('--sizes', type=str, default='1000,10000,100000,1000000',
+                        help='Comma-separated numbers of points of the synthetic datasets')
+    parser.add_argument('--dimensions', type=str, default='2,8,32',
+                        help='Comma-separated dimensions of the synthetic datasets')
+    parser.add_argument('--skipBundled', action='store_true',
+                        help='Do not benchmark the datasets in data/clustering/raw_data')
+    parser.add_argument('--noMemory', action='store_true',
+                        help='Only measure time, skipping the memory tracing runs')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Result file (defaults to benchmarks/results/<date>-<commit>.json)')
+    parser.add_argument('--compare', type=str, nargs=2, default=None,
+                        metavar=('BASELINE', 'CURRENT'),
+                        help='Compare two result files and report stage regressions')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='Relative slowdown reported as a regression by --compare')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs the benchmarks and writes the result file, or compares two result files
+    """
+    arguments = parse_arguments()
+    if arguments.compare:
+        baseline_path, current_path = arguments.compare
+        with open(baseline_path, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        with open(current_path, 'r', encoding='utf-8') as file:
+            current = json.load(file)
+        regressions = compare_results(baseline, current, arguments.threshold)
+        for dataset, num_points, dimension, stage, before, after in regressions:
+            print(f"{dataset} ({num_points} x {dimension}) {stage}: "
+                  f"{before:.3f} s -> {after:.3f} s")
+        print(f"{len(regressions)} regressions above {arguments.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
+
+    inputs = []
+    if not arguments.skipBundled:
+        for path in sorted(glob.glob(os.path.join('data', 'clustering', 'raw_data', '*.csv'))):
+            name = os.path.splitext(os.path.basename(path))[0]
+            inputs.append((name, lambda path=path: data_utils.get_data(path)))
+    for size in (int(value) for value in arguments.sizes.split(',') if value):
+        for dimension in (int(value) for value in arguments.dimensions.split(',') if value):
+            inputs.append((f"synthetic-{dimension}d", lambda size=size, dimension=dimension:
+                           create_dataset.create_blob_data(size, dimension)))
+
+    environment = get_environment()
+    rows = []
+    for name, load in inputs:
+        data = load()
+        row = benchmark(name, data, min(arguments.numNeigh, len(data) - 1),
+                        not arguments.noMemory)
+        rows.append(row)
+        print(f"{name:>20} {row['num_points']:>8} x {row['dimension']:<3} "
+              f"{row['total_seconds']:8.2f} s  " +
+              ' '.join(f"{stage}={row['seconds'][stage]:.2f}" for stage in STAGES))
+
+    output = arguments.output
+    if output is None:
+        os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+        stamp = environment['date'].replace(':', '-')
+        output = os.path.join(RESULTS_DIRECTORY,
+                              f"{stamp}-{(environment['commit'] or 'unknown')[:8]}.json")
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump({'environment': environment, 'results': rows}, file, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,28 @@ def create_filled_circle_data(center, radius, num_points):
     return np.vstack((x_val, y_val)).T
 
 
+# pylint: disable=R0913
+def create_blob_data(num_points, dimension, num_clusters=4, radius=3, anomaly_fraction=0.05,
+                     seed=90):
+    """
+    Creates a dummy dataset of any size and dimension: filled balls around
+    random centers, plus a fraction of uniform noise points
+    """
+    random_state = np.random.RandomState(seed)  # pylint: disable=E1101
+    num_anomalies = int(num_points * anomaly_fraction)
+    num_inliers = num_points - num_anomalies
+    cluster_centers = random_state.uniform(-5 * num_clusters, 5 * num_clusters,
+                                           (num_clusters, dimension))
+    assignments = random_state.randint(num_clusters, size=num_inliers)
+    directions = random_state.normal(size=(num_inliers, dimension))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    radii = radius * random_state.uniform(0, 1, num_inliers) ** (1 / dimension)
+    inliers = cluster_centers[assignments] + directions * radii[:, np.newaxis]
+    anomalies = random_state.uniform(-6 * num_clusters, 6 * num_clusters,
+                                     (num_anomalies, dimension))
+    return np.vstack((inliers, anomalies))
+
+
 NUM_POINTS_PER_CIRCLE = 250
 centers = [(-5, -5), (5, -5), (-5, 5), (5, 5)]
 RADIUS = 3
@@ -3,14 +3,19 @@ This is the main file which runs the DyTrAno program
 """
 
 import argparse
+import time
 import warnings
 import numpy as np
 from utils import pruning_utils, constants, clustering_utils, \
-    filtration_utils, merge_clusters
+    filtration_utils, merge_clusters, data_utils, extract_data, icd_utils, instrumentation, \
+    neighbor_index, snapshot
+from utils.streaming import StreamingDyTrAno
+from utils.sweep import run_sweep, format_sweep_table
 from visualizations import interactive_plot, visualize_clusters
 from validation import check_tree_structure
 
 
+# pylint: disable=R0915
 def parse_arguments():
     """
     This is used to parse the arguments passed from the CML
@@ -28,6 +33,69 @@ def parse_arguments():
                         help='Display the plot after pruning')
     parser.add_argument('--displayFinalResult', type=str, default="True",
                         help='Display the final plot with clusters')
+    parser.add_argument('--streaming', type=str, default="False",
+                        help='Stream the dataset points one at a time after a warm-up batch')
+    parser.add_argument('--warmupSize', type=int, default=0,
+                        help='Number of points used to bootstrap the streaming mode '
+                             '(defaults to half of the dataset)')
+    parser.add_argument('--windowSize', type=int, default=0,
+                        help='Number of most recent points kept by the streaming mode '
+                             '(0 keeps every point)')
+    parser.add_argument('--batchSize', type=int, default=0,
+                        help='Number of points inserted together by the streaming mode '
+                             '(0 inserts them one at a time)')
+    parser.add_argument('--sweep', type=str, default="False",
+                        help='Cluster the dataset for every combination of the sweep values '
+                             'and print a table of the results')
+    parser.add_argument('--sweepNumNeigh', type=str, default="",
+                        help='Comma-separated numNeigh values of the sweep (defaults to numNeigh)')
+    parser.add_argument('--sweepDelta', type=str, default="",
+                        help='Comma-separated DELTA values of the sweep')
+    parser.add_argument('--sweepBeta', type=str, default="",
+                        help='Comma-separated BETA values of the sweep')
+    parser.add_argument('--sweepEpsilon', type=str, default="",
+                        help='Comma-separated NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE values '
+                             'of the sweep')
+    parser.add_argument('--sweepWorkers', type=int, default=0,
+                        help='Number of worker processes of the sweep (0 uses every CPU)')
+    parser.add_argument('--neighborBackend', type=str, default=constants.CLUSTERING_ALGORITHM,
+                        choices=neighbor_index.NEIGHBOR_BACKENDS,
+                        help='kNN search backend; nn_descent is approximate and reports '
+                             'its estimated recall')
+    parser.add_argument('--pruningWorkers', type=int, default=0,
+                        help='Number of worker processes pruning the neighborhoods in shards '
+                             '(0 prunes in this process)')
+    parser.add_argument('--quiet', type=str, default="False",
+                        help='Turn off the progress bars and stage messages')
+    parser.add_argument('--report', type=str, default="",
+                        help='Write a JSON report of the stage timings, counts and memory '
+                             'to this file')
+    parser.add_argument('--profile', type=str, default="off",
+                        choices=instrumentation.PROFILE_MODES,
+                        help='Profile every stage with cProfile or a sampling profiler')
+    parser.add_argument('--profileDir', type=str, default="profiles",
+                        help='Directory of the cProfile stats of the stages')
+    parser.add_argument('--traceMemory', type=str, default="False",
+                        help='Measure the peak memory allocated by every stage with tracemalloc')
+    parser.add_argument('--validation', type=str, default="full",
+                        choices=check_tree_structure.VALIDATION_LEVELS,
+                        help='Check every node of the cluster trees, a random sample of them, '
+                             'or none')
+    parser.add_argument('--validationSampleSize', type=int, default=10000,
+                        help='Number of nodes checked by the sampled validation')
+    parser.add_argument('--mergeEngine', type=str, default=constants.MERGE_ENGINE,
+                        choices=merge_clusters.MERGE_ENGINES,
+                        help='Merge boundary points one at a time (points) or whole '
+                             'clusters over the cluster-adjacency graph (cluster_graph)')
+    parser.add_argument('--mergeCompatibleFraction', type=float,
+                        default=constants.MERGE_COMPATIBLE_FRACTION,
+                        help='Share of the boundary edges between two clusters that must '
+                             'satisfy the density criterion for cluster_graph to merge them')
+    parser.add_argument('--saveSnapshot', type=str, default="",
+                        help='Save the fitted model to this snapshot directory')
+    parser.add_argument('--loadSnapshot', type=str, default="",
+                        help='Restore the fitted model from this snapshot directory instead '
+                             'of fitting it (the streaming mode resumes inserting from it)')
     # parser.add_argument('--displayStats', type=str, default=True,
     # help='Display inlier-outlier stats at the end')
 
@@ -38,54 +106,244 @@ def parse_arguments():
     constants.DISPLAY_DENSITY = arguments.displayDensity
     constants.DISPLAY_PLOT = arguments.displayPlot
     constants.DISPLAY_FINAL_RESULT = arguments.displayFinalResult
+    constants.STREAMING = arguments.streaming
+    constants.WARMUP_SIZE = arguments.warmupSize
+    constants.WINDOW_SIZE = arguments.windowSize
+    constants.BATCH_SIZE = arguments.batchSize
+    constants.SWEEP = arguments.sweep
+    constants.SWEEP_NUM_NEIGHBORS = parse_values(arguments.sweepNumNeigh, int,
+                                                 constants.NUMBER_OF_NEIGHBORS)
+    constants.SWEEP_DELTAS = parse_values(arguments.sweepDelta, float, constants.DELTA)
+    constants.SWEEP_BETAS = parse_values(arguments.sweepBeta, float, constants.BETA)
+    constants.SWEEP_EPSILONS = parse_values(arguments.sweepEpsilon, float,
+                                            constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE)
+    constants.SWEEP_WORKERS = arguments.sweepWorkers
+    constants.CLUSTERING_ALGORITHM = arguments.neighborBackend
+    constants.PRUNING_WORKERS = arguments.pruningWorkers
+    constants.QUIET = arguments.quiet
+    constants.RUN_REPORT = arguments.report
+    constants.PROFILE_MODE = arguments.profile
+    constants.PROFILE_DIRECTORY = arguments.profileDir
+    constants.TRACE_MEMORY = arguments.traceMemory
+    constants.VALIDATION_LEVEL = arguments.validation
+    constants.VALIDATION_SAMPLE_SIZE = arguments.validationSampleSize
+    constants.MERGE_ENGINE = arguments.mergeEngine
+    constants.MERGE_COMPATIBLE_FRACTION = arguments.mergeCompatibleFraction
+    constants.SAVE_SNAPSHOT = arguments.saveSnapshot
+    constants.LOAD_SNAPSHOT = arguments.loadSnapshot
     # constants.DISPLAY_DATA_POINT_STATS = arguments.displayStats
 
 
-def main():
+def parse_values(text, value_type, default):
     """
-    This is the main function
+    Parses a comma-separated list of values, or returns [default] for an empty string
     """
-    warnings.filterwarnings('ignore')
-    parse_arguments()
-    pruned_neighbors_list = pruning_utils.optimal_neighborhood_selection(
-        constants.NUMBER_OF_NEIGHBORS,
-        constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE,
-        constants.SIGMA)
+    if not text:
+        return [default]
+    return [value_type(value) for value in text.split(',')]
+
+
+def run_sweep_mode(dataset):
+    """
+    Clusters the dataset for every combination of the sweep values
+    and prints the cluster counts, anomaly counts and timings
+    """
+    start = time.perf_counter()
+    with instrumentation.stage('sweep'):
+        rows = run_sweep(dataset.data, constants.SWEEP_NUM_NEIGHBORS, constants.SWEEP_DELTAS,
+                         constants.SWEEP_BETAS, constants.SWEEP_EPSILONS,
+                         max_workers=constants.SWEEP_WORKERS or None)
+        instrumentation.count('configurations', len(rows))
+    instrumentation.log(format_sweep_table(rows))
+    instrumentation.log(f"Swept {len(rows)} configurations in {time.perf_counter() - start:.2f} s")
+
+
+def run_streaming(dataset):
+    """
+    Bootstraps the streaming engine on the first points of the dataset
+    and inserts the remaining points one at a time
+    """
+    data = dataset.data
+    if constants.LOAD_SNAPSHOT:
+        with instrumentation.stage('snapshot_loading'):
+            engine = snapshot.load_streaming(constants.LOAD_SNAPSHOT)
+        # The points seen before the snapshot was saved are not inserted again
+        warmup_size = engine.num_seen
+    else:
+        warmup_size = constants.WARMUP_SIZE or len(data) // 2
+        engine = StreamingDyTrAno(window_size=constants.WINDOW_SIZE or None)
+        with instrumentation.stage('streaming_warmup'):
+            engine.fit(data[:warmup_size])
+
+    instrumentation.log("\nStarting streaming insertion...")
+    start = time.perf_counter()
+    with instrumentation.stage('streaming_insertion'):
+        if constants.BATCH_SIZE:
+            for first in range(warmup_size, len(data), constants.BATCH_SIZE):
+                engine.insert_many(data[first:first + constants.BATCH_SIZE])
+        else:
+            for point in data[warmup_size:]:
+                engine.insert(point)
+        instrumentation.count('points_inserted', len(data) - warmup_size)
+    elapsed = time.perf_counter() - start
+    num_inserted = len(data) - warmup_size
+    if num_inserted:
+        instrumentation.log(f"Inserted {num_inserted} points, "
+                            f"{1e6 * elapsed / num_inserted:.1f} us per point on average")
+
+    with instrumentation.stage('validation'):
+        check_tree_structure.check_tree_structure(engine.all_node_maps, engine.labels)
+
+    if constants.SAVE_SNAPSHOT:
+        with instrumentation.stage('snapshot_saving'):
+            snapshot.save_streaming(engine, constants.SAVE_SNAPSHOT)
+
+    labels, all_node_maps = engine.labels, engine.all_node_maps
+    if engine.windowed:
+        # Only the last rows of the dataset are still in the window, the others stay 0.
+        # Slots are reused, so the forest is re-keyed by dataset row for plotting.
+        first_row = len(data) - len(engine.arrivals)
+        row_of_slot = {index: first_row + position
+                       for position, (index, _) in enumerate(engine.arrivals)}
+        labels = np.zeros(len(data), dtype=int)
+        labels[first_row:] = engine.labels[list(row_of_slot)]
+        all_node_maps = {cluster_id: {row_of_slot[index]: node for index, node in node_map.items()}
+                         for cluster_id, node_map in all_node_maps.items()}
+    if constants.DISPLAY_FINAL_RESULT == "True" and len(np.unique(labels)) < 30:
+        visualize_clusters.cluster_visualization(labels, all_node_maps, dataset)
+
+    with open('cluster_output.txt', 'w', encoding='utf-8') as file:
+        file.write(f'{len(set(labels[labels != 0]))}\n')
+
+
+def run_pipeline(dataset):
+    """
+    Clusters the dataset, filters the anomalies and merges the clusters,
+    recording every stage on the active recorder
+    """
+    with instrumentation.stage('pruning'):
+        pruned_neighbors_list, pruned_distances_list = \
+            pruning_utils.optimal_neighborhood_selection(
+                constants.NUMBER_OF_NEIGHBORS,
+                constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE,
+                constants.SIGMA, return_distances=True, dataset=dataset,
+                num_workers=constants.PRUNING_WORKERS)
     if constants.DISPLAY_PLOT == "True":
-        interactive_plot.InteractivePlot(pruned_neighbors_list)
+        interactive_plot.InteractivePlot(pruned_neighbors_list, dataset)
 
     # Run the tree-based clustering algorithm
     # pylint: disable=W0612
-    labels, densities, all_node_maps = clustering_utils.tree_based_clustering(
-        pruned_neighbors_list,
-        constants.DELTA, constants.BETA)
+    with instrumentation.stage('tree_clustering'):
+        labels, densities, all_node_maps = clustering_utils.tree_based_clustering(
+            pruned_neighbors_list,
+            constants.DELTA, constants.BETA, pruned_distances_list, dataset, as_forest=True)
+
+    # The cluster ICDs are shared by filtration and merging
+    icd_cache = icd_utils.ICDCache(dataset.data, sample_threshold=constants.ICD_SAMPLE_THRESHOLD)
 
     # Perform filtration of potential anomalies
-    filtered_labels = filtration_utils.filter_potential_anomalies(np.array(labels),
-                                                                  all_node_maps, densities)
+    with instrumentation.stage('filtration'):
+        filtered_labels = filtration_utils.filter_potential_anomalies(np.array(labels),
+                                                                      all_node_maps, densities,
+                                                                      icd_cache, dataset)
 
     # Test to see if the tree structure is satisfied
-    check_tree_structure.check_tree_structure(all_node_maps)
+    with instrumentation.stage('validation'):
+        check_tree_structure.check_tree_structure(all_node_maps, filtered_labels)
 
     # Display the tree densities - for all trees
     if constants.DISPLAY_DENSITY:
         clustering_utils.print_tree_densities(all_node_maps)
 
     # Process different cluster neighbors and merge clusters if feasible
-    merged_labels, all_node_maps = merge_clusters.process_different_cluster_neighbors(
-        filtered_labels, pruned_neighbors_list, all_node_maps, densities)
+    with instrumentation.stage('merge'):
+        merged_labels, all_node_maps = merge_clusters.process_different_cluster_neighbors(
+            filtered_labels, pruned_neighbors_list, all_node_maps, densities,
+            icd_cache=icd_cache, dataset=dataset)
 
     # Make sure that the tree structure is satisfied -- Yeah once again!!
-    check_tree_structure.check_tree_structure(all_node_maps)
+    with instrumentation.stage('final_validation'):
+        check_tree_structure.check_tree_structure(all_node_maps, merged_labels)
+
+    if constants.SAVE_SNAPSHOT:
+        with instrumentation.stage('snapshot_saving'):
+            snapshot.save_model(constants.SAVE_SNAPSHOT, dataset.data, merged_labels,
+                                filtered_labels, densities, pruned_neighbors_list,
+                                all_node_maps, icd_cache, get_model_parameters())
+
+    write_results(dataset, merged_labels, filtered_labels, all_node_maps)
+
+
+def get_model_parameters():
+    """
+    Returns the parameters of the batch pipeline, as stored in its snapshots
+    """
+    return {'k': constants.NUMBER_OF_NEIGHBORS, 'delta': constants.DELTA,
+            'beta': constants.BETA, 'epsilon': constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE,
+            'sigma': constants.SIGMA, 'delta_for_filtration': constants.DELTA_FOR_FILTRATION,
+            'algorithm': constants.CLUSTERING_ALGORITHM, 'seed': 90,
+            'icd_sample_threshold': constants.ICD_SAMPLE_THRESHOLD,
+            'merge_engine': constants.MERGE_ENGINE,
+            'merge_compatible_fraction': constants.MERGE_COMPATIBLE_FRACTION}
+
+
+def run_from_snapshot(dataset):
+    """
+    Restores the fitted model of a batch run from a snapshot
+    instead of running the pipeline
+    """
+    with instrumentation.stage('snapshot_loading'):
+        model = snapshot.load_estimator(constants.LOAD_SNAPSHOT)
+    if len(model.labels_) != len(dataset):
+        raise ValueError(f"The snapshot holds {len(model.labels_)} points, "
+                         f"the dataset {len(dataset)}")
+    write_results(dataset, model.labels_, model.filtered_labels_, model.forest_)
 
-    # Visualize the clusters
+
+def write_results(dataset, merged_labels, filtered_labels, all_node_maps):
+    """
+    Visualizes the clusters and saves their number to a file for testing:
+    the number of labels after filtration, then the number of merged clusters
+    """
     if constants.DISPLAY_FINAL_RESULT == "True" and len(np.unique(merged_labels)) < 30:
-        visualize_clusters.cluster_visualization(merged_labels, all_node_maps)
+        visualize_clusters.cluster_visualization(merged_labels, all_node_maps, dataset)
 
-    # Save the number of clusters to a file for testing
     with open('cluster_output.txt', 'w', encoding='utf-8') as file:
         num_clusters = len(set(filtered_labels))
-        file.write(f'{num_clusters}\n')
+        num_merged_clusters = len(set(np.asarray(merged_labels).tolist()) - {-1})
+        file.write(f'{num_clusters}\n{num_merged_clusters}\n')
+
+
+def main():
+    """
+    This is the main function
+    """
+    warnings.filterwarnings('ignore')
+    parse_arguments()
+    recorder = instrumentation.start_run(instrumentation.RunRecorder(
+        trace_memory=constants.TRACE_MEMORY == "True", profile=constants.PROFILE_MODE,
+        profile_directory=constants.PROFILE_DIRECTORY))
+    # The dataset is read once and shared by every stage
+    with instrumentation.stage('loading'):
+        dataset = data_utils.Dataset.load(extract_data.get_raw_data_path(),
+                                          constants.DATASET_NAME)
+        instrumentation.count('points', len(dataset))
+    try:
+        if constants.STREAMING == "True":
+            run_streaming(dataset)
+        elif constants.SWEEP == "True":
+            run_sweep_mode(dataset)
+        elif constants.LOAD_SNAPSHOT:
+            run_from_snapshot(dataset)
+        else:
+            run_pipeline(dataset)
+    finally:
+        instrumentation.finish_run()
+    if constants.RUN_REPORT:
+        recorder.write_report(constants.RUN_REPORT, dataset=constants.DATASET_NAME,
+                              num_neighbors=constants.NUMBER_OF_NEIGHBORS,
+                              delta=constants.DELTA, beta=constants.BETA,
+                              epsilon=constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,15 @@
+"""
+Contains the fixtures shared by the tests
+"""
+
+import pytest
+
+from utils import data_utils, extract_data
+
+
+@pytest.fixture(scope='session')
+def get_data():
+    """
+    Returns the points of the configured dataset, read once per test session
+    """
+    return data_utils.get_data(extract_data.get_raw_data_path())
@@ -0,0 +1,16 @@
+from benchmarks.benchmark_pipeline import STAGES, benchmark, compare_results
+from data import create_dataset
+
+
+def test_benchmark_records_every_stage():
+    data = create_dataset.create_blob_data(400, 3)
+    assert data.shape == (400, 3)
+    row = benchmark('synthetic-3d', data, 15, trace_memory=True)
+    assert set(row['seconds']) == set(STAGES) == set(row['peak_bytes'])
+    assert row['clusters'] > 0
+
+    slower = dict(row, seconds={stage: 2 * seconds + 1 for stage, seconds
+                                in row['seconds'].items()})
+    regressions = compare_results({'results': [row]}, {'results': [slower]})
+    assert [regression[3] for regression in regressions] == list(STAGES)
+    assert not compare_results({'results': [row]}, {'results': [row]})
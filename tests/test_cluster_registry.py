@@ -0,0 +1,59 @@
+import numpy as np
+
+from utils import merge_clusters
+from utils.cluster_registry import ClusterRegistry
+from utils.forest import ArrayForest
+
+
+def add_chain(forest, indexes, densities, cluster_id):
+    parent = None
+    for index in indexes:
+        if parent is None:
+            forest.add_node(index, densities[index], cluster_id)
+        else:
+            forest.add_node(index, densities[index], cluster_id, parent)
+        parent = index
+
+
+def test_registry_tracks_moves_and_renumbering():
+    densities = np.array([9.0, 8.0, 7.0, 6.0, 5.0, 4.0, 3.0])
+    labels = np.array([2, 2, 2, 5, 5, 5, -1])
+    forest = ArrayForest(len(labels))
+    add_chain(forest, [0, 1, 2], densities, 2)
+    add_chain(forest, [3, 4, 5], densities, 5)
+    registry = ClusterRegistry(labels, forest)
+    assert registry.size(2) == 3 and registry.size(5) == 3 and registry.size(-1) == 1
+    assert registry.root(2) == 0 and registry.root(5) == 3
+
+    # Moving point 4 (with its child 5) below point 2
+    merge_clusters.cluster_reduction_helper(4, forest, 5, 2, 2, registry.labels,
+                                            densities, registry=registry)
+    assert registry.size(2) == 5 and registry.size(5) == 1
+    assert np.array_equal(registry.labels, [2, 2, 2, 5, 2, 2, -1])
+    assert forest.parent[4] == 2 and forest.parent[5] == 4 and forest.children(3) == []
+    assert sorted(registry.members(2).tolist()) == [0, 1, 2, 4, 5]
+
+    merged_labels, forest = merge_clusters.renumber_labels(
+        registry.labels, forest, registry=registry)
+    assert np.array_equal(merged_labels, [1, 1, 1, 2, 1, 1, -1])
+    assert np.array_equal(forest.cluster_id, [1, 1, 1, 2, 1, 1, 0])
+    assert registry.size(1) == 5 and registry.root(1) == 0 and registry.root(2) == 3
+
+    merged_labels, _ = merge_clusters.assign_singular_nodes_as_anomalies(
+        forest, merged_labels, registry)
+    assert merged_labels[3] == -1 and registry.size(-1) == 2 and registry.size(2) == 0
+    assert forest.cluster_id[3] == 0 and sorted(forest.roots) == [1]
+
+
+def test_move_deep_subtree():
+    num_points = 20000
+    densities = np.arange(num_points, 0, -1, dtype=float)
+    labels = np.ones(num_points + 1, dtype=int)
+    labels[-1] = 2
+    forest = ArrayForest(num_points + 1)
+    add_chain(forest, range(num_points), densities, 1)
+    forest.add_node(num_points, 0.5, 2)
+    moved = merge_clusters.move_subtree(10, 2, labels, forest)
+    assert moved == list(range(10, num_points))
+    assert np.sum(forest.cluster_id == 1) == 10 and np.sum(forest.cluster_id == 2) == num_points - 9
+    assert np.all(labels[10:] == 2) and forest.cluster_id[num_points - 1] == 2
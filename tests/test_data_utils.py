@@ -0,0 +1,52 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from utils import constants, data_utils, extract_data
+
+
+@pytest.fixture
+def dataset_dir(tmp_path, monkeypatch):
+    raw_data_dir = tmp_path / 'data' / 'clustering' / 'raw_data'
+    raw_data_dir.mkdir(parents=True)
+    points = np.random.RandomState(0).rand(100, 3)
+    np.savetxt(raw_data_dir / 'Tiny.csv', points, delimiter=',')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(constants, 'DATASET_NAME', 'Tiny')
+    return raw_data_dir
+
+
+def test_binary_round_trip(dataset_dir):
+    csv_path = extract_data.get_raw_data_path()
+    assert csv_path.endswith('.csv')
+    binary_path = data_utils.convert_to_binary(csv_path)
+
+    assert extract_data.get_raw_data_path() == binary_path
+    data = data_utils.read_binary(binary_path, verify=True)
+    assert isinstance(data, np.memmap) and not data.flags['WRITEABLE']
+    assert np.array_equal(data, data_utils.get_data(csv_path))
+
+    dataset = data_utils.Dataset.load(extract_data.get_raw_data_path())
+    assert not dataset.data.flags['OWNDATA'] and dataset.dimension == 3
+
+
+def test_binary_checksum_mismatch(dataset_dir):
+    binary_path = data_utils.convert_to_binary(extract_data.get_raw_data_path())
+    header_path = extract_data.get_header_path(binary_path)
+    with open(header_path, 'r', encoding='utf-8') as file:
+        header = json.load(file)
+    header['checksum'] += 1
+    with open(header_path, 'w', encoding='utf-8') as file:
+        json.dump(header, file)
+    data_utils.read_binary(binary_path)
+    with pytest.raises(ValueError):
+        data_utils.read_binary(binary_path, verify=True)
+
+
+def test_stale_binary_is_ignored(dataset_dir):
+    binary_path = data_utils.convert_to_binary(extract_data.get_raw_data_path())
+    csv_path = extract_data.get_csv_data_path()
+    os.utime(csv_path, (os.path.getmtime(binary_path) + 10,) * 2)
+    assert extract_data.get_raw_data_path() == csv_path
@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from utils import constants, pruning_utils, clustering_utils, \
+    filtration_utils, merge_clusters
+from utils.estimator import DyTrAno
+from validation import check_tree_structure
+
+
+
+def test_estimator_matches_pipeline(get_data):
+    pruned_neighbors = pruning_utils.optimal_neighborhood_selection(
+        constants.NUMBER_OF_NEIGHBORS,
+        constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE,
+        constants.SIGMA)
+    labels, densities, all_node_maps = clustering_utils.tree_based_clustering(
+        pruned_neighbors, constants.DELTA, constants.BETA)
+    filtered_labels = filtration_utils.filter_potential_anomalies(np.array(labels),
+                                                                  all_node_maps, densities)
+    merged_labels, _ = merge_clusters.process_different_cluster_neighbors(
+        filtered_labels.copy(), pruned_neighbors, all_node_maps, densities)
+
+    model = DyTrAno().fit(get_data)
+    assert np.allclose(model.densities_, densities)
+    assert np.array_equal(model.filtered_labels_, filtered_labels)
+    assert np.array_equal(model.labels_, merged_labels)
+    check_tree_structure.check_tree_structure(model.forest_)
+
+
+def test_concurrent_estimators_hold_no_global_state(get_data):
+    random_state = np.random.get_state()
+    parameters = [(35, 0.7), (50, 0.7), (35, 0.5)]
+    expected = [DyTrAno(k=k, delta=delta).fit_predict(get_data) for k, delta in parameters]
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(executor.map(lambda args: DyTrAno(k=args[0], delta=args[1])
+                                    .fit_predict(get_data), parameters))
+    for labels, expected_labels in zip(results, expected):
+        assert np.array_equal(labels, expected_labels)
+    assert np.array_equal(np.random.get_state()[1], random_state[1])
+    assert constants.NUMBER_OF_NEIGHBORS == 50
+
+
+def test_estimator_rejects_too_few_points():
+    with pytest.raises(ValueError):
+        DyTrAno(k=10).fit(np.random.RandomState(0).rand(5, 2))
@@ -0,0 +1,216 @@
+import numpy as np
+import pytest
+from sklearn.metrics import adjusted_rand_score
+
+from utils import constants, pruning_utils, clustering_utils, filtration_utils, merge_clusters, \
+    icd_utils, data_utils, extract_data
+from utils.forest import ArrayForest, NO_NODE
+from validation import check_tree_structure
+
+
+@pytest.fixture
+def clustering():
+    pruned_neighbors = pruning_utils.optimal_neighborhood_selection(
+        constants.NUMBER_OF_NEIGHBORS,
+        constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE,
+        constants.SIGMA)
+    labels, densities, all_node_maps = clustering_utils.tree_based_clustering(
+        pruned_neighbors, constants.DELTA, constants.BETA)
+    return pruned_neighbors, np.array(labels), densities, all_node_maps
+
+
+def test_forest_round_trip(clustering):
+    _, labels, _, all_node_maps = clustering
+    forest = ArrayForest.from_node_maps(all_node_maps, len(labels))
+    assert forest.nbytes < 40 * len(labels)
+    assert np.array_equal(forest.cluster_id, np.maximum(labels, 0))
+    assert len(forest.density_violations()) == 0
+
+    node_maps = forest.to_node_maps()
+    assert node_maps.keys() == all_node_maps.keys()
+    for cluster_id, node_map in all_node_maps.items():
+        assert node_maps[cluster_id].keys() == node_map.keys()
+        for index, node in node_map.items():
+            copy = node_maps[cluster_id][index]
+            assert sorted(copy.get_child_indexes()) == sorted(node.get_child_indexes())
+            assert (copy.get_parent() is None) == (node.get_parent() is None)
+
+
+def test_forest_queries(clustering):
+    _, labels, _, all_node_maps = clustering
+    forest = ArrayForest.from_node_maps(all_node_maps, len(labels))
+    roots = forest.tree_roots()
+    in_tree = labels > 0
+    assert np.array_equal(roots[in_tree],
+                          [forest.roots[cluster_id] for cluster_id in labels[in_tree]])
+    assert np.all(roots[~in_tree] == NO_NODE)
+
+    indptr, indices = forest.children_csr()
+    for index in np.flatnonzero(in_tree)[:50]:
+        assert sorted(indices[indptr[index]:indptr[index + 1]]) == sorted(forest.children(index))
+    assert np.array_equal(forest.cluster_sizes()[1:], np.bincount(labels[in_tree])[1:])
+
+    forest.parent[forest.roots[1]] = forest.first_child[forest.roots[1]]
+    with pytest.raises(ValueError):
+        forest.tree_roots()
+
+
+def test_native_forest_matches_node_maps(clustering):
+    pruned_neighbors, labels, densities, all_node_maps = clustering
+    expected = ArrayForest.from_node_maps(all_node_maps, len(labels))
+    native_labels, forest = clustering_utils.grow_cluster_trees(
+        pruned_neighbors, densities, constants.DELTA, constants.BETA, as_forest=True)
+    assert np.array_equal(native_labels, labels)
+    assert forest.roots == expected.roots
+    for name in ('parent', 'density', 'cluster_id'):
+        assert np.array_equal(getattr(forest, name), getattr(expected, name))
+    for index in np.flatnonzero(labels > 0)[:200]:
+        assert sorted(forest.children(index)) == expected.children(index)
+
+
+def test_filtration_links_demoted_roots():
+    # With these parameters filtration promotes anomalies above cluster roots
+    pruned_neighbors = pruning_utils.optimal_neighborhood_selection(
+        15, constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE, constants.SIGMA)
+    labels, densities, forest = clustering_utils.tree_based_clustering(
+        pruned_neighbors, 0.5, constants.BETA, as_forest=True)
+    original_roots = dict(forest.roots)
+    filtered_labels = filtration_utils.filter_potential_anomalies(labels, forest, densities)
+    demoted = [root for cluster_id, root in original_roots.items()
+               if forest.roots[cluster_id] != root]
+    assert demoted
+    for root in demoted:
+        assert forest.parent[root] != NO_NODE
+        assert root in forest.children(forest.parent[root])
+    assert np.array_equal(forest.tree_roots()[filtered_labels > 0],
+                          [forest.roots[cluster_id] for cluster_id
+                           in filtered_labels[filtered_labels > 0]])
+    check_tree_structure.check_tree_structure(forest, filtered_labels)
+
+
+def test_moved_node_keeps_its_subtree():
+    densities = np.array([5, 4, 3, 2, 10, 10], dtype=float)
+    forest = ArrayForest(len(densities))
+    for index, cluster_id, parent in ((0, 1, NO_NODE), (1, 1, 0), (2, 1, 1), (3, 1, 1),
+                                      (4, 2, NO_NODE), (5, 3, NO_NODE)):
+        forest.add_node(index, densities[index], cluster_id, parent)
+    labels = np.array([1, 1, 1, 1, 2, 3])
+
+    merge_clusters.cluster_reduction_helper(1, forest, 1, 2, 4, labels, densities)
+    assert forest.parent[1] == 4 and sorted(forest.children(1)) == [2, 3]
+    # The TreeNode merge left 2 and 3 under a detached copy of 1, in cluster 2
+    merge_clusters.cluster_reduction_helper(1, forest, 2, 3, 5, labels, densities)
+    assert labels.tolist() == [1, 3, 3, 3, 2, 3]
+    assert forest.parent[1] == 5 and sorted(forest.children(1)) == [2, 3]
+    check_tree_structure.check_tree_structure(forest, labels)
+
+
+def test_pipeline_on_forest(clustering):
+    pruned_neighbors, labels, densities, all_node_maps = clustering
+    forest = ArrayForest.from_node_maps(all_node_maps, len(labels))
+    filtered_labels = filtration_utils.filter_potential_anomalies(labels.copy(), forest,
+                                                                  densities)
+    check_tree_structure.check_tree_structure(forest)
+    caller_labels = filtered_labels.copy()
+    merged_labels, merged_forest = merge_clusters.process_different_cluster_neighbors(
+        filtered_labels, pruned_neighbors, forest, densities)
+    # Merging works on its own copy of the labels
+    assert np.array_equal(filtered_labels, caller_labels)
+    assert not np.array_equal(merged_labels, caller_labels)
+    assert isinstance(merged_forest, ArrayForest)
+    check_tree_structure.check_tree_structure(merged_forest, merged_labels)
+    assert len(merged_labels) == len(labels)
+
+
+
+def test_forest_pipeline_matches_node_maps():
+    # With these parameters filtration promotes anomalies above cluster roots
+    pruned_neighbors = pruning_utils.optimal_neighborhood_selection(
+        15, constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE, constants.SIGMA)
+    results = []
+    for use_forest in (False, True):
+        labels, densities, all_node_maps = clustering_utils.tree_based_clustering(
+            pruned_neighbors, 0.5, constants.BETA)
+        if use_forest:
+            all_node_maps = ArrayForest.from_node_maps(all_node_maps, len(labels))
+        filtered_labels = filtration_utils.filter_potential_anomalies(labels, all_node_maps,
+                                                                      densities)
+        merged_labels, _ = merge_clusters.process_different_cluster_neighbors(
+            filtered_labels, pruned_neighbors, all_node_maps, densities)
+        results.append(np.asarray(merged_labels))
+    assert np.array_equal(results[0], results[1])
+
+
+def test_cluster_graph_merge_engine(get_data):
+    pruned_neighbors = pruning_utils.optimal_neighborhood_selection(
+        15, constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE, constants.SIGMA)
+    labels, densities, all_node_maps = clustering_utils.tree_based_clustering(
+        pruned_neighbors, 0.2, constants.BETA)
+    forest = ArrayForest.from_node_maps(all_node_maps, len(labels))
+    filtered_labels = filtration_utils.filter_potential_anomalies(labels, forest, densities)
+
+    candidates = merge_clusters.get_different_cluster_neighbors(filtered_labels, pruned_neighbors)
+    adjacency = merge_clusters.build_cluster_adjacency(candidates, filtered_labels, densities,
+                                                       constants.BETA, 0.2, forest.roots)
+    assert np.sum(adjacency['edges']) == len(candidates)
+    assert len({frozenset(pair) for pair in zip(adjacency['cluster'].tolist(),
+                                                adjacency['neighbor_cluster'].tolist())}) == \
+        len(adjacency)
+    assert np.all(adjacency['min_distance'] <= adjacency['mean_distance'] + 1e-12)
+    assert np.all(adjacency['compatible_edges'] <= adjacency['edges'])
+    # The root moves go from the root of one cluster to a point of the other
+    for prefix, target in (('root', 'neighbor_cluster'), ('neighbor_root', 'cluster')):
+        moves = adjacency[adjacency[prefix + '_anchor'] != NO_NODE]
+        assert len(moves)
+        assert np.array_equal(filtered_labels[moves[prefix + '_anchor']], moves[target])
+        assert np.all(moves[prefix + '_distance'] >= moves['min_distance'])
+    assert np.all(np.isinf(adjacency['root_distance'][adjacency['root_anchor'] == NO_NODE]))
+
+    icd_cache = icd_utils.ICDCache(get_data)
+    for cluster_id in np.unique(filtered_labels[filtered_labels > 0]).tolist():
+        icd_cache.icd(cluster_id, np.flatnonzero(filtered_labels == cluster_id))
+    results = [merge_clusters.process_different_cluster_neighbors(
+        filtered_labels.copy(), pruned_neighbors, structure, densities, delta=0.2,
+        engine='cluster_graph', compatible_fraction=0.5, icd_cache=cache)
+        for structure, cache in ((forest, icd_cache), (forest.to_node_maps(), None))]
+    (merged_labels, merged_forest), (node_map_labels, _) = results
+    assert np.array_equal(merged_labels, node_map_labels)
+    num_clusters = len(np.unique(filtered_labels[filtered_labels > 0]))
+    assert 0 < len(merged_forest.roots) < num_clusters
+    check_tree_structure.check_tree_structure(merged_forest, merged_labels)
+    for cluster_id in merged_forest.roots:
+        members = np.flatnonzero(merged_labels == cluster_id)
+        assert np.isclose(icd_cache.icd(cluster_id),
+                          icd_utils.calculate_icd(get_data[members]))
+
+    unmerged_labels, _ = merge_clusters.process_different_cluster_neighbors(
+        filtered_labels.copy(), pruned_neighbors, forest, densities, engine='cluster_graph',
+        compatible_fraction=1.1)
+    assert len(np.unique(unmerged_labels[unmerged_labels > 0])) == num_clusters
+    with pytest.raises(ValueError):
+        merge_clusters.process_different_cluster_neighbors(
+            filtered_labels.copy(), pruned_neighbors, forest, densities, engine='clusters')
+
+
+@pytest.mark.parametrize("name, k", [('Jain', 15), ('Compound', 15), ('R15', 15), ('D31', 15),
+                                     ('TwoSpirals', 50), ('Clusterincluster', 200)])
+def test_merge_engines_agree(monkeypatch, name, k):
+    monkeypatch.setattr(constants, 'DATASET_NAME', name)
+    dataset = data_utils.Dataset.load(extract_data.get_raw_data_path(), name)
+    ground_truth = data_utils.get_data(extract_data.get_ground_truth_data_path())[:, -1]
+    pruned_neighbors, pruned_distances = pruning_utils.optimal_neighborhood_selection(
+        k, constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE, constants.SIGMA,
+        return_distances=True, dataset=dataset)
+    labels, densities, forest = clustering_utils.tree_based_clustering(
+        pruned_neighbors, constants.DELTA, constants.BETA, pruned_distances, dataset,
+        as_forest=True)
+    filtered_labels = filtration_utils.filter_potential_anomalies(labels, forest, densities,
+                                                                  dataset=dataset)
+    point_labels, graph_labels = [np.asarray(merge_clusters.process_different_cluster_neighbors(
+        filtered_labels, pruned_neighbors, forest, densities, dataset=dataset, engine=engine)[0])
+        for engine in merge_clusters.MERGE_ENGINES]
+    assert len(np.unique(graph_labels[graph_labels > 0])) == \
+        len(np.unique(point_labels[point_labels > 0]))
+    assert adjusted_rand_score(point_labels, graph_labels) > 0.9
+    assert adjusted_rand_score(ground_truth, graph_labels) >= \
+        adjusted_rand_score(ground_truth, point_labels) - 0.01
@@ -0,0 +1,62 @@
+import numpy as np
+
+from utils import icd_utils
+
+
+def brute_force_icd(points):
+    distances = np.linalg.norm(points[:, np.newaxis, :] - points[np.newaxis, :, :], axis=-1)
+    return np.sum(np.triu(distances, k=1)) / (len(points) * (len(points) - 1) / 2)
+
+
+def test_blocked_icd_matches_brute_force():
+    points = np.random.RandomState(0).rand(300, 3)
+    for block_size in (7, 64, 1000):
+        assert np.isclose(icd_utils.calculate_icd(points, block_size), brute_force_icd(points))
+    assert icd_utils.calculate_icd(points[:1]) == 0
+
+
+def test_sampled_icd_error_bound():
+    points = np.random.RandomState(1).rand(2000, 2)
+    estimate, error = icd_utils.sample_icd(points, num_samples=20000)
+    assert 0 < error < 0.01
+    assert abs(estimate - icd_utils.calculate_icd(points)) < 4 * error
+
+
+def test_cache_updates_incrementally():
+    data = np.random.RandomState(2).rand(200, 2)
+    cache = icd_utils.ICDCache(data, block_size=16)
+    assert np.isclose(cache.icd(1, range(100)), brute_force_icd(data[:100]))
+    assert np.isclose(cache.icd(2, range(100, 150)), brute_force_icd(data[100:150]))
+
+    cache.add_points(1, list(range(150, 200)))
+    assert np.isclose(cache.icd(1), brute_force_icd(data[list(range(100)) + list(range(150, 200))]))
+    cache.move_points(range(0, 30), 1, 2)
+    # Moves only invalidate the cached sums, until the next read
+    assert 1 in cache and 1 not in cache.distance_sums and 2 not in cache.distance_sums
+    assert np.isclose(cache.icd(1), brute_force_icd(data[list(range(30, 100)) +
+                                                         list(range(150, 200))]))
+    assert np.isclose(cache.icd(2), brute_force_icd(data[list(range(100, 150)) +
+                                                         list(range(30))]))
+    cache.move_points(range(30, 40), 1, 2)
+    cache.refresh()
+    assert 1 in cache.distance_sums and 2 in cache.distance_sums
+    cache.move_points(range(30, 40), 2, 1)
+    cache.relabel({2: 1})
+    assert 2 not in cache
+    assert np.isclose(cache.icd(1), brute_force_icd(data[list(range(100, 150)) +
+                                                         list(range(30))]))
+
+
+def test_cache_defers_removals_of_moved_points():
+    data = np.random.RandomState(3).rand(120, 2)
+    cache = icd_utils.ICDCache(data)
+    cache.icd(1, range(60))
+    cache.icd(2, range(60, 120))
+    cache.move_points(range(10), 1, 2)
+    # The moved points stay in the members of the old cluster until it is read
+    assert len(cache.members[1]) == 60 and cache.pending_removals[1] == set(range(10))
+    cache.move_points(range(5), 2, 1)
+    assert np.isclose(cache.icd(1), brute_force_icd(data[list(range(5)) + list(range(10, 60))]))
+    assert np.isclose(cache.icd(2), brute_force_icd(data[list(range(60, 120)) +
+                                                         list(range(5, 10))]))
+    assert sorted(cache.members[1]) == list(range(5)) + list(range(10, 60))
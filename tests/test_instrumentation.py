@@ -0,0 +1,63 @@
+import json
+
+from utils import constants, data_utils, extract_data, instrumentation, pruning_utils, \
+    clustering_utils
+
+
+class RecordingHook(instrumentation.StageHook):
+    def __init__(self):
+        self.events = []
+
+    def stage_started(self, name):
+        self.events.append(('started', name))
+
+    def stage_finished(self, record):
+        self.events.append(('finished', record.name))
+
+
+def test_recorder_collects_stage_counts(tmp_path):
+    dataset = data_utils.Dataset.load(extract_data.get_raw_data_path())
+    hook = RecordingHook()
+    instrumentation.add_hook(hook)
+    recorder = instrumentation.start_run(instrumentation.RunRecorder(trace_memory=True,
+                                                                     profile='sampling'))
+    try:
+        with instrumentation.stage('pruning'):
+            pruned_neighbors, pruned_distances = pruning_utils.optimal_neighborhood_selection(
+                15, constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE, constants.SIGMA,
+                return_distances=True, dataset=dataset)
+        with instrumentation.stage('tree_clustering'):
+            clustering_utils.tree_based_clustering(pruned_neighbors, constants.DELTA,
+                                                   constants.BETA, pruned_distances, dataset)
+    finally:
+        instrumentation.finish_run()
+        instrumentation.remove_hook(hook)
+
+    assert hook.events == [('started', 'pruning'), ('finished', 'pruning'),
+                           ('started', 'tree_clustering'), ('finished', 'tree_clustering')]
+    pruning, clustering = recorder.records
+    assert pruning.counts['points'] == len(dataset)
+    assert pruning.counts['neighbors_pruned'] == \
+        15 * len(dataset) - sum(len(neighbors) for neighbors in pruned_neighbors)
+    assert clustering.counts['trees_built'] > 0
+    assert pruning.traced_peak_bytes > 0
+    assert pruning.profile['samples'] >= 0
+
+    recorder.write_report(tmp_path / 'report.json', dataset='Corners')
+    with open(tmp_path / 'report.json', encoding='utf-8') as file:
+        report = json.load(file)
+    assert [stage['name'] for stage in report['stages']] == ['pruning', 'tree_clustering']
+    assert report['metadata'] == {'dataset': 'Corners'}
+
+
+def test_quiet_mode_silences_stages(capsys, monkeypatch):
+    monkeypatch.setattr(constants, 'QUIET', "True")
+    instrumentation.log("Starting")
+    for _ in instrumentation.progress(range(3)):
+        pass
+    captured = capsys.readouterr()
+    assert captured.out == captured.err == ""
+    # Without an active recorder, stages and counts are no-ops
+    with instrumentation.stage('pruning') as record:
+        instrumentation.count('points', 3)
+    assert record is None
@@ -3,24 +3,26 @@ import os
 import pytest
 
 
-@pytest.mark.parametrize("num_neigh, dataset_name, expected_clusters", [
-    (35, 'Corners', 4),
-    (35, 'Moon', 2),
-    (35, 'Half_kernel', 2),
-    (15, 'Jain', 2),
-    (15, 'Flame', 1),
-    (25, 'Outlier', 4),
-    (70, 'TwoSpirals', 2),
-    (200, 'Clusterincluster', 2),
+@pytest.mark.parametrize("num_neigh, dataset_name, expected_clusters, expected_merged_clusters", [
+    (35, 'Corners', 4, 4),
+    (35, 'Moon', 2, 2),
+    (35, 'Half_kernel', 2, 2),
+    (15, 'Jain', 2, 2),
+    (15, 'Flame', 1, 1),
+    (25, 'Outlier', 4, 4),
+    (70, 'TwoSpirals', 2, 2),
+    (200, 'Clusterincluster', 2, 2),
+    (50, 'R15', 15, 3),
 ])
 @pytest.mark.flaky(reruns=5)
-def test_dataset_clustering(num_neigh, dataset_name, expected_clusters):
+def test_dataset_clustering(num_neigh, dataset_name, expected_clusters, expected_merged_clusters):
     result = subprocess.run(['python', 'main.py', '--numNeigh', str(num_neigh),
                              '--datasetName', dataset_name, '--displayPlot',
                              'False', '--displayFinalResult', 'False'])
     with open('cluster_output.txt', 'r') as f:
-        num_clusters = int(f.read().strip())
+        num_clusters, num_merged_clusters = [int(line) for line in f.read().split()]
     assert num_clusters >= expected_clusters
+    assert num_merged_clusters == expected_merged_clusters
 
 
 def teardown_function(function):
@@ -0,0 +1,44 @@
+import numpy as np
+
+from utils import constants, clustering_utils, pruning_utils
+from utils.neighbor_graph import NeighborGraph
+
+
+def test_graph_views():
+    rows = [np.array([1, 2]), np.array([], dtype=int), np.array([0, 1, 3]), np.array([2])]
+    distance_rows = [np.array([0.5, 1.0]), np.array([]), np.array([0.2, 0.3, 0.4]),
+                     np.array([0.1])]
+    graph = NeighborGraph.from_rows(rows, distance_rows)
+    assert graph.indices.dtype == np.int32
+    assert len(graph) == 4 and all(np.array_equal(a, b) for a, b in zip(graph, rows))
+    assert np.array_equal(graph[2], rows[2]) and np.array_equal(graph.distances[2],
+                                                                distance_rows[2])
+    assert np.array_equal(graph.degrees(), [2, 0, 3, 1])
+
+    sources, targets, distances = graph.edges()
+    assert list(zip(sources.tolist(), targets.tolist())) == \
+        [(0, 1), (0, 2), (2, 0), (2, 1), (2, 3), (3, 2)]
+    assert np.array_equal(distances, np.concatenate(distance_rows))
+
+    reverse = graph.reverse()
+    assert [row.tolist() for row in reverse] == [[2], [0, 2], [0, 3], [2]]
+    assert [row.tolist() for row in reverse.distances] == [[0.2], [0.5, 0.3], [1.0, 0.1], [0.4]]
+
+
+def test_pruning_builds_graph(get_data):
+    distances, neighbors = pruning_utils.find_k_nearest_neighbors(get_data, 15, seed=None)
+    graph, pruned_distances = pruning_utils.prune_all_neighborhoods(
+        neighbors, distances, constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE, constants.SIGMA,
+        np.random.RandomState(3))
+    gamma = np.random.RandomState(3).rand(*neighbors.shape)
+    sorted_neighbors, sorted_distances, lengths = pruning_utils.prune_neighborhoods(
+        neighbors, distances, gamma, constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE,
+        constants.SIGMA)
+    assert np.array_equal(graph.degrees(), lengths)
+    for index, (row, distance_row) in enumerate(zip(graph, pruned_distances)):
+        assert np.array_equal(row, sorted_neighbors[index, :lengths[index]])
+        assert np.array_equal(distance_row, sorted_distances[index, :lengths[index]])
+
+    rows = [row.copy() for row in graph]
+    assert np.allclose(clustering_utils.calculate_density(get_data, graph, pruned_distances),
+                       clustering_utils.calculate_density(get_data, rows))
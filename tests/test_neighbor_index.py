@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from utils import pruning_utils
+from utils.neighbor_index import BruteForceIndex, NeighborIndex, NNDescentIndex, TreeIndex, \
+    create_neighbor_index, neighbor_recall
+
+
+@pytest.mark.parametrize("algorithm", ['brute', 'kd_tree'])
+def test_exact_backends_match_ball_tree(get_data, algorithm):
+    expected_distances, _ = pruning_utils.find_k_nearest_neighbors(get_data, 20,
+                                                                   algorithm='ball_tree')
+    distances, indices = pruning_utils.find_k_nearest_neighbors(get_data, 20, algorithm=algorithm)
+    assert np.allclose(distances, expected_distances)
+    assert np.array_equal(indices[:, 0], np.arange(len(get_data)))
+    assert neighbor_recall(get_data, indices) > 0.99
+
+
+def test_exact_backends_add_points(get_data):
+    for index in (BruteForceIndex(), TreeIndex('kd_tree')):
+        index.build(get_data[:600])
+        assert np.array_equal(index.add(get_data[600:]), np.arange(600, len(get_data)))
+        distances, ids = index.query(get_data[:5] + 0.01, 3)
+        expected = np.sort(np.linalg.norm(get_data - (get_data[:5] + 0.01)[:, None],
+                                          axis=-1))[:, :3]
+        assert np.allclose(distances, expected)
+        assert ids.shape == (5, 3)
+
+
+def test_tree_index_adds_without_rebuilding(get_data):
+    index = TreeIndex('kd_tree').build(get_data[:500])
+    model = index.model
+    for start in range(500, len(get_data), 37):
+        index.add(get_data[start:start + 37])
+    assert index.model is model and len(index) == len(get_data)
+    distances, ids = index.query(get_data[::50] + 0.01, 5)
+    expected_distances, expected_ids = BruteForceIndex().build(get_data).query(
+        get_data[::50] + 0.01, 5)
+    assert np.allclose(distances, expected_distances)
+    assert np.array_equal(ids, expected_ids)
+    assert np.array_equal(index.self_neighbors(1)[1][:, 0], np.arange(len(get_data)))
+
+
+def test_neighbor_index_is_abstract():
+    with pytest.raises(TypeError):
+        NeighborIndex()  # pylint: disable=E0110
+
+
+def test_nn_descent_recall(get_data):
+    index = create_neighbor_index('nn_descent', 20).build(get_data[:800])
+    _, indices = index.self_neighbors(20)
+    assert np.array_equal(indices[:, 0], np.arange(800))
+    assert neighbor_recall(get_data[:800], indices) > 0.95
+
+    ids = index.add(get_data[800:850])
+    assert np.array_equal(ids, np.arange(800, 850))
+    _, indices = index.self_neighbors(20)
+    assert neighbor_recall(get_data[:850], indices) > 0.9
+
+    distances, ids = index.query(get_data[850:], 10)
+    _, exact = BruteForceIndex().build(get_data[:850]).query(get_data[850:], 10)
+    assert np.mean([len(np.intersect1d(row, exact_row)) / 10
+                    for row, exact_row in zip(ids, exact)]) > 0.9
+    assert np.all(np.diff(distances, axis=1) >= 0)
+    assert isinstance(index, NNDescentIndex) and not index.exact
@@ -0,0 +1,81 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from utils import icd_utils
+from utils.estimator import DyTrAno
+from utils.scoring_server import AnomalyScorer, ScoringClient, ScoringServer
+
+
+@pytest.fixture(scope='module')
+def model(get_data):
+    return DyTrAno().fit(get_data)
+
+
+@pytest.fixture
+def queries(model):
+    points = model.icd_cache_.data
+    rng = np.random.RandomState(0)
+    low, high = points.min(axis=0), points.max(axis=0)
+    return rng.uniform(low - 0.1 * (high - low), high + 0.1 * (high - low), (300, 2))
+
+
+def test_scorer_applies_filtration_rule(model, queries):
+    labels, distances, thresholds = AnomalyScorer.from_estimator(model).score(queries)
+    points = model.icd_cache_.data
+    inliers = np.flatnonzero(model.labels_ > 0)
+    for query, label, distance, threshold in zip(queries, labels, distances, thresholds):
+        nearest = inliers[np.argmin(np.linalg.norm(points[inliers] - query, axis=1))]
+        cluster_id = model.labels_[nearest]
+        icd = icd_utils.calculate_icd(points[model.labels_ == cluster_id])
+        assert distance == pytest.approx(np.linalg.norm(points[nearest] - query))
+        assert threshold == pytest.approx(model.delta_for_filtration * icd)
+        assert label == (cluster_id if distance < threshold else -1)
+    assert -1 in labels and np.any(labels > 0)
+
+
+def test_concurrent_requests_are_micro_batched(model, queries):
+    scorer = AnomalyScorer.from_estimator(model)
+
+    async def run():
+        server = await ScoringServer(scorer, max_batch_size=64, max_wait=0.01).start()
+        try:
+            results = await server.score_many(queries)
+        finally:
+            await server.stop()
+        return results, server.stats()
+
+    results, stats = asyncio.run(run())
+    expected_labels, expected_distances, _ = scorer.score(queries)
+    assert [label for label, _, _ in results] == expected_labels.tolist()
+    assert np.allclose([distance for _, distance, _ in results], expected_distances)
+    assert 1 < max(stats['batch_sizes']) <= 64
+    assert sum(size * count for size, count in stats['batch_sizes'].items()) == len(queries)
+    assert stats['request_latency']['count'] == len(queries)
+
+
+def test_http_endpoint_and_backpressure(model, queries):
+    scorer = AnomalyScorer.from_estimator(model)
+
+    async def run():
+        server = await ScoringServer(scorer, max_queue_size=16).start('127.0.0.1', 0)
+        client = ScoringClient('127.0.0.1', server.port)
+        try:
+            scored = await client.score(queries[:10])
+            rejected = await client.score(queries[:20])
+            bad_request = await client.score([[1.0, 2.0, 3.0]])
+            stats = await client.stats()
+        finally:
+            await client.close()
+            await server.stop()
+        return scored, rejected, bad_request, stats
+
+    scored, rejected, bad_request, stats = asyncio.run(run())
+    assert scored[0] == 200
+    expected_labels = scorer.score(queries[:10])[0]
+    assert [result['label'] for result in scored[1]['results']] == expected_labels.tolist()
+    assert [result['anomaly'] for result in scored[1]['results']] == \
+        (expected_labels == -1).tolist()
+    assert rejected[0] == 503 and bad_request[0] == 400
+    assert stats[0] == 200 and stats[1]['rejected'] == 1
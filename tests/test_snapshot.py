@@ -0,0 +1,61 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from utils import snapshot
+from utils.estimator import DyTrAno
+from utils.streaming import StreamingDyTrAno
+from validation import check_tree_structure
+
+
+
+def test_estimator_snapshot_round_trip(get_data, tmp_path):
+    model = DyTrAno().fit(get_data)
+    snapshot.save_estimator(model, tmp_path)
+    restored = snapshot.load_estimator(tmp_path, verify=True)
+    assert restored.k == model.k and restored.delta == model.delta
+    assert np.array_equal(restored.labels_, model.labels_)
+    assert np.array_equal(restored.filtered_labels_, model.filtered_labels_)
+    assert np.allclose(restored.densities_, model.densities_)
+    assert all(np.array_equal(row, expected) for row, expected
+               in zip(restored.pruned_neighbors_, model.pruned_neighbors_))
+    assert restored.forest_.roots == model.forest_.roots
+    assert np.array_equal(restored.forest_.parent, model.forest_.parent)
+    check_tree_structure.check_tree_structure(restored.forest_)
+    for cluster_id in model.icd_cache_.distance_sums:
+        assert restored.icd_cache_.icd(cluster_id) == model.icd_cache_.icd(cluster_id)
+
+
+def test_snapshot_rejects_other_versions(get_data, tmp_path):
+    snapshot.save_estimator(DyTrAno(k=20).fit(get_data), tmp_path)
+    with pytest.raises(ValueError):
+        snapshot.load_streaming(tmp_path)
+    manifest_path = os.path.join(tmp_path, snapshot.MANIFEST_NAME)
+    with open(manifest_path, encoding='utf-8') as file:
+        manifest = json.load(file)
+    manifest['version'] = snapshot.SNAPSHOT_VERSION + 1
+    with open(manifest_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+    with pytest.raises(ValueError):
+        snapshot.load_estimator(tmp_path)
+
+
+@pytest.mark.parametrize("window_size", [None, 400])
+def test_streaming_snapshot_resumes_insertion(get_data, tmp_path, window_size):
+    warmup_size = len(get_data) // 2
+    resumed_from = warmup_size + 100
+    engine = StreamingDyTrAno(window_size=window_size).fit(get_data[:warmup_size])
+    for point in get_data[warmup_size:resumed_from]:
+        engine.insert(point)
+    snapshot.save_streaming(engine, tmp_path)
+    restored = snapshot.load_streaming(tmp_path, verify=True)
+    assert restored.num_seen == resumed_from
+
+    expected = [engine.insert(point) for point in get_data[resumed_from:]]
+    labels = [restored.insert(point) for point in get_data[resumed_from:]]
+    assert labels == expected
+    assert np.array_equal(restored.labels, engine.labels)
+    assert np.allclose(restored.densities, engine.densities)
+    check_tree_structure.check_tree_structure(restored.all_node_maps)
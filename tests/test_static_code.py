@@ -1,6 +1,8 @@
 import pytest
+import numpy as np
 
-from utils import constants, pruning_utils, data_utils, extract_data, clustering_utils
+from utils import constants, pruning_utils, data_utils, extract_data, clustering_utils, \
+    filtration_utils, merge_clusters
 from validation import check_tree_structure
 
 
@@ -12,10 +14,6 @@ def pruned_neighbor_list():
         constants.SIGMA)
 
 
-@pytest.fixture
-def get_data():
-    return data_utils.get_data(extract_data.get_raw_data_path())
-
 
 @pytest.fixture
 def tree_based_clustering(pruned_neighbor_list):
@@ -42,3 +40,87 @@ def test_tree_density_structure(tree_based_clustering):
         check_tree_structure.check_tree_structure(all_node_maps)
     except Exception as e:
         pytest.fail(f"test_tree_structure.test_tree_structure raised an exception: {str(e)}")
+
+
+def test_density_from_pruned_distances(get_data):
+    pruned_neighbors, pruned_distances = pruning_utils.optimal_neighborhood_selection(
+        constants.NUMBER_OF_NEIGHBORS,
+        constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE,
+        constants.SIGMA, return_distances=True)
+    densities = clustering_utils.calculate_density(get_data, pruned_neighbors,
+                                                   pruned_distances)
+    recomputed = clustering_utils.calculate_density(get_data, pruned_neighbors)
+    assert np.array_equal(densities, recomputed)
+    assert np.all(densities >= 0)
+
+
+@pytest.mark.parametrize("algorithm", ['brute', 'kd_tree'])
+def test_pruning_is_independent_of_backend(algorithm):
+    # The kNN distances are recomputed from the points, so the backends'
+    # rounding cannot reorder the pruning weights
+    points = np.random.RandomState(0).rand(600, 8)
+    graphs = [pruning_utils.optimal_neighborhood_selection(
+        constants.NUMBER_OF_NEIGHBORS, constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE,
+        constants.SIGMA, dataset=points, random_state=np.random.RandomState(0),
+        algorithm=backend) for backend in ('ball_tree', algorithm)]
+    assert np.array_equal(graphs[0].indptr, graphs[1].indptr)
+    assert np.array_equal(graphs[0].indices, graphs[1].indices)
+    assert np.array_equal(graphs[0].distances.values, graphs[1].distances.values)
+
+
+def test_batched_nearest_inliers(tree_based_clustering, get_data):
+    labels, _, _ = tree_based_clustering
+    labels = np.array(labels)
+    anomalies = np.where(labels == -1)[0]
+    _, nearest = filtration_utils.find_nearest_inliers(anomalies, labels, get_data)
+    for anomaly_index, nearest_index in zip(anomalies, nearest):
+        expected = filtration_utils.find_nearest_inlier(anomaly_index, labels, get_data)
+        assert np.isclose(np.linalg.norm(get_data[anomaly_index] - get_data[nearest_index]),
+                          np.linalg.norm(get_data[anomaly_index] - get_data[expected]))
+
+
+def test_cross_cluster_candidates(pruned_neighbor_list, tree_based_clustering, get_data):
+    labels = np.array(tree_based_clustering[0])
+    candidates = merge_clusters.get_different_cluster_neighbors(labels, pruned_neighbor_list)
+    expected = sorted((index, neighbor, labels[neighbor])
+                      for index, neighbors in enumerate(pruned_neighbor_list)
+                      for neighbor in neighbors
+                      if -1 not in (labels[index], labels[neighbor])
+                      and labels[index] != labels[neighbor])
+    assert len(expected) > 0
+    assert sorted(zip(candidates['point'].tolist(), candidates['neighbor'].tolist(),
+                      candidates['neighbor_label'].tolist())) == expected
+    assert np.all(np.diff(candidates['distance']) >= 0)
+    assert np.allclose(candidates['distance'], np.linalg.norm(
+        get_data[candidates['point']] - get_data[candidates['neighbor']], axis=1))
+
+
+def test_stages_share_loaded_dataset(get_data):
+    dataset = data_utils.Dataset.load(extract_data.get_raw_data_path(), constants.DATASET_NAME)
+    assert len(dataset) == len(get_data) and dataset.dimension == get_data.shape[1]
+    assert dataset.data.flags['C_CONTIGUOUS']
+    pruned_neighbors, pruned_distances = pruning_utils.optimal_neighborhood_selection(
+        constants.NUMBER_OF_NEIGHBORS,
+        constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE,
+        constants.SIGMA, return_distances=True, dataset=dataset)
+    labels, densities, _ = clustering_utils.tree_based_clustering(
+        pruned_neighbors, constants.DELTA, constants.BETA, pruned_distances, dataset)
+    expected_labels, expected_densities, _ = clustering_utils.tree_based_clustering(
+        pruned_neighbors, constants.DELTA, constants.BETA)
+    assert np.array_equal(labels, expected_labels)
+    assert np.allclose(densities, expected_densities)
+
+
+def test_parallel_pruning_is_independent_of_workers(get_data):
+    distances, neighbors = pruning_utils.find_k_nearest_neighbors(get_data, 15, seed=None)
+    results = [pruning_utils.prune_all_neighborhoods_parallel(
+        neighbors, distances, constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE, constants.SIGMA,
+        seed=7, num_workers=num_workers, shard_size=300) for num_workers in (1, 2)]
+    for first, second in zip(*results):
+        assert len(first) == len(get_data)
+        assert all(np.array_equal(a, b) for a, b in zip(first, second))
+    pruned_neighbors, pruned_distances = results[0]
+    for index, row in enumerate(pruned_neighbors):
+        assert set(row) <= set(neighbors[index])
+        assert np.allclose(pruned_distances[index],
+                           np.linalg.norm(get_data[row] - get_data[index], axis=1))
@@ -0,0 +1,201 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from utils import constants, pruning_utils
+from utils.neighbor_index import IncrementalNeighborIndex, ReachIndex
+from utils.streaming import StreamingDyTrAno
+from validation import check_tree_structure
+
+
+
+@pytest.fixture
+def streamed_engine(get_data):
+    warmup_size = len(get_data) // 2
+    engine = StreamingDyTrAno().fit(get_data[:warmup_size])
+    labels = [engine.insert(point) for point in get_data[warmup_size:]]
+    return engine, labels
+
+
+def test_incremental_index_matches_brute_force():
+    rng = np.random.RandomState(0)
+    points = rng.rand(1000, 3)
+    index = IncrementalNeighborIndex(3, buffer_size=32)
+    for point in points:
+        index.add(point)
+    queries = rng.rand(20, 3)
+    distances, indices = index.query(queries, 10)
+    expected = np.linalg.norm(queries[:, np.newaxis] - points[np.newaxis], axis=-1)
+    assert np.allclose(distances, np.sort(expected, axis=1)[:, :10])
+    assert np.allclose(np.take_along_axis(expected, indices, axis=1), distances)
+
+
+def test_reach_index_finds_containing_balls():
+    rng = np.random.RandomState(0)
+    centers = rng.rand(500, 2) * 10
+    radii = rng.exponential(0.5, 500)
+    radii[:5] = [0, np.inf, 1e-9, 30, 1e-3]
+    index = ReachIndex()
+    index.update(np.arange(500), centers, radii)
+    # Shrunk and grown balls, and removed ones
+    radii[100:200] *= rng.rand(100) * 2
+    index.update(np.arange(100, 200), centers[100:200], radii[100:200])
+    index.remove(np.arange(200, 250))
+    radii[200:250] = 0
+    assert len(index) == 450
+
+    for query in rng.rand(50, 2) * 12 - 1:
+        expected = np.flatnonzero(np.linalg.norm(centers - query, axis=1) < radii)
+        candidates = index.query(query)
+        assert set(expected) <= set(candidates)
+        assert len(candidates) < 250
+
+
+def test_streaming_insert_labels(streamed_engine, get_data):
+    engine, labels = streamed_engine
+    assert len(engine.labels) == len(get_data)
+    # Clustered points stay in their cluster, anomalies may later seed a new one
+    streamed = engine.labels[len(get_data) - len(labels):]
+    assert np.all(streamed[np.array(labels) > 0] == np.array(labels)[np.array(labels) > 0])
+    assert np.all(engine.labels != 0)
+    for cluster_id, node_map in engine.all_node_maps.items():
+        assert np.all(engine.labels[list(node_map)] == cluster_id)
+        assert engine.roots[cluster_id].get_parent() is None
+    clustered = sum(len(node_map) for node_map in engine.all_node_maps.values())
+    assert clustered == np.sum(engine.labels > 0)
+
+
+def test_streaming_neighborhoods_match_batch_fit():
+    # Noise points have far k-th neighbors, so new points enter their kNN
+    # lists without being among their nearest candidates
+    rng = np.random.RandomState(0)
+    data = np.vstack([center + rng.randn(300, 2) for center in rng.rand(3, 2) * 20] +
+                     [rng.rand(100, 2) * 24 - 2])
+    rng.shuffle(data)
+    distances, _ = pruning_utils.find_k_nearest_neighbors(data, 10, seed=None)
+
+    engine = StreamingDyTrAno(k=10).fit(data[:300])
+    for point in data[300:]:
+        engine.insert(point)
+    assert np.allclose(engine._knn_distances[:len(data)], distances)
+
+    batched = StreamingDyTrAno(k=10).fit(data[:300])
+    for start in range(300, len(data), 64):
+        batched.insert_many(data[start:start + 64])
+    assert np.allclose(batched._knn_distances[:len(data)], distances)
+
+
+def test_streaming_tree_density_structure(streamed_engine):
+    engine, _ = streamed_engine
+    check_tree_structure.check_tree_structure(engine.all_node_maps)
+
+
+def test_streaming_requires_bootstrap(get_data):
+    with pytest.raises(RuntimeError):
+        StreamingDyTrAno().insert(get_data[0])
+    with pytest.raises(ValueError):
+        StreamingDyTrAno().fit(get_data[:constants.NUMBER_OF_NEIGHBORS - 1])
+
+
+def test_count_window_expiry(get_data):
+    window_size = len(get_data) // 4
+    engine = StreamingDyTrAno(window_size=window_size).fit(get_data[:window_size])
+    for point in get_data[window_size:]:
+        engine.insert(point)
+    assert np.sum(engine.alive) == window_size
+    assert len(engine.index) == window_size
+    assert engine.size <= window_size + 1
+    assert np.all(engine.labels[~engine.alive] == 0)
+    assert np.all(engine.labels[engine.alive] != 0)
+    for cluster_id, node_map in engine.all_node_maps.items():
+        assert len(node_map) > 1
+        assert np.all(engine.alive[list(node_map)])
+        assert np.all(engine.labels[list(node_map)] == cluster_id)
+    check_tree_structure.check_tree_structure(engine.all_node_maps)
+
+
+def test_window_expiry_keeps_clusters_whole():
+    # Expired points leave orphaned subtrees, which must not each become a cluster
+    rng = np.random.RandomState(0)
+    data = np.vstack([center + rng.randn(500, 2) for center in rng.rand(4, 2) * 20] +
+                     [rng.rand(200, 2) * 24 - 2])
+    rng.shuffle(data)
+    engine = StreamingDyTrAno(k=20, window_size=300).fit(data[:300])
+    for point in data[300:]:
+        engine.insert(point)
+    refit = StreamingDyTrAno(k=20).fit(engine.index.points[np.flatnonzero(engine.alive)])
+    assert len(engine.all_node_maps) <= 2 * len(refit.all_node_maps)
+    for cluster_id, node_map in engine.all_node_maps.items():
+        assert np.all(engine.labels[list(node_map)] == cluster_id)
+    check_tree_structure.check_tree_structure(engine.all_node_maps)
+
+
+def test_timestamp_window_expiry(get_data):
+    warmup_size = len(get_data) // 2
+    duration = 100
+    engine = StreamingDyTrAno(window_duration=duration)
+    engine.fit(get_data[:warmup_size], timestamps=np.arange(warmup_size))
+    for timestamp, point in enumerate(get_data[warmup_size:], start=warmup_size):
+        engine.insert(point, timestamp)
+    assert np.sum(engine.alive) == duration + 1
+    live = np.flatnonzero(engine.alive)
+    assert all(engine.reverse_neighbors[neighbor] >= {index} for index in live
+               for neighbor in engine._knn_indices[index])
+    check_tree_structure.check_tree_structure(engine.all_node_maps)
+
+
+def test_batch_insertion(get_data, streamed_engine):
+    warmup_size = len(get_data) // 2
+    engine, labels = streamed_engine
+    single = StreamingDyTrAno().fit(get_data[:warmup_size])
+    single_labels = [single.insert_many(point[np.newaxis])[0] for point in get_data[warmup_size:]]
+    assert single_labels == labels
+
+    batched = StreamingDyTrAno().fit(get_data[:warmup_size])
+    batch_labels = np.concatenate([batched.insert_many(get_data[start:start + 64])
+                                   for start in range(warmup_size, len(get_data), 64)])
+    assert np.array_equal(batched.labels[warmup_size:], batch_labels)
+    assert np.array_equal(batched._knn_indices[:len(get_data)],
+                          engine._knn_indices[:len(get_data)])
+    assert np.allclose(batched.densities, engine.densities)
+    for cluster_id, node_map in batched.all_node_maps.items():
+        assert np.all(batched.labels[list(node_map)] == cluster_id)
+    check_tree_structure.check_tree_structure(batched.all_node_maps)
+
+
+def test_batch_insertion_with_window(get_data):
+    window_size = len(get_data) // 4
+    engine = StreamingDyTrAno(window_size=window_size).fit(get_data[:window_size])
+    labels = engine.insert_many(get_data[window_size:])
+    # Only the last window_size points of the batch are inserted
+    assert np.sum(engine.alive) == window_size
+    assert engine.num_seen == len(get_data)
+    assert np.all(labels[:-window_size] == 0) and np.all(labels[-window_size:] != 0)
+    assert np.array_equal(np.sort(engine.index.points[np.flatnonzero(engine.alive)], axis=0),
+                          np.sort(get_data[-window_size:], axis=0))
+    live = np.flatnonzero(engine.alive)
+    assert all(engine.reverse_neighbors[neighbor] >= {index} for index in live
+               for neighbor in engine._knn_indices[index])
+    check_tree_structure.check_tree_structure(engine.all_node_maps)
+
+
+def test_large_batch_insertion():
+    # Noise points have far k-th neighbors, so each of them may take in many
+    # points of the batch
+    rng = np.random.RandomState(0)
+    data = np.vstack([center + rng.randn(4000, 2) for center in rng.rand(5, 2) * 100] +
+                     [rng.rand(5000, 2) * 120 - 10])
+    rng.shuffle(data)
+    engine = StreamingDyTrAno(k=10).fit(data[:20000])
+    tracemalloc.start()
+    try:
+        labels = engine.insert_many(data[20000:])
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 64 * 2 ** 20
+    assert len(labels) == 5000 and np.all(labels != 0)
+    distances, _ = pruning_utils.find_k_nearest_neighbors(data, 10, seed=None)
+    assert np.allclose(engine._knn_distances[:len(data)], distances)
+    check_tree_structure.check_tree_structure(engine.all_node_maps)
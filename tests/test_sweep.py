@@ -0,0 +1,18 @@
+import numpy as np
+
+from utils.estimator import DyTrAno
+from utils.sweep import run_sweep, format_sweep_table
+
+
+def test_sweep_matches_separate_runs(get_data):
+    rows = run_sweep(get_data, [15, 35], [0.5, 0.7], [0.3], [0.37], max_workers=2)
+    assert [(row['k'], row['delta']) for row in rows] == [(15, 0.5), (15, 0.7),
+                                                          (35, 0.5), (35, 0.7)]
+    for row in rows:
+        labels = DyTrAno(k=row['k'], delta=row['delta'], beta=row['beta'],
+                         epsilon=row['epsilon']).fit_predict(get_data)
+        assert row['clusters'] == len(np.unique(labels[labels > 0]))
+        assert row['anomalies'] == np.sum(labels == -1)
+
+    table = format_sweep_table(rows)
+    assert len(table.splitlines()) == len(rows) + 1
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from utils import constants, pruning_utils, clustering_utils, data_utils, extract_data, \
+    filtration_utils, merge_clusters
+from utils.forest import ArrayForest, NO_NODE
+from validation import check_tree_structure
+
+
+@pytest.fixture
+def clustering():
+    pruned_neighbors = pruning_utils.optimal_neighborhood_selection(
+        constants.NUMBER_OF_NEIGHBORS,
+        constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE,
+        constants.SIGMA)
+    labels, _, all_node_maps = clustering_utils.tree_based_clustering(
+        pruned_neighbors, constants.DELTA, constants.BETA)
+    return np.array(labels), all_node_maps
+
+
+def deepest_child(forest):
+    """A node with a parent that is not a root, so that it has a grandparent"""
+    children = np.flatnonzero((forest.parent != NO_NODE))
+    return children[forest.parent[forest.parent[children]] != NO_NODE][0]
+
+
+@pytest.mark.parametrize("level", ['full', 'sample'])
+def test_valid_forest_passes(clustering, level):
+    labels, all_node_maps = clustering
+    forest = ArrayForest.from_node_maps(all_node_maps, len(labels))
+    for structure in (forest, all_node_maps):
+        check_tree_structure.check_tree_structure(structure, labels, level=level,
+                                                  sample_size=100)
+
+
+def test_invalid_forests_fail(clustering):
+    labels, all_node_maps = clustering
+    forest = ArrayForest.from_node_maps(all_node_maps, len(labels))
+    node = deepest_child(forest)
+    parent = forest.parent[node]
+
+    forest.density[node] = forest.density[parent] + 1
+    for level in ('full', 'sample'):
+        with pytest.raises(AssertionError):
+            check_tree_structure.check_tree_structure(forest, level=level, sample_size=len(labels))
+    check_tree_structure.check_tree_structure(forest, level='off')
+    forest.density[node] = forest.density[parent]
+
+    wrong_labels = labels.copy()
+    wrong_labels[node] = -1
+    with pytest.raises(AssertionError):
+        check_tree_structure.check_tree_structure(forest, wrong_labels)
+
+    # Relinking a node below another parent leaves it in its old child list
+    forest.parent[node] = forest.parent[parent]
+    for level in ('full', 'sample'):
+        with pytest.raises(AssertionError):
+            check_tree_structure.check_tree_structure(forest, level=level,
+                                                      sample_size=len(labels))
+
+    forest.parent[node] = parent
+    forest.parent[parent] = node
+    with pytest.raises(AssertionError):
+        check_tree_structure.check_tree_structure(forest)
+
+
+def test_sampled_node_maps_fail(clustering):
+    labels, all_node_maps = clustering
+    node = next(node for node_map in all_node_maps.values() for node in node_map.values()
+                if node.get_parent() is not None)
+    node.density = node.get_parent().get_density() + 1
+    with pytest.raises(AssertionError):
+        check_tree_structure.check_tree_structure(all_node_maps, labels, level='sample',
+                                                  sample_size=len(labels))
+    with pytest.raises(ValueError):
+        check_tree_structure.check_tree_structure(all_node_maps, level='partial')
+
+
+def test_node_map_child_lists_fail(clustering):
+    _, all_node_maps = clustering
+    node = next(node for node_map in all_node_maps.values() for node in node_map.values()
+                if node.get_parent() is not None)
+    node.get_parent().get_children().remove(node)
+    with pytest.raises(AssertionError):
+        check_tree_structure.check_tree_structure(all_node_maps)
+
+
+@pytest.mark.parametrize("engine", merge_clusters.MERGE_ENGINES)
+def test_merged_forest_passes_with_labels(monkeypatch, engine):
+    monkeypatch.setattr(constants, 'DATASET_NAME', 'Flame')
+    dataset = data_utils.Dataset.load(extract_data.get_raw_data_path(), 'Flame')
+    pruned_neighbors = pruning_utils.optimal_neighborhood_selection(
+        15, constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE, constants.SIGMA, dataset=dataset)
+    labels, densities, forest = clustering_utils.tree_based_clustering(
+        pruned_neighbors, constants.DELTA, constants.BETA, dataset=dataset, as_forest=True)
+    filtered_labels = filtration_utils.filter_potential_anomalies(labels, forest, densities,
+                                                                  dataset=dataset)
+    for structure in (forest, forest.to_node_maps()):
+        merged_labels, merged_structure = merge_clusters.process_different_cluster_neighbors(
+            filtered_labels, pruned_neighbors, structure, densities, dataset=dataset,
+            engine=engine)
+        check_tree_structure.check_tree_structure(merged_structure, merged_labels)
@@ -0,0 +1,88 @@
+"""
+Contains the registry of cluster memberships shared by the merging stage
+"""
+
+import numpy as np
+
+
+class ClusterRegistry:
+    """
+    Tracks the label array and the size of every cluster while points move
+    between clusters, so that cluster sizes are looked up in O(1). The members
+    and the root of a cluster are read from the ArrayForest holding the
+    trees; sizes count labels, as the merge criterion does.
+    """
+
+    def __init__(self, labels, array_forest, anomaly_label=-1):
+        """
+        Builds the registry from a copy of the labels and the forest of all clusters
+        """
+        self.labels = np.array(labels, copy=True)
+        self.array_forest = array_forest
+        self.anomaly_label = anomaly_label
+        cluster_ids, counts = np.unique(self.labels, return_counts=True)
+        self.sizes = dict(zip(cluster_ids.tolist(), counts.tolist()))
+
+    def size(self, cluster_id):
+        """
+        Returns the number of points labeled with the given cluster id
+        """
+        return self.sizes.get(cluster_id, 0)
+
+    def members(self, cluster_id):
+        """
+        Returns the indexes of the points of a cluster in the forest
+        """
+        return self.array_forest.members(cluster_id)
+
+    def root(self, cluster_id):
+        """
+        Returns the index of the root of a cluster
+        """
+        return self.array_forest.roots.get(cluster_id)
+
+    def move(self, indexes, old_cluster_id, new_cluster_id):
+        """
+        Records that the given points moved from one cluster to another
+        """
+        self.labels[indexes] = new_cluster_id
+        self.sizes[old_cluster_id] = self.sizes.get(old_cluster_id, 0) - len(indexes)
+        self.sizes[new_cluster_id] = self.sizes.get(new_cluster_id, 0) + len(indexes)
+        if self.sizes[old_cluster_id] == 0:
+            del self.sizes[old_cluster_id]
+
+    def label_mapping(self):
+        """
+        Returns the mapping from the current cluster labels to consecutive labels
+        """
+        cluster_ids = sorted(set(self.sizes) - {self.anomaly_label})
+        label_mapping = {old_label: new_label + 1 for new_label, old_label
+                         in enumerate(cluster_ids)}
+        label_mapping[self.anomaly_label] = self.anomaly_label
+        return label_mapping
+
+    def renumber(self):
+        """
+        Renumbers the clusters of the labels and of the forest with
+        consecutive labels. Returns the label mapping.
+        """
+        label_mapping = self.label_mapping()
+        old_labels = np.array(sorted(label_mapping))
+        new_labels = np.array([label_mapping[label] for label in old_labels])
+        self.labels[:] = new_labels[np.searchsorted(old_labels, self.labels)]
+
+        array_forest = self.array_forest
+        in_tree = array_forest.cluster_id > 0
+        array_forest.cluster_id[in_tree] = new_labels[
+            np.searchsorted(old_labels, array_forest.cluster_id[in_tree])]
+        array_forest.roots = {label_mapping[cluster_id]: root
+                              for cluster_id, root in array_forest.roots.items()
+                              if cluster_id in label_mapping}
+        self.sizes = {label_mapping[cluster_id]: size for cluster_id, size in self.sizes.items()}
+        return label_mapping
+
+    def mark_anomaly(self, index, cluster_id):
+        """
+        Records that the single point of a cluster became an anomaly
+        """
+        self.move([index], cluster_id, self.anomaly_label)
@@ -4,8 +4,8 @@ Module for hierarchical tree-based clustering using density criteria.
 
 from collections import deque
 import numpy as np
-from tqdm import tqdm
-from utils import data_utils, extract_data, pruning_utils
+from utils import data_utils, forest, instrumentation
+from utils.neighbor_graph import CSRRows, NeighborGraph
 
 
 class TreeNode:
@@ -95,30 +95,76 @@ class TreeNode:
         return self.cluster_id
 
 
-def calculate_density(data, pruned_neighbors_list):
+def sum_rows_in_order(values, starts, lengths):
+    """
+    Sums the rows values[starts[i]:starts[i] + lengths[i]] one column at a
+    time, from the first value of every row, so that the rounding is the
+    same as summing each row in turn. Longest rows first, the rows still
+    summed are a prefix.
+    """
+    order = np.argsort(-lengths, kind='stable')
+    starts = starts[order]
+    # num_rows[length] is the number of rows at least that long
+    num_rows = np.cumsum(np.bincount(lengths)[::-1])[::-1]
+    sorted_sums = np.zeros(len(starts))
+    for length in range(1, len(num_rows)):
+        rows = slice(0, num_rows[length])
+        sorted_sums[rows] += values[starts[rows] + length - 1]
+    sums = np.empty(len(starts))
+    sums[order] = sorted_sums
+    return sums
+
+
+def calculate_density(data, pruned_neighbors_list, pruned_distances_list=None):
     """
     Calculate densities for each point based on its pruned neighbors.
+    The distances to the pruned neighbors are taken from
+    pruned_distances_list when given, otherwise they are computed
+    from the data in a single vectorized pass. Both may be lists of
+    arrays or CSR rows (a NeighborGraph and its distances).
     """
-    densities = []
-    for i in range(len(data)):
-        neighbors = pruned_neighbors_list[i]
-        k_opt = len(neighbors)
-        if k_opt == 0:
-            densities.append(0)
-            continue
-
-        e_values = [pruning_utils.calculate_distance(data[i], data[neighbor]) for
-                    neighbor in neighbors]
-        e_k_opt = e_values[-1] if e_values else 0
-
-        if e_k_opt == 0:
-            densities.append(0)
-        else:
-            density = sum(e_values) / (np.pi * e_k_opt ** 2)
-            densities.append(density)
+    graph = pruned_neighbors_list
+    if not isinstance(graph, NeighborGraph):
+        graph = NeighborGraph.from_rows(pruned_neighbors_list)
+    densities = np.zeros(len(graph))
+    non_empty = graph.degrees() > 0
+    if not np.any(non_empty):
+        return densities
+
+    if pruned_distances_list is None:
+        owners, neighbors, _ = graph.edges()
+        e_values = np.linalg.norm(data[neighbors] - data[owners], axis=1)
+    elif isinstance(pruned_distances_list, CSRRows):
+        e_values = pruned_distances_list.values
+    else:
+        e_values = np.concatenate(pruned_distances_list)
+
+    sums = sum_rows_in_order(e_values, graph.indptr[:-1][non_empty],
+                             graph.degrees()[non_empty])
+    e_k_opt = e_values[graph.indptr[1:][non_empty] - 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density = sums / (np.pi * e_k_opt ** 2)
+    densities[non_empty] = np.where(e_k_opt == 0, 0, density)
     return densities
 
 
+def calculate_density_from_sorted_distances(sorted_distances, pruned_lengths):
+    """
+    Calculate densities for a (n, k) block of neighbor distances sorted in
+    pruning order, keeping only the first pruned_lengths[i] of row i.
+    """
+    pruned_lengths = np.asarray(pruned_lengths)
+    rows = np.arange(len(sorted_distances))
+    mask = np.arange(sorted_distances.shape[1]) < pruned_lengths[:, np.newaxis]
+    sums = np.zeros(len(sorted_distances))
+    for column in range(sorted_distances.shape[1]):
+        sums += np.where(mask[:, column], sorted_distances[:, column], 0)
+    e_k_opt = sorted_distances[rows, np.maximum(pruned_lengths, 1) - 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density = sums / (np.pi * e_k_opt ** 2)
+    return np.where((pruned_lengths == 0) | (e_k_opt == 0), 0, density)
+
+
 def ewma(current_value, previous_ewma, beta):
     """
     Calculate Exponentially Weighted Moving Average (EWMA).
@@ -128,12 +174,15 @@ def ewma(current_value, previous_ewma, beta):
 
 # pylint: disable=R0913,R0914
 def cluster_tree(root_index, pruned_neighbors_list, labels, densities,
-                 delta, cluster_id, beta, parent_node):
+                 delta, cluster_id, beta, parent_node, ewma_values=None):
     """
     Build a cluster tree in a breadth-first search manner starting from a root node.
+    If ewma_values is given, the EWMA reached at every node is stored in it.
     """
     root_density = densities[root_index]
     ewma_value = root_density
+    if ewma_values is not None:
+        ewma_values[root_index] = ewma_value
     root_node = TreeNode(root_index, root_density, parent_node, cluster_id)
     node_map = {root_index: root_node}
     queue = deque([(root_index, root_node, ewma_value)])
@@ -162,52 +211,128 @@ def cluster_tree(root_index, pruned_neighbors_list, labels, densities,
                 child_node.set_parent(new_root_node)
                 new_root_node.add_child(child_node)
                 node_map[child_index] = child_node
+                if ewma_values is not None:
+                    ewma_values[child_index] = ewma_value
 
                 queue.append((child_index, child_node, ewma_value))
 
     return root_node, node_map
 
 
-def tree_based_clustering(pruned_neighbors_list, delta, beta):
+# pylint: disable=R0913
+def cluster_forest_tree(array_forest, root_index, pruned_neighbors_list, labels, densities,
+                        delta, cluster_id, beta, ewma_values=None):
+    """
+    Build a cluster tree in a breadth-first search manner starting from a root node,
+    as cluster_tree does, straight into the arrays of array_forest.
+    Returns the number of nodes in the tree.
+    """
+    ewma_value = densities[root_index]
+    if ewma_values is not None:
+        ewma_values[root_index] = ewma_value
+    array_forest.add_node(root_index, densities[root_index], cluster_id)
+    queue = deque([(root_index, ewma_value)])
+    tree_size = 1
+
+    while queue:
+        current_index, current_ewma_value = queue.popleft()
+        for child_index in pruned_neighbors_list[current_index]:
+            if child_index == current_index or labels[child_index] != 0:
+                continue
+
+            child_density = densities[child_index]
+            ewma_value = ewma(child_density, current_ewma_value, beta)
+
+            if abs((ewma_value - child_density) / ewma_value) <= delta:
+                labels[child_index] = cluster_id
+                array_forest.insert(child_index, child_density, cluster_id, current_index)
+                tree_size += 1
+                if ewma_values is not None:
+                    ewma_values[child_index] = ewma_value
+
+                queue.append((child_index, ewma_value))
+
+    return tree_size
+
+
+# pylint: disable=R0913
+def tree_based_clustering(pruned_neighbors_list, delta, beta, pruned_distances_list=None,
+                          dataset=None, as_forest=False):
     """
     Perform tree-based clustering using density criteria.
+    With as_forest, the trees are returned as an ArrayForest rather than node maps.
     """
-    data = data_utils.get_data(extract_data.get_raw_data_path())
-    labels = [0] * len(data)
-    densities = np.array(calculate_density(data, pruned_neighbors_list))
+    data = data_utils.get_dataset_points(dataset)
+    densities = calculate_density(data, pruned_neighbors_list, pruned_distances_list)
+    labels, all_node_maps = grow_cluster_trees(pruned_neighbors_list, densities, delta, beta,
+                                               as_forest=as_forest)
+    return labels, densities, all_node_maps
+
+
+# pylint: disable=R0913
+def grow_cluster_trees(pruned_neighbors_list, densities, delta, beta, ewma_values=None,
+                       as_forest=False):
+    """
+    Grow cluster trees from the densest unlabeled points until every point
+    is labeled. Returns the labels and the node maps of all cluster trees,
+    or with as_forest an ArrayForest holding them.
+    """
+    labels = np.zeros(len(densities), dtype=int)
     cluster_id = 1
     all_node_maps = {}
-
-    print("\nStarting tree-based clustering...")
-    with tqdm() as pbar:
+    array_forest = forest.ArrayForest(len(densities)) if as_forest else None
+    # Points in decreasing density order; the stable sort keeps the lowest index
+    # first among equal densities, as argmax would. Labeled points are skipped
+    # by a cursor that only moves forward, so root selection is O(n log n) overall.
+    density_order = np.argsort(-np.asarray(densities), kind='stable')
+    cursor = 0
+
+    instrumentation.log("\nStarting tree-based clustering...")
+    with instrumentation.progress() as pbar:
         while True:
-            zero_indices = np.where(np.array(labels) == 0)[0]
-            if len(zero_indices) == 0:
+            while cursor < len(density_order) and labels[density_order[cursor]] != 0:
+                cursor += 1
+            if cursor == len(density_order):
                 break
 
-            root_index = zero_indices[np.argmax(densities[zero_indices])]
+            root_index = density_order[cursor]
             labels[root_index] = cluster_id
-            _, node_map = cluster_tree(root_index, pruned_neighbors_list,
-                                       labels, densities, delta, cluster_id,
-                                       beta, None)
-            all_node_maps[cluster_id] = node_map
+            if array_forest is None:
+                _, node_map = cluster_tree(root_index, pruned_neighbors_list,
+                                           labels, densities, delta, cluster_id,
+                                           beta, None, ewma_values)
+                all_node_maps[cluster_id] = node_map
+                tree_size = len(node_map)
+            else:
+                tree_size = cluster_forest_tree(array_forest, root_index, pruned_neighbors_list,
+                                                labels, densities, delta, cluster_id, beta,
+                                                ewma_values)
             pbar.update(1)
 
             # Check if the cluster has only one point
             # If yes, then its an anomaly
-            if len(node_map) == 1:
+            if tree_size == 1:
                 labels[root_index] = -1
-                del all_node_maps[cluster_id]
+                if array_forest is None:
+                    del all_node_maps[cluster_id]
+                else:
+                    array_forest.remove_root(cluster_id)
             else:
                 cluster_id += 1
 
-    return labels, densities, all_node_maps
+    if array_forest is not None:
+        all_node_maps = array_forest
+    instrumentation.count('trees_built', cluster_id - 1)
+    instrumentation.count('singleton_anomalies', int(np.sum(labels == -1)))
+    return labels, all_node_maps
 
 
 def print_tree_densities(all_node_maps):
     """
     Print the densities of nodes in each cluster tree.
     """
+    all_node_maps = forest.as_node_maps(all_node_maps)
+
     def print_node_and_children(node, node_map, depth=0):
         indent = " " * depth
         print(f"{indent}Density of Node {node.index}: {node.get_density():.3f}")
@@ -6,7 +6,8 @@ CLUSTERING_ENABLED = True
 DISPLAY_DATA_POINT_STATS = True
 
 NUMBER_OF_NEIGHBORS = 50
-CLUSTERING_ALGORITHM = 'ball_tree'  # 'kd_tree'
+CLUSTERING_ALGORITHM = 'ball_tree'  # 'kd_tree', 'brute' or the approximate 'nn_descent'
+NEIGHBOR_RECALL_SAMPLES = 1000  # Points sampled to estimate the recall of approximate kNN
 SIGMA = 1e-9  # Small multiple for regularization
 DATASET_NAME = "Corners"
 DELTA = 0.7  # Threshold for density change
@@ -14,5 +15,28 @@ BETA = 0.3  # Decay constant for EwMA
 DISPLAY_DENSITY = False
 NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE = 0.37  # 0.35
 DELTA_FOR_FILTRATION = 0.4
+ICD_SAMPLE_THRESHOLD = 0  # Clusters above this size use a sampled ICD (0 = always exact)
 DISPLAY_PLOT = ""
 DISPLAY_FINAL_RESULT = ""
+STREAMING = ""
+WARMUP_SIZE = 0
+WINDOW_SIZE = 0
+BATCH_SIZE = 0  # Points inserted together by the streaming mode (0 = one at a time)
+SWEEP = ""
+SWEEP_NUM_NEIGHBORS = []
+SWEEP_DELTAS = []
+SWEEP_BETAS = []
+SWEEP_EPSILONS = []
+SWEEP_WORKERS = 0
+PRUNING_WORKERS = 0  # Processes of the sharded parallel pruning (0 prunes in-process)
+QUIET = "False"
+RUN_REPORT = ""
+PROFILE_MODE = "off"
+PROFILE_DIRECTORY = "profiles"
+TRACE_MEMORY = "False"
+SAVE_SNAPSHOT = ""
+LOAD_SNAPSHOT = ""
+VALIDATION_LEVEL = "full"  # Forest validation: "full", "sample" or "off"
+VALIDATION_SAMPLE_SIZE = 10000  # Nodes checked by the sampled validation
+MERGE_ENGINE = "points"  # Merging of clusters: "points" or the whole-cluster "cluster_graph"
+MERGE_COMPATIBLE_FRACTION = 0  # Share of density-compatible boundary edges to merge (0 = any)
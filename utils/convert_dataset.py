@@ -0,0 +1,38 @@
+"""
+Converts CSV datasets to the memory-mapped binary format.
+Usage: python -m utils.convert_dataset --datasetName Corners
+"""
+
+import argparse
+import glob
+import os
+from utils import constants, data_utils, extract_data, instrumentation
+
+
+def parse_arguments():
+    """
+    This is used to parse the arguments passed from the CML
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasetName', type=str, default=None,
+                        help='Name of the dataset to convert (all datasets if not given)')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Converts the requested dataset, or every CSV dataset of the raw data folder
+    """
+    arguments = parse_arguments()
+    if arguments.datasetName is None:
+        csv_paths = sorted(glob.glob(os.path.join('data', 'clustering', 'raw_data', '*.csv')))
+    else:
+        constants.DATASET_NAME = arguments.datasetName
+        csv_paths = [extract_data.get_csv_data_path()]
+    for csv_path in csv_paths:
+        binary_path = data_utils.convert_to_binary(csv_path)
+        instrumentation.log(f"Converted {csv_path} to {binary_path}")
+
+
+if __name__ == "__main__":
+    main()
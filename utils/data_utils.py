@@ -2,25 +2,82 @@
 Lists all utility functions related to data extraction
 """
 
+import json
+import zlib
 import numpy as np
+from utils import extract_data
+
+# Number of bytes hashed at a time when computing the checksum of a binary dataset
+CHECKSUM_CHUNK_SIZE = 1 << 24
 
 
 def read_data(data_path):
     """
-    Read data from a CSV file using numpy.
+    Read data from a CSV file using numpy, or map it from a binary
+    dataset file (.npy) written by convert_to_binary.
 
     Parameters:
-        data_path (str): Path to the CSV file.
+        data_path (str): Path to the CSV or binary file.
 
     Returns:
         tuple: A tuple containing the loaded data and its dimension.
     """
-    with open(data_path, 'r', encoding='utf-8') as file:
-        data = np.genfromtxt(file, delimiter=',')
+    if data_path.endswith(extract_data.BINARY_EXTENSION):
+        data = read_binary(data_path)
+    else:
+        with open(data_path, 'r', encoding='utf-8') as file:
+            data = np.genfromtxt(file, delimiter=',')
     dimension = data.shape[1]
     return data, dimension
 
 
+def calculate_checksum(data):
+    """
+    Returns the CRC32 checksum of the bytes of an array, hashed in chunks
+    so that mapped arrays are not loaded in memory at once
+    """
+    flat = data.reshape(-1).view(np.uint8)
+    checksum = 0
+    for start in range(0, len(flat), CHECKSUM_CHUNK_SIZE):
+        checksum = zlib.crc32(flat[start:start + CHECKSUM_CHUNK_SIZE], checksum)
+    return checksum
+
+
+def convert_to_binary(csv_path, binary_path=None):
+    """
+    Converts a CSV dataset to a binary .npy file that can be memory-mapped.
+    The shape, dtype and checksum of the points are written to a small
+    JSON header next to it. Returns the path of the binary file.
+    """
+    if binary_path is None:
+        binary_path = extract_data.get_binary_path(csv_path)
+    data = np.ascontiguousarray(get_data(csv_path), dtype=np.float64)
+    np.save(binary_path, data)
+    header = {'shape': list(data.shape), 'dtype': data.dtype.str,
+              'checksum': calculate_checksum(data)}
+    with open(extract_data.get_header_path(binary_path), 'w', encoding='utf-8') as file:
+        json.dump(header, file)
+    return binary_path
+
+
+def read_binary(binary_path, verify=False):
+    """
+    Memory-maps a binary dataset read-only, without copying it in memory.
+    The mapped array is checked against its header, and against its
+    checksum as well if verify is True.
+    """
+    data = np.load(binary_path, mmap_mode='r')
+    with open(extract_data.get_header_path(binary_path), 'r', encoding='utf-8') as file:
+        header = json.load(file)
+    if list(data.shape) != header['shape'] or data.dtype.str != header['dtype']:
+        raise ValueError(f"{binary_path} does not match its header: "
+                         f"{data.shape} {data.dtype.str} instead of "
+                         f"{tuple(header['shape'])} {header['dtype']}")
+    if verify and calculate_checksum(data) != header['checksum']:
+        raise ValueError(f"The checksum of {binary_path} does not match its header")
+    return data
+
+
 def get_data(data_path):
     """
     This function returns the raw data after extraction
@@ -36,3 +93,44 @@ def get_data_dimension(data_path):
     """
     _, dimension = read_data(data_path)
     return dimension
+
+
+class Dataset:
+    """
+    Holds the points of a dataset as one contiguous array, so that a run
+    parses its input file once and passes the points to every stage
+    """
+
+    def __init__(self, data, name=None):
+        """
+        Wraps already loaded points
+        """
+        self.data = np.ascontiguousarray(data, dtype=float)
+        self.name = name
+
+    @classmethod
+    def load(cls, data_path, name=None):
+        """
+        Reads the points from a file
+        """
+        return cls(get_data(data_path), name)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def dimension(self):
+        """
+        Returns the dimension of the points
+        """
+        return self.data.shape[1]
+
+
+def get_dataset_points(dataset=None):
+    """
+    Returns the points of the dataset, reading the raw data file of the
+    configured dataset when no dataset is given
+    """
+    if dataset is None:
+        return get_data(extract_data.get_raw_data_path())
+    return dataset.data
@@ -0,0 +1,90 @@
+"""
+Contains the in-process DyTrAno estimator
+"""
+
+import numpy as np
+from utils import constants, pruning_utils, clustering_utils, filtration_utils, \
+    merge_clusters, data_utils, icd_utils
+
+
+# pylint: disable=R0902
+class DyTrAno:
+    """
+    Runs the DyTrAno pipeline (pruning, tree-based clustering, filtration of
+    potential anomalies and cluster merging) on an in-memory array.
+
+    All parameters are held by the estimator and passed explicitly to every
+    stage, so several estimators can run in the same process, including
+    concurrently, without touching the settings in constants or the global
+    NumPy generator. With the default seed, fit() gives the same labels as
+    main.py on the same data.
+
+    After fit(), labels_ holds the label of each point (-1 for anomalies),
+    densities_ the densities and forest_ the cluster trees as an ArrayForest.
+    """
+
+    # pylint: disable=R0913
+    def __init__(self, k=None, delta=None, beta=None, epsilon=None, sigma=None,
+                 delta_for_filtration=None, algorithm=None, seed=90,
+                 icd_sample_threshold=None, merge_engine=None, merge_compatible_fraction=None):
+        """
+        Initializes the estimator; parameters default to the values in constants
+        """
+        self.k = constants.NUMBER_OF_NEIGHBORS if k is None else k
+        self.delta = constants.DELTA if delta is None else delta
+        self.beta = constants.BETA if beta is None else beta
+        self.epsilon = constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE if epsilon is None \
+            else epsilon
+        self.sigma = constants.SIGMA if sigma is None else sigma
+        self.delta_for_filtration = constants.DELTA_FOR_FILTRATION \
+            if delta_for_filtration is None else delta_for_filtration
+        self.algorithm = constants.CLUSTERING_ALGORITHM if algorithm is None else algorithm
+        self.seed = seed
+        self.icd_sample_threshold = constants.ICD_SAMPLE_THRESHOLD \
+            if icd_sample_threshold is None else icd_sample_threshold
+        self.merge_engine = constants.MERGE_ENGINE if merge_engine is None else merge_engine
+        self.merge_compatible_fraction = constants.MERGE_COMPATIBLE_FRACTION \
+            if merge_compatible_fraction is None else merge_compatible_fraction
+        self.labels_ = None
+        self.filtered_labels_ = None
+        self.densities_ = None
+        self.forest_ = None
+        self.pruned_neighbors_ = None
+        self.icd_cache_ = None
+
+    def fit(self, data):
+        """
+        Clusters the (n, d) array of points and returns the estimator
+        """
+        dataset = data_utils.Dataset(data)
+        if len(dataset) <= self.k:
+            raise ValueError(f"At least {self.k + 1} points are needed to fit with k={self.k}")
+        random_state = np.random.RandomState(self.seed)  # pylint: disable=E1101
+
+        pruned_neighbors, pruned_distances = pruning_utils.optimal_neighborhood_selection(
+            self.k, self.epsilon, self.sigma, return_distances=True, dataset=dataset,
+            random_state=random_state, algorithm=self.algorithm)
+        labels, densities, forest = clustering_utils.tree_based_clustering(
+            pruned_neighbors, self.delta, self.beta, pruned_distances, dataset, as_forest=True)
+
+        icd_cache = icd_utils.ICDCache(dataset.data, sample_threshold=self.icd_sample_threshold)
+        filtered_labels = filtration_utils.filter_potential_anomalies(
+            labels, forest, densities, icd_cache, dataset, self.delta_for_filtration)
+        merged_labels, forest = merge_clusters.process_different_cluster_neighbors(
+            filtered_labels, pruned_neighbors, forest, densities, icd_cache=icd_cache,
+            dataset=dataset, beta=self.beta, delta=self.delta, engine=self.merge_engine,
+            compatible_fraction=self.merge_compatible_fraction)
+
+        self.pruned_neighbors_ = pruned_neighbors
+        self.densities_ = densities
+        self.filtered_labels_ = filtered_labels
+        self.labels_ = np.asarray(merged_labels)
+        self.forest_ = forest
+        self.icd_cache_ = icd_cache
+        return self
+
+    def fit_predict(self, data):
+        """
+        Clusters the (n, d) array of points and returns their labels
+        """
+        return self.fit(data).labels_
@@ -5,14 +5,44 @@ the raw and ground truth data file paths
 import os
 from utils import constants
 
+BINARY_EXTENSION = '.npy'
+
 
 def get_raw_data_path():
     """
-    Returns the raw data file path
+    Returns the raw data file path. The binary version of the dataset is
+    preferred when it exists and is not older than the CSV file.
+    """
+    csv_path = get_csv_data_path()
+    binary_path = get_binary_path(csv_path)
+    if os.path.exists(binary_path) and os.path.exists(get_header_path(binary_path)) and \
+            (not os.path.exists(csv_path) or
+             os.path.getmtime(binary_path) >= os.path.getmtime(csv_path)):
+        return binary_path
+    return csv_path
+
+
+def get_csv_data_path():
+    """
+    Returns the path of the CSV file of the raw data
     """
     return os.path.join('data', 'clustering', 'raw_data', f"{constants.DATASET_NAME}.csv")
 
 
+def get_binary_path(csv_path):
+    """
+    Returns the path of the binary version of a CSV dataset
+    """
+    return os.path.splitext(csv_path)[0] + BINARY_EXTENSION
+
+
+def get_header_path(binary_path):
+    """
+    Returns the path of the JSON header of a binary dataset
+    """
+    return binary_path + '.json'
+
+
 def get_ground_truth_data_path():
     """
     Returns the ground truth data file path
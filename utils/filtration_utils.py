@@ -3,28 +3,17 @@ Contains the helper functions for filtration of potential anomalies
 """
 
 import numpy as np
-from tqdm import tqdm
-from utils import data_utils, extract_data, clustering_utils, pruning_utils, constants
+from scipy.spatial import cKDTree
+from utils import data_utils, clustering_utils, pruning_utils, constants, forest, icd_utils, \
+    instrumentation
 
 
 def calculate_cluster_icd(cluster_points, data):
     """
     Calculate the mean intra-cluster distance for the given cluster points
-    using vectorized operations
+    in fixed-size tiles, so that memory does not grow with the cluster size
     """
-    cluster_points = list(cluster_points)
-    num_points = len(cluster_points)
-    if num_points <= 1:
-        return 0
-
-    cluster_data = data[cluster_points]
-    diff = cluster_data[:, np.newaxis, :] - cluster_data[np.newaxis, :, :]
-    distances = np.sqrt(np.sum(diff ** 2, axis=-1))
-    upper_tri_indices = np.triu_indices(num_points, k=1)
-    total_distance = np.sum(distances[upper_tri_indices])
-    count = len(upper_tri_indices[0])
-
-    return total_distance / count
+    return icd_utils.calculate_icd(data[list(cluster_points)])
 
 
 def find_nearest_inlier(potential_anomaly_index, labels, data):
@@ -39,61 +28,112 @@ def find_nearest_inlier(potential_anomaly_index, labels, data):
     return nearest_inlier_index
 
 
-# pylint: disable=R0914
-def filter_potential_anomalies(labels, all_node_maps, densities):
+def find_nearest_inliers(query_indexes, labels, data):
     """
-    Returns the labels after selection of confirmed anomalies and inliers
+    Find the nearest non-anomalous point of every query point with one
+    batched KD-tree query over the inliers. Returns the distances and the
+    indexes of the nearest inliers.
     """
-    data = data_utils.get_data(extract_data.get_raw_data_path())
-    potential_anomalies = np.where(labels == -1)[0]
+    inliers = np.where((labels != -1) & (labels != 0))[0]
+    distances, positions = cKDTree(data[inliers]).query(data[query_indexes], k=1)
+    return distances, inliers[positions]
 
-    print("\nStarting filtration of potential anomalies...")
-    cluster_icds = {}
 
-    for anomaly_index in tqdm(potential_anomalies):
-        nearest_inlier_index = find_nearest_inlier(anomaly_index, labels, data)
+def patch_nearest_inlier(query_index, nearest_inlier_index, nearest_distance,
+                         promoted_indexes, data):
+    """
+    Returns the nearest inlier of a query point among its nearest original
+    inlier and the points promoted to inliers since the batched query
+    """
+    if not promoted_indexes:
+        return nearest_inlier_index, nearest_distance
+    promoted = np.array(promoted_indexes)
+    distances = np.sqrt(np.sum((data[promoted] - data[query_index]) ** 2, axis=1))
+    closest = np.argmin(distances)
+    # Ties go to the lowest index, as in a scan over the inliers in index order
+    if (distances[closest], promoted[closest]) < (nearest_distance, nearest_inlier_index):
+        return promoted[closest], distances[closest]
+    return nearest_inlier_index, nearest_distance
+
+
+def add_tree_node(node_map, index, density, cluster_id, anchor):
+    """
+    Adds a point to the TreeNode map of the cluster of anchor, below the
+    closest ancestor of anchor at least as dense as the point; a point
+    denser than all of them becomes the parent of the former root
+    """
+    new_root_node = node_map[anchor]
+    while density > new_root_node.get_density():
+        if new_root_node.get_parent() is None:
+            current_root_node = new_root_node
+            new_root_node = None
+            break
+        new_root_node = new_root_node.get_parent()
+
+    new_node = clustering_utils.TreeNode(index, density, new_root_node, cluster_id)
+    if new_root_node is None:
+        new_node.add_child(current_root_node)
+        current_root_node.set_parent(new_node)
+    else:
+        new_root_node.add_child(new_node)
+    node_map[index] = new_node
+
+
+# pylint: disable=R0913,R0914
+def filter_potential_anomalies(labels, all_node_maps, densities, icd_cache=None, dataset=None,
+                               delta_for_filtration=None):
+    """
+    Returns the labels after selection of confirmed anomalies and inliers.
+    all_node_maps may be TreeNode maps or an ArrayForest; either is updated in place.
+    The ICDs of the clusters are kept in icd_cache, which is updated as
+    anomalies join clusters. delta_for_filtration defaults to the value in constants.
+    """
+    if delta_for_filtration is None:
+        delta_for_filtration = constants.DELTA_FOR_FILTRATION
+    data = data_utils.get_dataset_points(dataset)
+    potential_anomalies = np.where(labels == -1)[0]
+    if len(potential_anomalies) == 0 or len(potential_anomalies) == len(labels):
+        return labels
+
+    if icd_cache is None:
+        icd_cache = icd_utils.ICDCache(data)
+    # The members are only read the first time the ICD of a cluster is looked up,
+    # before any anomaly joined it
+    if isinstance(all_node_maps, forest.ArrayForest):
+        cluster_members = all_node_maps.members_by_cluster()
+    else:
+        cluster_members = {cluster_id: node_map.keys()
+                           for cluster_id, node_map in all_node_maps.items()}
+
+    instrumentation.log("\nStarting filtration of potential anomalies...")
+    # All nearest-inlier queries are answered against the original inliers at once;
+    # anomalies promoted to inliers along the way are checked separately
+    nearest_distances, nearest_inliers = find_nearest_inliers(potential_anomalies, labels, data)
+    promoted_indexes = []
+
+    for position, anomaly_index in enumerate(instrumentation.progress(potential_anomalies)):
+        nearest_inlier_index, dist2 = patch_nearest_inlier(
+            anomaly_index, nearest_inliers[position], nearest_distances[position],
+            promoted_indexes, data)
 
         cluster_id = labels[nearest_inlier_index]
-        node_map = all_node_maps[cluster_id]
-
-        if cluster_id not in cluster_icds:
-            icd_inlier = calculate_cluster_icd(list(node_map.keys()), data)
-            cluster_icds[cluster_id] = icd_inlier
-        else:
-            icd_inlier = cluster_icds[cluster_id]
-
-        dist1 = icd_inlier
-        dist2 = pruning_utils.calculate_distance(data[anomaly_index],
-                                                 data[nearest_inlier_index])
-
-        if dist2 < constants.DELTA_FOR_FILTRATION * dist1:
-            labels[anomaly_index] = labels[nearest_inlier_index]
-            cluster_id = labels[nearest_inlier_index]
-            node_map = all_node_maps[cluster_id]
-
-            parent_node = node_map[nearest_inlier_index]
-
-            new_root_node = parent_node
-            anomaly_converted_to_inlier_density = densities[anomaly_index]
-            while anomaly_converted_to_inlier_density > new_root_node.get_density():
-                if new_root_node.get_parent() is None:
-                    current_root_node = new_root_node
-                    new_root_node = None
-                    break
-                new_root_node = new_root_node.get_parent()
-
-            new_node = clustering_utils.TreeNode(anomaly_index,
-                                                 anomaly_converted_to_inlier_density,
-                                                 new_root_node, cluster_id)
-            new_node.set_parent(new_root_node)
-
-            if new_root_node is None:
-                new_node.add_child(current_root_node)
+        dist1 = icd_cache.icd(cluster_id, cluster_members[cluster_id])
+
+        if dist2 < delta_for_filtration * dist1:
+            promoted_indexes.append(anomaly_index)
+            icd_cache.add_points(cluster_id, [anomaly_index])
+            labels[anomaly_index] = cluster_id
+            if isinstance(all_node_maps, forest.ArrayForest):
+                all_node_maps.insert(anomaly_index, densities[anomaly_index], cluster_id,
+                                     nearest_inlier_index)
             else:
-                new_root_node.add_child(new_node)
-            node_map[anomaly_index] = new_node
+                add_tree_node(all_node_maps[cluster_id], anomaly_index, densities[anomaly_index],
+                              cluster_id, nearest_inlier_index)
 
         else:
             labels[anomaly_index] = -1  # Confirmed anomaly
 
+    instrumentation.count('potential_anomalies', len(potential_anomalies))
+    instrumentation.count('anomalies_promoted', len(promoted_indexes))
+    instrumentation.count('anomalies_confirmed', len(potential_anomalies) - len(promoted_indexes))
     return labels
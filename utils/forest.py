@@ -0,0 +1,321 @@
+"""
+Contains the array-backed representation of the cluster forest
+"""
+
+import numpy as np
+from utils import clustering_utils
+
+NO_NODE = -1
+
+
+# pylint: disable=R0904
+class ArrayForest:
+    """
+    Stores every cluster tree of a run in parallel NumPy arrays indexed by
+    data point: parent, density, cluster id and first-child/next-sibling
+    links, plus the root of each cluster. Points that are not in any tree
+    have cluster id 0. This takes 24 bytes per point, against hundreds of
+    bytes for a TreeNode in a dict of dicts.
+
+    The child lists hold the same links as parent, which the whole-forest
+    queries use.
+    """
+
+    def __init__(self, num_points):
+        """
+        Initializes an empty forest over num_points points
+        """
+        self.parent = np.full(num_points, NO_NODE, dtype=np.int32)
+        self.first_child = np.full(num_points, NO_NODE, dtype=np.int32)
+        self.next_sibling = np.full(num_points, NO_NODE, dtype=np.int32)
+        self.density = np.zeros(num_points)
+        self.cluster_id = np.zeros(num_points, dtype=np.int32)
+        self.roots = {}
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def nbytes(self):
+        """
+        Returns the memory used by the per-point arrays
+        """
+        return (self.parent.nbytes + self.first_child.nbytes + self.next_sibling.nbytes +
+                self.density.nbytes + self.cluster_id.nbytes)
+
+    @classmethod
+    def from_node_maps(cls, all_node_maps, num_points):
+        """
+        Builds the forest from the TreeNode maps of all clusters
+        """
+        forest = cls(num_points)
+        indices = []
+        parents = []
+        for cluster_id, node_map in all_node_maps.items():
+            for index, node in node_map.items():
+                parent = node.get_parent()
+                indices.append(index)
+                parents.append(NO_NODE if parent is None else parent.get_index())
+                forest.density[index] = node.get_density()
+                forest.cluster_id[index] = cluster_id
+
+        forest.parent[np.array(indices, dtype=np.int32)] = np.array(parents, dtype=np.int32)
+        forest.link_children()
+        forest.find_roots()
+        return forest
+
+    def copy(self):
+        """
+        Returns an independent copy of the forest
+        """
+        forest = ArrayForest(0)
+        forest.parent = self.parent.copy()
+        forest.first_child = self.first_child.copy()
+        forest.next_sibling = self.next_sibling.copy()
+        forest.density = self.density.copy()
+        forest.cluster_id = self.cluster_id.copy()
+        forest.roots = dict(self.roots)
+        return forest
+
+    def find_roots(self):
+        """
+        Caches the root of every cluster: its densest node without a parent
+        """
+        candidates = np.flatnonzero((self.cluster_id != 0) & (self.parent == NO_NODE))
+        order = np.lexsort((-self.density[candidates], self.cluster_id[candidates]))
+        candidates = candidates[order]
+        cluster_ids = self.cluster_id[candidates]
+        first = np.ones(len(candidates), dtype=bool)
+        first[1:] = cluster_ids[1:] != cluster_ids[:-1]
+        self.roots = dict(zip(cluster_ids[first].tolist(), candidates[first].tolist()))
+
+    def link_children(self):
+        """
+        Rebuilds the child lists from the parent links, in index order
+        """
+        self.first_child[:] = NO_NODE
+        self.next_sibling[:] = NO_NODE
+        children = np.flatnonzero(self.parent != NO_NODE).astype(np.int32)
+        parents = self.parent[children]
+        order = np.argsort(parents, kind='stable')
+        children = children[order]
+        parents = parents[order]
+        first = np.ones(len(parents), dtype=bool)
+        first[1:] = parents[1:] != parents[:-1]
+        self.first_child[parents[first]] = children[first]
+        same_parent = ~first[1:]
+        self.next_sibling[children[:-1][same_parent]] = children[1:][same_parent]
+
+    def to_node_maps(self):
+        """
+        Returns the forest as TreeNode maps, for stages that mutate TreeNodes
+        """
+        members = np.flatnonzero(self.cluster_id != 0)
+        nodes = {index: clustering_utils.TreeNode(index, self.density[index], None,
+                                                  int(self.cluster_id[index]))
+                 for index in members.tolist()}
+        for index in members.tolist():
+            parent = int(self.parent[index])
+            if parent != NO_NODE:
+                nodes[index].set_parent(nodes[parent])
+        for index in members.tolist():
+            for child in self.children(index):
+                nodes[index].add_child(nodes[child])
+
+        all_node_maps = {cluster_id: {} for cluster_id in self.roots}
+        for index in members.tolist():
+            all_node_maps.setdefault(int(self.cluster_id[index]), {})[index] = nodes[index]
+        return all_node_maps
+
+    def children(self, index):
+        """
+        Returns the child indexes of a node
+        """
+        child_indexes = []
+        child = int(self.first_child[index])
+        while child != NO_NODE:
+            child_indexes.append(child)
+            child = int(self.next_sibling[child])
+        return child_indexes
+
+    def add_node(self, index, density, cluster_id, parent=NO_NODE):
+        """
+        Adds a point to a cluster below the given parent, or as the cluster's
+        root when no parent is given
+        """
+        self.density[index] = density
+        self.cluster_id[index] = cluster_id
+        self.parent[index] = NO_NODE
+        if parent == NO_NODE:
+            self.roots[cluster_id] = index
+        else:
+            self.add_child(parent, index)
+
+    def add_child(self, parent, child):
+        """
+        Links a child below a parent, as the first of its children
+        """
+        self.parent[child] = parent
+        self.next_sibling[child] = self.first_child[parent]
+        self.first_child[parent] = child
+
+    def remove_child(self, parent, child):
+        """
+        Unlinks a child from its parent
+        """
+        if self.first_child[parent] == child:
+            self.first_child[parent] = self.next_sibling[child]
+        else:
+            sibling = int(self.first_child[parent])
+            while self.next_sibling[sibling] != child:
+                sibling = int(self.next_sibling[sibling])
+            self.next_sibling[sibling] = self.next_sibling[child]
+        self.next_sibling[child] = NO_NODE
+        self.parent[child] = NO_NODE
+
+    def remove_root(self, cluster_id):
+        """
+        Takes a cluster reduced to its root out of the forest.
+        Returns the index of the root.
+        """
+        index = self.roots.pop(cluster_id)
+        self.density[index] = 0
+        self.cluster_id[index] = 0
+        return index
+
+    def attach(self, index, anchor):
+        """
+        Links a parentless node into the tree of anchor: below the closest
+        ancestor of anchor at least as dense as the node, or above the root
+        when the node is denser than all of them. Returns the new parent,
+        or NO_NODE when the node became the root of the tree.
+        """
+        node = anchor
+        while self.density[index] > self.density[node]:
+            if self.parent[node] == NO_NODE:
+                self.add_child(index, node)
+                return NO_NODE
+            node = int(self.parent[node])
+        self.add_child(node, index)
+        return node
+
+    def insert(self, index, density, cluster_id, anchor):
+        """
+        Adds a point to the cluster of anchor (see attach); a point denser
+        than the root becomes the root, with the former root as its child
+        """
+        self.density[index] = density
+        self.cluster_id[index] = cluster_id
+        self.parent[index] = NO_NODE
+        if self.attach(index, anchor) == NO_NODE:
+            self.roots[cluster_id] = index
+
+    def subtree(self, index):
+        """
+        Returns the indexes of the subtree rooted at a node in depth-first
+        pre-order, iteratively so that deep chains do not hit the recursion limit
+        """
+        subtree = []
+        stack = [index]
+        while stack:
+            current = stack.pop()
+            subtree.append(current)
+            stack.extend(reversed(self.children(current)))
+        return subtree
+
+    def members(self, cluster_id):
+        """
+        Returns the indexes of the points of a cluster
+        """
+        return np.flatnonzero(self.cluster_id == cluster_id)
+
+    def members_by_cluster(self):
+        """
+        Returns the indexes of the points of every cluster, keyed by cluster id
+        """
+        in_tree = np.flatnonzero(self.cluster_id > 0)
+        order = in_tree[np.argsort(self.cluster_id[in_tree], kind='stable')]
+        cluster_ids, starts = np.unique(self.cluster_id[order], return_index=True)
+        return dict(zip(cluster_ids.tolist(), np.split(order, starts[1:])))
+
+    def cluster_sizes(self):
+        """
+        Returns the number of points in each cluster, indexed by cluster id
+        """
+        return np.bincount(self.cluster_id[self.cluster_id > 0])
+
+    def root_density(self, cluster_id):
+        """
+        Returns the density of a cluster's root
+        """
+        return self.density[self.roots[cluster_id]]
+
+    def children_csr(self):
+        """
+        Returns the children of every node as CSR arrays (indptr, indices),
+        so that the children of node i are indices[indptr[i]:indptr[i + 1]]
+        """
+        has_parent = np.flatnonzero(self.parent != NO_NODE)
+        parents = self.parent[has_parent]
+        order = np.argsort(parents, kind='stable')
+        indptr = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parents, minlength=len(self)), out=indptr[1:])
+        return indptr, has_parent[order].astype(np.int32)
+
+    def listed_children(self, parents=None):
+        """
+        Returns the (parent, child) pairs of the child lists of the given
+        nodes (all nodes by default), walking every list in lockstep.
+        Raises a ValueError if a list loops.
+        """
+        if parents is None:
+            parents = np.flatnonzero(self.first_child != NO_NODE)
+        parents = np.asarray(parents)
+        children = self.first_child[parents]
+        all_parents = []
+        all_children = []
+        for _ in range(len(self) + 1):
+            listed = children != NO_NODE
+            if not np.any(listed):
+                return np.concatenate(all_parents or [parents[:0]]), \
+                    np.concatenate(all_children or [children[:0]])
+            parents, children = parents[listed], children[listed]
+            all_parents.append(parents)
+            all_children.append(children)
+            children = self.next_sibling[children]
+        raise ValueError("The child lists of the forest contain a loop")
+
+    def tree_roots(self):
+        """
+        Returns the root reached from every tree node by following parent
+        links, using pointer jumping. Nodes outside the trees get NO_NODE.
+        Raises a ValueError if the parent links contain a cycle.
+        """
+        in_tree = self.cluster_id != 0
+        jump = np.where(self.parent == NO_NODE, np.arange(len(self)), self.parent)
+        # Each step doubles the distance jumped, so log2(n) + 1 steps reach every root
+        for _ in range(max(len(self), 2).bit_length() + 1):
+            next_jump = jump[jump]
+            if np.array_equal(next_jump, jump):
+                break
+            jump = next_jump
+        if np.any(self.parent[jump[in_tree]] != NO_NODE):
+            raise ValueError("The parent links of the forest contain a cycle")
+        return np.where(in_tree, jump, NO_NODE)
+
+    def density_violations(self):
+        """
+        Returns the nodes whose density is higher than their parent's
+        """
+        has_parent = np.flatnonzero(self.parent != NO_NODE)
+        return has_parent[self.density[has_parent] > self.density[self.parent[has_parent]]]
+
+
+def as_node_maps(all_node_maps):
+    """
+    Returns TreeNode maps for a forest given either as TreeNode maps
+    or as an ArrayForest
+    """
+    if isinstance(all_node_maps, ArrayForest):
+        return all_node_maps.to_node_maps()
+    return all_node_maps
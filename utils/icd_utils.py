@@ -0,0 +1,237 @@
+"""
+Contains the helper functions for the intra-cluster distance (ICD) of clusters
+"""
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+# Number of points per side of the distance tiles. Bounds the temporary
+# memory to ICD_BLOCK_SIZE ** 2 distances (32 MB), whatever the cluster size.
+ICD_BLOCK_SIZE = 2048
+# Number of random point pairs used by the sampled ICD estimator
+ICD_NUM_SAMPLES = 100000
+
+
+def pairwise_distance_sum(points, block_size=ICD_BLOCK_SIZE):
+    """
+    Returns the sum of the distances between all pairs of points,
+    computed tile by tile
+    """
+    total = 0.0
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size]
+        # The diagonal tile is symmetric with a zero diagonal
+        total += np.sum(cdist(block, block)) / 2
+        total += cross_distance_sum(block, points[start + block_size:], block_size)
+    return total
+
+
+def cross_distance_sum(points_a, points_b, block_size=ICD_BLOCK_SIZE):
+    """
+    Returns the sum of the distances between every point of points_a
+    and every point of points_b, computed tile by tile
+    """
+    total = 0.0
+    for start_a in range(0, len(points_a), block_size):
+        block_a = points_a[start_a:start_a + block_size]
+        for start_b in range(0, len(points_b), block_size):
+            total += np.sum(cdist(block_a, points_b[start_b:start_b + block_size]))
+    return total
+
+
+def calculate_icd(points, block_size=ICD_BLOCK_SIZE):
+    """
+    Returns the exact mean distance between all pairs of points
+    """
+    num_points = len(points)
+    if num_points <= 1:
+        return 0
+    return pairwise_distance_sum(points, block_size) / (num_points * (num_points - 1) / 2)
+
+
+def sample_icd(points, num_samples=ICD_NUM_SAMPLES, random_state=None):
+    """
+    Estimates the mean distance between all pairs of points from random
+    pairs of distinct points. Returns the estimate and its standard error;
+    the exact ICD lies within 2 standard errors of the estimate with
+    about 95% probability.
+    """
+    num_points = len(points)
+    if num_points <= 1:
+        return 0, 0
+    if random_state is None:
+        random_state = np.random.RandomState(90)  # pylint: disable=E1101
+    first = random_state.randint(num_points, size=num_samples)
+    second = random_state.randint(num_points - 1, size=num_samples)
+    second += second >= first
+    distances = np.linalg.norm(points[first] - points[second], axis=1)
+    return np.mean(distances), np.std(distances, ddof=1) / np.sqrt(num_samples)
+
+
+# pylint: disable=R0902
+class ICDCache:
+    """
+    Caches the ICD of clusters as the sum of their pairwise distances,
+    which is updated incrementally when points join or leave a cluster.
+    Points moved between clusters (merges) only invalidate the sums of the
+    two clusters, which are computed again when they are next read.
+    Clusters larger than sample_threshold (if non-zero) are computed from
+    a sampled estimate instead of the exact sum.
+    """
+
+    # pylint: disable=R0913
+    def __init__(self, data, block_size=ICD_BLOCK_SIZE, sample_threshold=0,
+                 num_samples=ICD_NUM_SAMPLES, seed=90):
+        """
+        Initializes an empty cache over the given data points
+        """
+        self.data = data
+        self.block_size = block_size
+        self.sample_threshold = sample_threshold
+        self.num_samples = num_samples
+        self.random_state = np.random.RandomState(seed)  # pylint: disable=E1101
+        self.members = {}
+        self.pending_removals = {}
+        self.distance_sums = {}
+        self.distance_sum_errors = {}
+
+    def __contains__(self, cluster_id):
+        return cluster_id in self.members
+
+    def icd(self, cluster_id, members=None):
+        """
+        Returns the ICD of a cluster. The members of the cluster are only
+        needed the first time the cluster is looked up; after that the
+        cached members are used.
+        """
+        if cluster_id not in self.distance_sums:
+            self._compute(cluster_id, self._members(cluster_id) if cluster_id in self.members
+                          else list(members))
+        num_pairs = self._num_pairs(cluster_id)
+        return self.distance_sums[cluster_id] / num_pairs if num_pairs else 0
+
+    def standard_error(self, cluster_id):
+        """
+        Returns the standard error of the cached ICD of a cluster,
+        which is 0 unless the ICD was estimated by sampling
+        """
+        self.icd(cluster_id)
+        num_pairs = self._num_pairs(cluster_id)
+        return self.distance_sum_errors[cluster_id] / num_pairs if num_pairs else 0
+
+    def _num_pairs(self, cluster_id):
+        num_points = len(self.members[cluster_id]) - len(self.pending_removals.get(cluster_id, ()))
+        return num_points * (num_points - 1) / 2
+
+    def _members(self, cluster_id):
+        """
+        Returns the members of a cached cluster after dropping the points
+        that moved out of it since they were last read
+        """
+        removed = self.pending_removals.pop(cluster_id, None)
+        if removed:
+            self.members[cluster_id] = [index for index in self.members[cluster_id]
+                                        if index not in removed]
+        return self.members[cluster_id]
+
+    def _compute(self, cluster_id, members):
+        """
+        Computes the pairwise distance sum of a cluster, exactly or by sampling
+        """
+        points = self.data[members]
+        num_pairs = len(members) * (len(members) - 1) / 2
+        if self.sample_threshold and len(members) > self.sample_threshold:
+            estimate, error = sample_icd(points, self.num_samples, self.random_state)
+            self.distance_sums[cluster_id] = estimate * num_pairs
+            self.distance_sum_errors[cluster_id] = error * num_pairs
+        else:
+            self.distance_sums[cluster_id] = pairwise_distance_sum(points, self.block_size)
+            self.distance_sum_errors[cluster_id] = 0
+        self.members[cluster_id] = members
+
+    def refresh(self):
+        """
+        Computes the ICDs invalidated since they were last read
+        """
+        for cluster_id in self.members:
+            if cluster_id not in self.distance_sums:
+                self._compute(cluster_id, self._members(cluster_id))
+
+    def _invalidate(self, cluster_id):
+        """
+        Drops the cached sums of a cluster, keeping its members
+        """
+        self.distance_sums.pop(cluster_id, None)
+        self.distance_sum_errors.pop(cluster_id, None)
+
+    def add_points(self, cluster_id, indexes):
+        """
+        Updates the cached ICD of a cluster after the given points joined it
+        """
+        if cluster_id not in self.members:
+            return
+        if cluster_id not in self.distance_sums:
+            self._extend(cluster_id, indexes)
+            return
+        points = self.data[indexes]
+        self.distance_sums[cluster_id] += (
+            cross_distance_sum(points, self.data[self._members(cluster_id)], self.block_size) +
+            pairwise_distance_sum(points, self.block_size))
+        self.members[cluster_id].extend(indexes)
+
+    def remove_points(self, cluster_id, indexes):
+        """
+        Updates the cached ICD of a cluster after the given points left it
+        """
+        if cluster_id not in self.members:
+            return
+        removed = set(indexes)
+        remaining = [index for index in self._members(cluster_id) if index not in removed]
+        if cluster_id not in self.distance_sums:
+            self.members[cluster_id] = remaining
+            return
+        points = self.data[indexes]
+        self.distance_sums[cluster_id] -= (
+            cross_distance_sum(points, self.data[remaining], self.block_size) +
+            pairwise_distance_sum(points, self.block_size))
+        self.members[cluster_id] = remaining
+
+    def _extend(self, cluster_id, indexes):
+        """
+        Adds points to the members of a cached cluster, cancelling the
+        pending removals of the points that moved back into it
+        """
+        removed = self.pending_removals.get(cluster_id)
+        if removed:
+            returning = removed.intersection(indexes)
+            removed -= returning
+            indexes = [index for index in indexes if index not in returning]
+        self.members[cluster_id].extend(indexes)
+
+    def move_points(self, indexes, old_cluster_id, new_cluster_id):
+        """
+        Moves points from one cluster to another. Updating the sums would
+        cost O(moved points x cluster size) inside the merge loops, so the
+        ICDs of both clusters are invalidated instead and computed again,
+        exactly or by sampling, when they are next read. The moved points
+        are only dropped from the members of the old cluster at that time,
+        so a move costs O(moved points).
+        """
+        indexes = list(indexes)
+        if old_cluster_id in self.members:
+            self.pending_removals.setdefault(old_cluster_id, set()).update(indexes)
+            self._invalidate(old_cluster_id)
+        if new_cluster_id in self.members:
+            self._extend(new_cluster_id, indexes)
+            self._invalidate(new_cluster_id)
+
+    def relabel(self, label_mapping):
+        """
+        Renames the cached clusters; clusters missing from the mapping are dropped
+        """
+        for cache in (self.members, self.pending_removals, self.distance_sums,
+                      self.distance_sum_errors):
+            renamed = {label_mapping[cluster_id]: value for cluster_id, value in cache.items()
+                       if cluster_id in label_mapping}
+            cache.clear()
+            cache.update(renamed)
@@ -0,0 +1,337 @@
+"""
+Contains the per-stage instrumentation: timings, item counts, memory high-water
+marks, optional profiling, pluggable hooks and the switches of the quiet mode
+"""
+
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+from tqdm import tqdm
+from utils import constants
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+PROFILE_MODES = ('off', 'cprofile', 'sampling')
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between two samples of the sampling profiler
+PROFILE_TOP_ENTRIES = 25  # Number of functions kept in a sampling profile
+
+_hooks = []
+_active_recorder = None  # pylint: disable=C0103
+
+
+def is_quiet():
+    """
+    Returns whether the progress bars and stage messages are turned off
+    """
+    return constants.QUIET == "True"
+
+
+def log(message):
+    """
+    Prints a stage message, unless running in quiet mode
+    """
+    if not is_quiet():
+        print(message)
+
+
+def progress(iterable=None, **kwargs):
+    """
+    Wraps an iterable in a tqdm progress bar, which is disabled in quiet mode
+    """
+    return tqdm(iterable, disable=is_quiet(), **kwargs)
+
+
+def add_hook(hook):
+    """
+    Registers a hook notified at the start and the end of every recorded stage
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """
+    Unregisters a hook added by add_hook
+    """
+    _hooks.remove(hook)
+
+
+class StageHook:
+    """
+    Base class of the hooks: subclasses override the events they need
+    """
+
+    def stage_started(self, name):
+        """
+        Called when a stage starts
+        """
+
+    def stage_finished(self, record):
+        """
+        Called with the StageRecord of a stage when it ends
+        """
+
+
+class StageRecord:  # pylint: disable=R0903
+    """
+    Holds the measurements of one stage: its wall-clock time, its item counts,
+    the memory high-water marks and the profile, when profiling is on.
+    process_peak_rss_bytes is the peak resident memory of the whole process
+    when the stage ended, not of the stage alone: it only grows from stage to
+    stage, so a stage raised the peak only when it is above the previous one.
+    """
+
+    def __init__(self, name):
+        """
+        Initializes an empty record
+        """
+        self.name = name
+        self.seconds = 0.0
+        self.counts = {}
+        self.process_peak_rss_bytes = None
+        self.traced_peak_bytes = None
+        self.profile = None
+
+    def to_dict(self):
+        """
+        Returns the record as a JSON-serializable dict
+        """
+        return {'name': self.name, 'seconds': self.seconds, 'counts': self.counts,
+                'process_peak_rss_bytes': self.process_peak_rss_bytes,
+                'traced_peak_bytes': self.traced_peak_bytes, 'profile': self.profile}
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of a thread at a fixed interval from a background
+    thread, and counts how often each function is running (self) or
+    on the stack (cumulative)
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        """
+        Initializes the profiler for the calling thread
+        """
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.self_samples = {}
+        self.cumulative_samples = {}
+        self.num_samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """
+        Starts sampling
+        """
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling
+        """
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        """
+        Takes samples until stopped
+        """
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=W0212
+            if frame is None:
+                continue
+            self.num_samples += 1
+            location = f"{frame.f_code.co_filename}:{frame.f_code.co_name}"
+            self.self_samples[location] = self.self_samples.get(location, 0) + 1
+            on_stack = set()
+            while frame is not None:
+                on_stack.add(f"{frame.f_code.co_filename}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            for location in on_stack:
+                self.cumulative_samples[location] = self.cumulative_samples.get(location, 0) + 1
+
+    def summary(self, top=PROFILE_TOP_ENTRIES):
+        """
+        Returns the number of samples and the functions with the most self samples
+        """
+        functions = sorted(self.self_samples, key=self.self_samples.get, reverse=True)[:top]
+        return {'interval': self.interval, 'samples': self.num_samples,
+                'functions': [{'function': function, 'self': self.self_samples[function],
+                               'cumulative': self.cumulative_samples[function]}
+                              for function in functions]}
+
+
+def get_max_rss_bytes():
+    """
+    Returns the peak resident memory of the process so far, or None if unknown
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class RunRecorder:
+    """
+    Records the stages of a run. Stages are timed and their counts collected;
+    tracemalloc peaks and profiles are opt-in, as they slow the stages down.
+    With profile='cprofile', the stats of each stage are dumped to
+    profile_directory/<stage>.prof; with profile='sampling', the top
+    functions are kept in the report.
+    """
+
+    def __init__(self, trace_memory=False, profile='off', profile_directory='profiles'):
+        """
+        Initializes a recorder without stages
+        """
+        if profile not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {profile!r}, expected one of {PROFILE_MODES}")
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.profile_directory = profile_directory
+        self.records = []
+        self.current = None
+        self.start_time = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Records the stage run inside the with block and yields its StageRecord
+        """
+        record = StageRecord(name)
+        previous, self.current = self.current, record
+        for hook in _hooks:
+            hook.stage_started(name)
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        profiler = self._start_profiler()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - start
+            self._stop_profiler(profiler, record)
+            if started_tracing:
+                record.traced_peak_bytes = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            record.process_peak_rss_bytes = get_max_rss_bytes()
+            self.current = previous
+            self.records.append(record)
+            for hook in _hooks:
+                hook.stage_finished(record)
+
+    def _start_profiler(self):
+        """
+        Starts the profiler of a stage, if profiling is on
+        """
+        if self.profile == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        if self.profile == 'sampling':
+            profiler = SamplingProfiler()
+            profiler.start()
+            return profiler
+        return None
+
+    def _stop_profiler(self, profiler, record):
+        """
+        Stops the profiler of a stage and stores its results in the record
+        """
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            os.makedirs(self.profile_directory, exist_ok=True)
+            record.profile = os.path.join(self.profile_directory, f"{record.name}.prof")
+            profiler.dump_stats(record.profile)
+        elif isinstance(profiler, SamplingProfiler):
+            profiler.stop()
+            record.profile = profiler.summary()
+
+    def count(self, name, value=1):
+        """
+        Adds value to a count of the current stage
+        """
+        if self.current is not None:
+            self.current.counts[name] = self.current.counts.get(name, 0) + value
+
+    def set_value(self, name, value):
+        """
+        Sets a value (a ratio, a size...) of the current stage
+        """
+        if self.current is not None:
+            self.current.counts[name] = value
+
+    def report(self, **metadata):
+        """
+        Returns the run report: the metadata, the environment and the stage records
+        """
+        return {'metadata': metadata,
+                'environment': {'python': platform.python_version(),
+                                'platform': platform.platform()},
+                'total_seconds': time.perf_counter() - self.start_time,
+                'process_peak_rss_bytes': get_max_rss_bytes(),
+                'stages': [record.to_dict() for record in self.records]}
+
+    def write_report(self, path, **metadata):
+        """
+        Writes the run report to a JSON file
+        """
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.report(**metadata), file, indent=2, default=str)
+
+
+def start_run(recorder):
+    """
+    Makes recorder the one receiving the stages and counts of this process
+    """
+    global _active_recorder  # pylint: disable=W0603
+    _active_recorder = recorder
+    return recorder
+
+
+def finish_run():
+    """
+    Detaches the active recorder and returns it
+    """
+    global _active_recorder  # pylint: disable=W0603
+    recorder, _active_recorder = _active_recorder, None
+    return recorder
+
+
+@contextmanager
+def stage(name):
+    """
+    Records a stage on the active recorder, or does nothing without one
+    """
+    if _active_recorder is None:
+        yield None
+    else:
+        with _active_recorder.stage(name) as record:
+            yield record
+
+
+def count(name, value=1):
+    """
+    Adds value to a count of the current stage of the active recorder, if any
+    """
+    if _active_recorder is not None:
+        _active_recorder.count(name, value)
+
+
+def set_value(name, value):
+    """
+    Sets a value of the current stage of the active recorder, if any
+    """
+    if _active_recorder is not None:
+        _active_recorder.set_value(name, value)
@@ -3,8 +3,27 @@ Contains the necessary functions to perform cluster-merging
 """
 
 import numpy as np
-from tqdm import tqdm
-from utils import data_utils, extract_data, pruning_utils, clustering_utils, constants
+from utils import data_utils, pruning_utils, clustering_utils, constants, forest, \
+    instrumentation
+from utils.cluster_registry import ClusterRegistry
+from utils.neighbor_graph import NeighborGraph
+
+# A merge candidate: a pruned neighbor edge between points of different clusters
+CANDIDATE_DTYPE = np.dtype([('point', np.int64), ('neighbor', np.int64),
+                            ('neighbor_label', np.int64), ('distance', np.float64)])
+# An edge of the cluster-adjacency graph: the boundary edges between two clusters,
+# how many satisfy the density criterion, their distances and the closest one,
+# which goes from point (in cluster) to neighbor (in neighbor_cluster). The root
+# moves are the closest edges along which the root of cluster (or neighbor_cluster)
+# may move to the other cluster, with the point it moves next to (NO_NODE if none).
+ADJACENCY_DTYPE = np.dtype([('cluster', np.int64), ('neighbor_cluster', np.int64),
+                            ('edges', np.int64), ('compatible_edges', np.int64),
+                            ('min_distance', np.float64), ('mean_distance', np.float64),
+                            ('point', np.int64), ('neighbor', np.int64),
+                            ('root_anchor', np.int64), ('root_distance', np.float64),
+                            ('neighbor_root_anchor', np.int64),
+                            ('neighbor_root_distance', np.float64)])
+MERGE_ENGINES = ('points', 'cluster_graph')
 
 
 def find_nearest_point_in_cluster(data_point, cluster_indices, data, actual_idx):
@@ -20,221 +39,457 @@ def find_nearest_point_in_cluster(data_point, cluster_indices, data, actual_idx)
     return nearest_index, min_distance
 
 
-def check_different_cluster_neighbors_helper(filtered_labels, pruned_neighbors_list):
+def check_different_cluster_neighbors_helper(filtered_labels, pruned_neighbors_list,
+                                             dataset=None):
     """
-    Helper function to check and print points that have pruned neighbors
-    belonging to different clusters.
+    Helper function to find the pruned neighbor edges between points of
+    different clusters, in one array pass over all the edges. Returns them
+    as a CANDIDATE_DTYPE structured array sorted by increasing distance.
     """
-    data = data_utils.get_data(extract_data.get_raw_data_path())
-    different_cluster_neighbors = []
-
-    print("\nIdentifying neighbors belonging to different clusters...")
-    for idx, neighbors in tqdm(enumerate(pruned_neighbors_list)):
-        current_label = filtered_labels[idx]
-        if current_label == -1:
-            continue
-
-        for neighbor_idx in neighbors:
-            neighbor_label = filtered_labels[neighbor_idx]
-            if neighbor_label in (current_label, -1):
-                continue
-
-            distance_between_points = pruning_utils.calculate_distance(data[idx],
-                                                                       data[neighbor_idx])
-
-            different_cluster_neighbors.append((idx, neighbor_idx, neighbor_label,
-                                                distance_between_points))
-
-    different_cluster_neighbors.sort(key=lambda x: x[3])
-    return different_cluster_neighbors
-
-
-def get_different_cluster_neighbors(filtered_labels, pruned_neighbors_list):
+    data = data_utils.get_dataset_points(dataset)
+    graph = pruned_neighbors_list
+    if not isinstance(graph, NeighborGraph):
+        graph = NeighborGraph.from_rows(pruned_neighbors_list)
+    labels = np.asarray(filtered_labels)
+
+    instrumentation.log("\nIdentifying neighbors belonging to different clusters...")
+    points, neighbors, _ = graph.edges()
+    point_labels = labels[points]
+    neighbor_labels = labels[neighbors]
+    different = (point_labels != -1) & (neighbor_labels != -1) & \
+        (point_labels != neighbor_labels)
+    points, neighbors = points[different], neighbors[different]
+
+    candidates = np.empty(len(points), dtype=CANDIDATE_DTYPE)
+    candidates['point'] = points
+    candidates['neighbor'] = neighbors
+    candidates['neighbor_label'] = neighbor_labels[different]
+    candidates['distance'] = np.sqrt(np.sum((data[points] - data[neighbors]) ** 2, axis=1))
+    # The stable sort keeps the edges of equal distance in point order
+    return candidates[np.argsort(candidates['distance'], kind='stable')]
+
+
+def get_different_cluster_neighbors(filtered_labels, pruned_neighbors_list, dataset=None):
     """
-    Returns the points that have pruned neighbors
-    belonging to different clusters.
+    Returns the pruned neighbor edges between points of different clusters,
+    as a CANDIDATE_DTYPE structured array sorted by increasing distance.
     """
-    return check_different_cluster_neighbors_helper(filtered_labels, pruned_neighbors_list)
+    return check_different_cluster_neighbors_helper(filtered_labels, pruned_neighbors_list,
+                                                    dataset)
 
 
-def check_different_cluster_neighbors(filtered_labels, pruned_neighbors_list):
+def check_different_cluster_neighbors(filtered_labels, pruned_neighbors_list, dataset=None):
     """
     Prints out points having neighbors belonging to a different cluster.\
     To be used only for debugging.
     Note: Set debugging=True in process_different_cluster_neighbors to enable this
     """
     different_cluster_neighbors = get_different_cluster_neighbors(filtered_labels,
-                                                                  pruned_neighbors_list)
+                                                                  pruned_neighbors_list, dataset)
     print("Points with pruned neighbors belonging to different clusters:")
-    for point, neighbor, neighbor_label, distance_between_points in different_cluster_neighbors:
+    for point, neighbor, neighbor_label, distance_between_points in \
+            different_cluster_neighbors.tolist():
         print(
             f"Point {point} (Cluster {filtered_labels[point]}) has neighbor "
             f"{neighbor} (Cluster {neighbor_label}) with d1 = {distance_between_points:.3f}")
 
 
-def update_child_labels(node, new_label, labels, all_node_maps, old_label):
+def move_subtree(index, new_label, labels, array_forest):
     """
-    Recursively update the labels and cluster IDs of the children of the given node.
+    Moves the subtree rooted at the given node to another cluster:
+    updates the cluster IDs and the labels in bulk.
+    Returns the indexes of the moved nodes.
     """
-    node_index = node.get_index()
-    node.cluster_id = new_label
-    labels[node_index] = new_label
-    all_node_maps[new_label][node_index] = node
-    if old_label in all_node_maps and node_index in all_node_maps[old_label]:
-        del all_node_maps[old_label][node_index]
-
-    for child in node.get_children():
-        update_child_labels(child, new_label, labels, all_node_maps, old_label)
+    indexes = array_forest.subtree(index)
+    array_forest.cluster_id[indexes] = new_label
+    labels[indexes] = new_label
+    return indexes
 
 
-# pylint: disable=R0913
-def cluster_reduction_helper(data_idx, all_node_maps, old_cluster_label,
-                             new_cluster_label, neighbor_idx, labels, densities):
-    """
-    Helper function that updates the node's labels,
-    its child node's labels, removes it from the previous parent,
-    and adds it to the new parent.
-    """
-    if data_idx in all_node_maps[old_cluster_label]:
-        node = all_node_maps[old_cluster_label][data_idx]
-        previous_parent_node = node.get_parent()
-        update_child_labels(node, new_cluster_label, labels, all_node_maps,
-                            old_cluster_label)
-        # Delete the datapoint from children list of its previous parent node
-        if previous_parent_node is not None:
-            previous_parent_node.get_children().remove(node)
-        # We already delete the datapoint from all_node_maps of its previous cluster
-        # in the update_child_labels function
-        # No datapoint in a cluster - remove the cluster from all_node_maps
-        if len(all_node_maps[old_cluster_label]) == 0:
-            del all_node_maps[old_cluster_label]
-
-    labels[data_idx] = new_cluster_label
-    cluster_id = new_cluster_label
-
-    node_map = all_node_maps[cluster_id]
-
-    parent_node = node_map[neighbor_idx]
-
-    new_root_node = parent_node
-    point_density = densities[data_idx]
-    while point_density > new_root_node.get_density():
-        if new_root_node.get_parent() is None:
-            current_root_node = new_root_node
-            new_root_node = None
-            break
-        new_root_node = new_root_node.get_parent()
-
-    new_node = clustering_utils.TreeNode(data_idx, point_density, new_root_node,
-                                         cluster_id)
-    new_node.set_parent(new_root_node)
-
-    if new_root_node is None:
-        new_node.add_child(current_root_node)
-    else:
-        new_root_node.add_child(new_node)
-    node_map[data_idx] = new_node
-
-    return labels, all_node_maps
+def update_child_labels(index, new_label, labels, array_forest):
+    """
+    Update the labels and cluster IDs of the given node and all its descendants.
+    """
+    move_subtree(index, new_label, labels, array_forest)
 
 
+# pylint: disable=R0913
+def cluster_reduction_helper(data_idx, array_forest, old_cluster_label,
+                             new_cluster_label, neighbor_idx, labels, densities,
+                             icd_cache=None, registry=None):
+    """
+    Helper function that moves a node, with its subtree, to another cluster:
+    updates the labels, removes it from its previous parent
+    and links it below its new parent in the tree of neighbor_idx.
+    The registry, if given, must hold labels and array_forest.
+    """
+    previous_parent = int(array_forest.parent[data_idx])
+    if previous_parent != forest.NO_NODE:
+        array_forest.remove_child(previous_parent, data_idx)
+    elif array_forest.roots.get(old_cluster_label) == data_idx:
+        # The whole tree moves and the old cluster is left empty
+        del array_forest.roots[old_cluster_label]
+    moved_indexes = move_subtree(data_idx, new_cluster_label, labels, array_forest)
+    if icd_cache is not None:
+        icd_cache.move_points(moved_indexes, old_cluster_label, new_cluster_label)
+    if registry is not None:
+        registry.move(moved_indexes, old_cluster_label, new_cluster_label)
+
+    array_forest.insert(data_idx, densities[data_idx], new_cluster_label, neighbor_idx)
+    return labels, array_forest
+
+
+# pylint: disable=R0913,R0914
 def process_different_cluster_neighbors(labels, pruned_neighbors_list, all_node_maps,
-                                        densities, debugging=False):
+                                        densities, debugging=False, icd_cache=None,
+                                        dataset=None, beta=None, delta=None, engine=None,
+                                        compatible_fraction=None):
     """
-    Main function that checks if merging is possible or not
+    Main function that checks if merging is possible or not.
+    all_node_maps may be TreeNode maps or an ArrayForest, and is returned as the same type.
+    The ICDs cached in icd_cache follow the points that change clusters.
+    engine is 'points', which moves boundary points one at a time, or
+    'cluster_graph' (see merge_cluster_graph, which takes compatible_fraction).
+    beta, delta, engine and compatible_fraction default to the values in constants.
     Note: For the time being density-criterion is not considered.
           Only distance has been considered
     """
-    print("\nStarting merging of clusters...")
+    beta = constants.BETA if beta is None else beta
+    delta = constants.DELTA if delta is None else delta
+    engine = constants.MERGE_ENGINE if engine is None else engine
+    if engine not in MERGE_ENGINES:
+        raise ValueError(f"Unknown merge engine {engine!r}, expected one of {MERGE_ENGINES}")
+    if engine == 'cluster_graph':
+        return merge_cluster_graph(labels, pruned_neighbors_list, all_node_maps, densities,
+                                   icd_cache, dataset, beta, delta, compatible_fraction)
+    if isinstance(all_node_maps, forest.ArrayForest):
+        array_forest = all_node_maps.copy()
+    else:
+        array_forest = forest.ArrayForest.from_node_maps(all_node_maps, len(labels))
+    registry = ClusterRegistry(labels, array_forest)
+    labels = registry.labels
+    instrumentation.log("\nStarting merging of clusters...")
     different_cluster_neighbors = get_different_cluster_neighbors(labels,
-                                                                  pruned_neighbors_list)
+                                                                  pruned_neighbors_list, dataset)
     if debugging:
-        check_different_cluster_neighbors(labels, pruned_neighbors_list)
+        check_different_cluster_neighbors(labels, pruned_neighbors_list, dataset)
+    instrumentation.count('merge_candidates', len(different_cluster_neighbors))
     for data_idx, neighbor_idx, _, distance_between_points in \
-            different_cluster_neighbors:
+            different_cluster_neighbors.tolist():
         data_label = labels[data_idx]
         new_neighbor_label = labels[neighbor_idx]
 
         if data_label == new_neighbor_label:
             continue
 
-        data_point_cluster_size = sum(1 for label in labels if label == data_label)
-        neighbor_cluster_size = sum(1 for label in labels if label == new_neighbor_label)
+        data_point_cluster_size = registry.size(data_label)
+        neighbor_cluster_size = registry.size(new_neighbor_label)
 
+        # The smaller cluster gives up the point, so the arguments swap roles
+        # pylint: disable=W1114
         if data_point_cluster_size > neighbor_cluster_size:
-            if distance_from_current_parent(neighbor_idx, all_node_maps, new_neighbor_label) < \
+            if distance_from_current_parent(neighbor_idx, array_forest) < \
                     distance_between_points and \
                     satisfies_density_criterion(neighbor_idx, data_idx, densities,
-                                                constants.BETA, constants.DELTA):
-                labels, all_node_maps = cluster_reduction_helper(neighbor_idx, all_node_maps,
-                                                                 new_neighbor_label, data_label,
-                                                                 data_idx, labels, densities)
+                                                beta, delta):
+                labels, array_forest = cluster_reduction_helper(neighbor_idx, array_forest,
+                                                                new_neighbor_label, data_label,
+                                                                data_idx, labels, densities,
+                                                                icd_cache, registry)
+                instrumentation.count('merges_accepted')
 
         else:
-            if distance_from_current_parent(data_idx, all_node_maps, data_label) < \
+            if distance_from_current_parent(data_idx, array_forest) < \
                     distance_between_points and \
                     satisfies_density_criterion(data_idx, neighbor_idx, densities,
-                                                constants.BETA, constants.DELTA):
-                labels, all_node_maps = cluster_reduction_helper(data_idx, all_node_maps,
-                                                                 data_label, new_neighbor_label,
-                                                                 neighbor_idx, labels, densities)
+                                                beta, delta):
+                labels, array_forest = cluster_reduction_helper(data_idx, array_forest,
+                                                                data_label, new_neighbor_label,
+                                                                neighbor_idx, labels, densities,
+                                                                icd_cache, registry)
+                instrumentation.count('merges_accepted')
+
+    new_filtered_labels, array_forest = renumber_labels(labels, array_forest,
+                                                        registry=registry, icd_cache=icd_cache)
+    merged_labels, array_forest = assign_singular_nodes_as_anomalies(array_forest,
+                                                                     new_filtered_labels,
+                                                                     registry)
+    instrumentation.count('clusters', len(set(registry.sizes) - {registry.anomaly_label}))
+    if not isinstance(all_node_maps, forest.ArrayForest):
+        return merged_labels, array_forest.to_node_maps()
+    return merged_labels, array_forest
+
+
+def build_cluster_adjacency(candidates, labels, densities, beta, delta, roots=None):
+    """
+    Aggregates the merge candidates (sorted by distance) into the weighted
+    cluster-adjacency graph: one ADJACENCY_DTYPE row per pair of adjacent
+    clusters, sorted by the distance of their closest boundary edge.
+    The root moves are only filled in when the roots of the clusters are given.
+    """
+    labels = np.asarray(labels)
+    densities = np.asarray(densities)
+    point_labels = labels[candidates['point']]
+    neighbor_labels = candidates['neighbor_label']
+    num_labels = int(max(np.max(point_labels, initial=0), np.max(neighbor_labels, initial=0))) + 1
+    pair_keys = np.minimum(point_labels, neighbor_labels) * num_labels + \
+        np.maximum(point_labels, neighbor_labels)
+    # The candidates are sorted by distance, so the first edge of a pair is its closest
+    _, first, inverse = np.unique(pair_keys, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    compatible = satisfies_density_criterion(candidates['point'], candidates['neighbor'],
+                                             densities, beta, delta)
+
+    adjacency = np.empty(len(first), dtype=ADJACENCY_DTYPE)
+    adjacency['cluster'] = point_labels[first]
+    adjacency['neighbor_cluster'] = neighbor_labels[first]
+    adjacency['edges'] = np.bincount(inverse, minlength=len(first))
+    adjacency['compatible_edges'] = np.bincount(inverse, weights=compatible,
+                                                minlength=len(first))
+    adjacency['min_distance'] = candidates['distance'][first]
+    adjacency['mean_distance'] = np.bincount(inverse, weights=candidates['distance'],
+                                             minlength=len(first)) / adjacency['edges']
+    adjacency['point'] = candidates['point'][first]
+    adjacency['neighbor'] = candidates['neighbor'][first]
+    for prefix in ('root', 'neighbor_root'):
+        adjacency[prefix + '_anchor'] = forest.NO_NODE
+        adjacency[prefix + '_distance'] = np.inf
+    if roots:
+        neighbor_compatible = satisfies_density_criterion(
+            candidates['neighbor'], candidates['point'], densities, beta, delta)
+        add_root_moves(adjacency, candidates, inverse, labels, roots,
+                       (compatible, neighbor_compatible))
+    return adjacency[np.argsort(adjacency['min_distance'], kind='stable')]
+
 
-    new_filtered_labels, all_node_maps = renumber_labels(labels, all_node_maps)
-    return assign_singular_nodes_as_anomalies(all_node_maps, new_filtered_labels)
+# pylint: disable=R0913
+def add_root_moves(adjacency, candidates, pairs, labels, roots, compatible):
+    """
+    Fills the root moves of the adjacency rows (pairs gives the row of every
+    candidate): the closest edge of non-zero length with the root of a
+    cluster at one end, along which the density criterion lets the root
+    move to the cluster at the other end. compatible holds whether the point,
+    and whether the neighbor, of every candidate may move.
+    """
+    is_root = np.zeros(len(labels), dtype=bool)
+    is_root[list(roots.values())] = True
+    positions, movers, anchors = [], [], []
+    for mover, anchor, moves in (('point', 'neighbor', compatible[0]),
+                                 ('neighbor', 'point', compatible[1])):
+        position = np.flatnonzero(is_root[candidates[mover]] & moves &
+                                  (candidates['distance'] > 0))
+        positions.append(position)
+        movers.append(candidates[mover][position])
+        anchors.append(candidates[anchor][position])
+    # The candidates are sorted by distance, so the first move of a root is its closest
+    order = np.argsort(np.concatenate(positions), kind='stable')
+    positions, movers, anchors = [np.concatenate(arrays)[order]
+                                  for arrays in (positions, movers, anchors)]
+    rows = pairs[positions]
+    of_neighbor_cluster = labels[movers] != adjacency['cluster'][rows]
+    _, first = np.unique(rows * 2 + of_neighbor_cluster, return_index=True)
+    for prefix, side in (('root', False), ('neighbor_root', True)):
+        selected = first[of_neighbor_cluster[first] == side]
+        adjacency[prefix + '_anchor'][rows[selected]] = anchors[selected]
+        adjacency[prefix + '_distance'][rows[selected]] = \
+            candidates['distance'][positions[selected]]
+
+
+def find_set(sets, cluster_id):
+    """
+    Returns the representative of the merged set of a cluster, halving the path
+    """
+    while sets[cluster_id] != cluster_id:
+        sets[cluster_id] = sets[sets[cluster_id]]
+        cluster_id = sets[cluster_id]
+    return cluster_id
 
 
-def renumber_labels(new_filtered_labels, all_node_maps, anomaly_label=-1):
+def graft_tree(array_forest, root, anchor, anchor_root):
     """
-    Re-adjusts the label numbers after cluster merging
+    Attaches the tree rooted at root to the tree of anchor (whose root is
+    anchor_root): below the closest ancestor of anchor at least as dense as
+    root, or above anchor_root when root is denser. Returns the root of the
+    grafted tree.
     """
-    unique_labels = sorted(set(new_filtered_labels) - {anomaly_label})
+    if array_forest.attach(root, anchor) == forest.NO_NODE:
+        return root
+    return anchor_root
+
+
+# pylint: disable=R0913,R0914
+def merge_cluster_graph(labels, pruned_neighbors_list, all_node_maps, densities,
+                        icd_cache=None, dataset=None, beta=None, delta=None,
+                        compatible_fraction=None):
+    """
+    Merge engine working on whole clusters. The point engine mostly merges a
+    cluster by moving its root, which takes the whole tree along, so every
+    pair of adjacent clusters in the cluster-adjacency graph (see
+    build_cluster_adjacency) is visited once, by the distance of its closest
+    root move: as in the point engine, the smaller (merged) set of clusters
+    moves when its root is the root of one of the two clusters and the
+    density criterion lets that root move to the other cluster. The merged
+    sets are tracked with union-find and each merge grafts the root of the
+    smaller set next to the point of the root move. The cost grows with the
+    number of cluster pairs rather than with the number of boundary edges.
+    Pairs of clusters with less than compatible_fraction of their boundary
+    edges satisfying the density criterion are never merged.
+    all_node_maps may be TreeNode maps or an ArrayForest, and is returned as the same type.
+    """
+    beta = constants.BETA if beta is None else beta
+    delta = constants.DELTA if delta is None else delta
+    compatible_fraction = constants.MERGE_COMPATIBLE_FRACTION if compatible_fraction is None \
+        else compatible_fraction
+    labels = np.array(labels)
+    if isinstance(all_node_maps, forest.ArrayForest):
+        array_forest = all_node_maps.copy()
+    else:
+        array_forest = forest.ArrayForest.from_node_maps(all_node_maps, len(labels))
+
+    instrumentation.log("\nStarting merging of clusters...")
+    candidates = get_different_cluster_neighbors(labels, pruned_neighbors_list, dataset)
+    adjacency = build_cluster_adjacency(candidates, labels, densities, beta, delta,
+                                        array_forest.roots)
+    instrumentation.count('merge_candidates', len(candidates))
+    instrumentation.count('cluster_pairs', len(adjacency))
+    move_distances = np.minimum(adjacency['root_distance'], adjacency['neighbor_root_distance'])
+    mergeable = (adjacency['compatible_edges'] >= compatible_fraction * adjacency['edges']) & \
+        np.isfinite(move_distances)
+    adjacency = adjacency[mergeable][np.argsort(move_distances[mergeable], kind='stable')]
+
+    sets = list(range(max(int(np.max(labels, initial=0)),
+                          int(np.max(array_forest.cluster_id, initial=0))) + 1))
+    sizes = np.bincount(labels[labels > 0], minlength=len(sets)).tolist()
+    roots = dict(array_forest.roots)
+    cluster_roots = dict(array_forest.roots)
+    members = None
+    if icd_cache is not None:
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(len(sets) + 1))
+        members = {cluster_id: order[bounds[cluster_id]:bounds[cluster_id + 1]].tolist()
+                   for cluster_id in range(1, len(sets))}
+    for cluster_id, neighbor_cluster_id, anchor, neighbor_anchor in zip(
+            adjacency['cluster'].tolist(), adjacency['neighbor_cluster'].tolist(),
+            adjacency['root_anchor'].tolist(), adjacency['neighbor_root_anchor'].tolist()):
+        set_a, set_b = find_set(sets, cluster_id), find_set(sets, neighbor_cluster_id)
+        if set_a == set_b:
+            continue
+        # The smaller set moves, as in the point engine
+        if sizes[set_a] > sizes[set_b]:
+            set_a, set_b, cluster_id, anchor = set_b, set_a, neighbor_cluster_id, neighbor_anchor
+        if anchor == forest.NO_NODE or roots.get(set_a) != cluster_roots[cluster_id]:
+            continue
+        roots[set_b] = graft_tree(array_forest, roots.pop(set_a), anchor, roots[set_b])
+        sets[set_a] = set_b
+        sizes[set_b] += sizes[set_a]
+        if members is not None:
+            icd_cache.move_points(members[set_a], set_a, set_b)
+            members[set_b].extend(members.pop(set_a))
+        instrumentation.count('merges_accepted')
+
+    # Clusters left with a single point are anomalies, as in the point engine
+    for set_id in [set_id for set_id in roots if sizes[set_id] == 1]:
+        labels[roots[set_id]] = -1
+        array_forest.cluster_id[roots.pop(set_id)] = 0
+
+    set_of = np.array([find_set(sets, cluster_id) for cluster_id in range(len(sets))])
+    relabel_merged_sets(labels, array_forest, set_of, roots, icd_cache)
+    instrumentation.count('clusters', len(array_forest.roots))
+    if not isinstance(all_node_maps, forest.ArrayForest):
+        return labels, array_forest.to_node_maps()
+    return labels, array_forest
+
+
+def relabel_merged_sets(labels, array_forest, set_of, roots, icd_cache=None):
+    """
+    Relabels the points and the tree nodes of every cluster with the label of
+    its merged set (set_of[cluster_id]), renumbered to consecutive labels, and
+    keys the roots of the sets by these labels
+    """
+    in_cluster = labels > 0
+    label_mapping = get_label_mapping(set_of[labels[in_cluster]])
+    if icd_cache is not None:
+        icd_cache.relabel(label_mapping)
+    final_labels = np.zeros(len(set_of), dtype=labels.dtype)
+    for set_id, label in label_mapping.items():
+        if set_id > 0:
+            final_labels[set_id] = label
+    final_labels = final_labels[set_of]
+    labels[in_cluster] = final_labels[labels[in_cluster]]
+    in_tree = array_forest.cluster_id > 0
+    array_forest.cluster_id[in_tree] = final_labels[array_forest.cluster_id[in_tree]]
+    array_forest.roots = {label_mapping[set_id]: root for set_id, root in roots.items()
+                          if set_id in label_mapping}
+
+
+def get_label_mapping(labels, anomaly_label=-1):
+    """
+    Returns the mapping from the current cluster labels to consecutive labels
+    """
+    unique_labels = sorted(set(labels) - {anomaly_label})
     label_mapping = {old_label: new_label + 1 for new_label, old_label
                      in enumerate(unique_labels)}
     label_mapping[anomaly_label] = anomaly_label
-    new_filtered_labels = [label_mapping[label] for label in new_filtered_labels]
+    return label_mapping
+
 
-    for old_cluster_id, node_map in all_node_maps.items():
-        if old_cluster_id in label_mapping:
-            new_cluster_id = label_mapping[old_cluster_id]
-            for node in node_map.values():
-                node.cluster_id = new_cluster_id
+def renumber_labels(new_filtered_labels, array_forest, anomaly_label=-1, registry=None,
+                    icd_cache=None):
+    """
+    Re-adjusts the label numbers after cluster merging.
+    With a registry holding the labels and array_forest, both are renumbered in place.
+    """
+    if registry is not None:
+        label_mapping = registry.renumber()
+        if icd_cache is not None:
+            icd_cache.relabel(label_mapping)
+        return registry.labels, registry.array_forest
+
+    label_mapping = get_label_mapping(new_filtered_labels, anomaly_label)
+    if icd_cache is not None:
+        icd_cache.relabel(label_mapping)
+    new_filtered_labels = [label_mapping[label] for label in new_filtered_labels]
 
-    all_node_maps = {label_mapping[old_key]: new_key for old_key, new_key
-                     in all_node_maps.items() if old_key in label_mapping}
+    in_tree = np.flatnonzero(array_forest.cluster_id > 0)
+    array_forest.cluster_id[in_tree] = [label_mapping[cluster_id] for cluster_id
+                                        in array_forest.cluster_id[in_tree].tolist()]
+    array_forest.roots = {label_mapping[cluster_id]: root
+                          for cluster_id, root in array_forest.roots.items()
+                          if cluster_id in label_mapping}
 
-    return new_filtered_labels, all_node_maps
+    return new_filtered_labels, array_forest
 
 
 def satisfies_density_criterion(data_idx, neighbor_idx, densities, beta, delta):
     """
-    Checks if the density criterion is satisfied or not
+    Checks if the density criterion is satisfied or not; the indexes
+    may be arrays, with densities an array, to check many pairs at once
     """
     current_ewma_value = densities[neighbor_idx]
     data_point_density = densities[data_idx]
     ewma_value = clustering_utils.ewma(data_point_density, current_ewma_value, beta)
-    if abs((ewma_value - data_point_density) / ewma_value) <= delta:
-        return True
-    return False
+    return np.abs((ewma_value - data_point_density) / ewma_value) <= delta
 
 
-def distance_from_current_parent(data_idx, all_node_maps, current_data_label):
+def distance_from_current_parent(data_idx, array_forest):
     """
     Returns the distance between data point and its current parent
     """
-    current_node = all_node_maps[current_data_label][data_idx]
-    current_parent_node = current_node.get_parent()
-    if current_parent_node is not None:
-        return pruning_utils.calculate_distance(data_idx, current_parent_node.get_index())
+    current_parent = array_forest.parent[data_idx]
+    if current_parent != forest.NO_NODE:
+        return pruning_utils.calculate_distance(data_idx, current_parent)
     return 0
 
 
-def assign_singular_nodes_as_anomalies(all_node_maps, labels):
+def assign_singular_nodes_as_anomalies(array_forest, labels, registry=None):
     """
     Re-assigns singular nodes points as anomalies
     """
-    for _, node_map in all_node_maps.items():
-        if len(node_map) == 1:
-            data_idx = next(iter(node_map))
-            labels[data_idx] = -1
-            node_map[data_idx].cluster_id = -1
-    return labels, all_node_maps
+    cluster_sizes = array_forest.cluster_sizes()
+    for cluster_id in [cluster_id for cluster_id in array_forest.roots
+                       if cluster_sizes[cluster_id] == 1]:
+        data_idx = array_forest.remove_root(cluster_id)
+        if registry is not None:
+            registry.mark_anomaly(data_idx, cluster_id)
+        labels[data_idx] = -1
+    return labels, array_forest
@@ -0,0 +1,161 @@
+"""
+Contains the CSR representation of the pruned neighborhoods
+"""
+
+import numpy as np
+
+
+def index_dtype(num_points):
+    """
+    Returns the smallest integer dtype that holds the indexes of num_points points
+    """
+    return np.int32 if num_points <= np.iinfo(np.int32).max else np.int64
+
+
+def lengths_to_indptr(lengths):
+    """
+    Returns the row offsets of rows with the given lengths
+    """
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    return indptr
+
+
+class CSRRows:
+    """
+    Stores variable-length rows as one flat array of values and the offsets
+    of the rows in it, so that row i is values[indptr[i]:indptr[i + 1]].
+    Indexing and iterating return views, as the rows of a list of arrays.
+    """
+
+    def __init__(self, indptr, values):
+        self.indptr = np.asarray(indptr)
+        self.values = np.asarray(values)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, index):
+        return self.values[self.indptr[index]:self.indptr[index + 1]]
+
+    def __iter__(self):
+        bounds = self.indptr.tolist()
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield self.values[start:end]
+
+    @property
+    def nbytes(self):
+        """
+        Returns the memory used by the arrays
+        """
+        return self.indptr.nbytes + self.values.nbytes
+
+    def lengths(self):
+        """
+        Returns the length of every row
+        """
+        return np.diff(self.indptr)
+
+
+class NeighborGraph(CSRRows):
+    """
+    Stores the pruned neighborhoods of all points as a directed CSR graph:
+    the neighbors of point i, in pruning order, are indices[indptr[i]:indptr[i + 1]],
+    in the smallest integer dtype that holds the point indexes. The distances
+    to the neighbors, when known, are the rows of distances, which shares indptr.
+
+    Indexing and iterating the graph return the neighbor rows, so it stands in
+    for the list of neighbor arrays; edges() and reverse() give vectorized views.
+    """
+
+    def __init__(self, indptr, indices, distances=None):
+        super().__init__(indptr, indices)
+        self.distances = None if distances is None else CSRRows(self.indptr, distances)
+
+    @property
+    def indices(self):
+        """
+        Returns the neighbor indexes of all points, row after row
+        """
+        return self.values
+
+    @property
+    def nbytes(self):
+        """
+        Returns the memory used by the arrays, distances included
+        """
+        return super().nbytes + (0 if self.distances is None else self.distances.values.nbytes)
+
+    @classmethod
+    def from_rows(cls, neighbor_rows, distance_rows=None):
+        """
+        Builds the graph from a list of neighbor arrays and, optionally,
+        the list of the distances to them
+        """
+        neighbor_rows = list(neighbor_rows)
+        lengths = np.fromiter((len(row) for row in neighbor_rows), dtype=np.int64,
+                              count=len(neighbor_rows))
+        dtype = index_dtype(len(neighbor_rows))
+        indices = np.concatenate(neighbor_rows).astype(dtype) if neighbor_rows \
+            else np.empty(0, dtype=dtype)
+        distances = None
+        if distance_rows is not None:
+            distance_rows = list(distance_rows)
+            distances = np.concatenate(distance_rows) if distance_rows else np.empty(0)
+        return cls(lengths_to_indptr(lengths), indices, distances)
+
+    @classmethod
+    def from_sorted(cls, sorted_neighbors, sorted_distances, lengths):
+        """
+        Builds the graph from (n, k) neighbors and distances sorted in pruning
+        order, keeping the first lengths[i] of row i
+        """
+        lengths = np.asarray(lengths)
+        keep = np.arange(np.shape(sorted_neighbors)[1]) < lengths[:, np.newaxis]
+        indices = np.asarray(sorted_neighbors)[keep].astype(index_dtype(len(lengths)))
+        distances = None if sorted_distances is None else np.asarray(sorted_distances)[keep]
+        return cls(lengths_to_indptr(lengths), indices, distances)
+
+    @classmethod
+    def concatenate(cls, graphs):
+        """
+        Stacks the rows of graphs built over consecutive blocks of points
+        """
+        graphs = list(graphs)
+        lengths = np.concatenate([graph.lengths() for graph in graphs])
+        indices = np.concatenate([graph.indices for graph in graphs]).astype(
+            index_dtype(len(lengths)))
+        distances = None
+        if all(graph.distances is not None for graph in graphs):
+            distances = np.concatenate([graph.distances.values for graph in graphs])
+        return cls(lengths_to_indptr(lengths), indices, distances)
+
+    def degrees(self):
+        """
+        Returns the number of neighbors of every point
+        """
+        return self.lengths()
+
+    def sources(self):
+        """
+        Returns the point each entry of indices is a neighbor of
+        """
+        return np.repeat(np.arange(len(self), dtype=self.indices.dtype), self.degrees())
+
+    def edges(self):
+        """
+        Returns the graph as an edge list (sources, targets, distances),
+        in row order; distances is None when they are not known
+        """
+        distances = None if self.distances is None else self.distances.values
+        return self.sources(), self.indices, distances
+
+    def reverse(self):
+        """
+        Returns the graph with every edge reversed: row i lists the points
+        that have i as a neighbor, in increasing order
+        """
+        order = np.argsort(self.indices, kind='stable')
+        indptr = lengths_to_indptr(np.bincount(self.indices, minlength=len(self)))
+        distances = None if self.distances is None else self.distances.values[order]
+        return NeighborGraph(indptr, self.sources()[order], distances)
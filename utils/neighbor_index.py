@@ -0,0 +1,792 @@
+"""
+Contains the nearest-neighbor indexes: the incremental indexes used by the
+streaming mode and the backends of the batch kNN search
+"""
+
+from abc import ABC, abstractmethod
+from itertools import product
+import numpy as np
+from scipy.spatial import cKDTree
+from sklearn.neighbors import NearestNeighbors
+
+# Query and indexed points compared at once by the brute-force backend.
+# Bounds the temporary (queries, points) distance tiles.
+BRUTE_FORCE_QUERY_BLOCK_SIZE = 512
+BRUTE_FORCE_POINT_BLOCK_SIZE = 16384
+# Points whose candidate neighbors are evaluated together by NN-descent
+NN_DESCENT_BLOCK_SIZE = 4096
+
+
+# pylint: disable=R0903
+class IndexBlock:
+    """
+    A static KD-tree over a set of indexed points. Removed points are
+    only marked as dead until the block is rebuilt.
+    """
+
+    def __init__(self, ids, points):
+        """
+        Builds the tree over the given points and their ids
+        """
+        self.ids = ids
+        self.tree = cKDTree(points)
+        self.alive = np.ones(len(ids), dtype=bool)
+        self.num_dead = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+
+# pylint: disable=R0902
+class IncrementalNeighborIndex:
+    """
+    Nearest-neighbor index that supports inserting and removing points.
+
+    Inserted points are collected in a small buffer that is searched by
+    brute force. A full buffer becomes a static KD-tree block, and blocks of
+    similar size are merged into one (the logarithmic method). Only
+    O(log n) blocks exist at any time, so inserts cost amortized
+    O(log^2 n) and queries stay logarithmic in the number of points.
+    The blocks use scipy's cKDTree, whose single-point queries avoid the
+    input validation overhead of the sklearn trees.
+
+    Removed points are marked dead in their block, and a block is rebuilt
+    from its live points once half of them are dead. The ids of removed
+    points are handed out again by later inserts.
+    """
+
+    def __init__(self, dimension, buffer_size=256):
+        """
+        Initializes an empty index for points of the given dimension
+        """
+        self.buffer_size = buffer_size
+        self.points = np.empty((max(buffer_size, 16), dimension))
+        self.block_of = np.full(len(self.points), -1)
+        self.position_in_block = np.zeros(len(self.points), dtype=np.intp)
+        self.blocks = {}
+        self.next_block_key = 0
+        self.buffer = []
+        self.free_ids = []
+        self.high_water = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, required):
+        """
+        Grows the point storage so that it can hold the required number of ids
+        """
+        if required <= len(self.points):
+            return
+        capacity = max(required, 2 * len(self.points))
+        points = np.empty((capacity, self.points.shape[1]))
+        points[:len(self.points)] = self.points
+        self.points = points
+        self.block_of = np.concatenate((self.block_of,
+                                        np.full(capacity - len(self.block_of), -1)))
+        self.position_in_block = np.concatenate(
+            (self.position_in_block,
+             np.zeros(capacity - len(self.position_in_block), dtype=np.intp)))
+
+    def _store_block(self, ids):
+        """
+        Builds a block over the given ids and records where each id lives
+        """
+        key = self.next_block_key
+        self.next_block_key += 1
+        self.blocks[key] = IndexBlock(ids, self.points[ids])
+        self.block_of[ids] = key
+        self.position_in_block[ids] = np.arange(len(ids))
+
+    def _flush_buffer(self):
+        """
+        Turns the buffer into a tree block and merges blocks of similar size
+        """
+        ids = [np.array(self.buffer, dtype=np.intp)]
+        num_ids = len(self.buffer)
+        # Blocks are kept in creation order, which is roughly decreasing size
+        while self.blocks:
+            key = next(reversed(self.blocks))
+            last = self.blocks[key]
+            live = len(last) - last.num_dead
+            if live > num_ids:
+                break
+            del self.blocks[key]
+            ids.append(last.ids[last.alive])
+            num_ids += live
+        self.buffer = []
+        self._store_block(np.concatenate(ids))
+
+    def add(self, points):
+        """
+        Adds a (m, d) block of points and returns their ids
+        """
+        points = np.atleast_2d(points)
+        if len(points) >= self.buffer_size and not self.free_ids:
+            # Bulk loads go straight into a tree block
+            ids = np.arange(self.high_water, self.high_water + len(points))
+            self.high_water += len(points)
+            self._reserve(self.high_water)
+            self.points[ids] = points
+            self.buffer.extend(ids.tolist())
+            self.size += len(points)
+            self._flush_buffer()
+            return ids
+
+        ids = []
+        for point in points:
+            if self.free_ids:
+                point_id = self.free_ids.pop()
+            else:
+                point_id = self.high_water
+                self.high_water += 1
+                self._reserve(self.high_water)
+            self.points[point_id] = point
+            self.block_of[point_id] = -1
+            self.buffer.append(point_id)
+            ids.append(point_id)
+            if len(self.buffer) >= self.buffer_size:
+                self._flush_buffer()
+        self.size += len(points)
+        return np.array(ids, dtype=np.intp)
+
+    def remove(self, point_id):
+        """
+        Removes a point from the index; its id may be reused by later inserts
+        """
+        key = self.block_of[point_id]
+        if key == -1:
+            self.buffer.remove(point_id)
+        else:
+            block = self.blocks[key]
+            block.alive[self.position_in_block[point_id]] = False
+            block.num_dead += 1
+            if 2 * block.num_dead >= len(block):
+                del self.blocks[key]
+                if block.num_dead < len(block):
+                    self._store_block(block.ids[block.alive])
+                    self.blocks = dict(sorted(self.blocks.items(),
+                                              key=lambda item: item[1].num_dead - len(item[1])))
+        self.block_of[point_id] = -1
+        self.free_ids.append(point_id)
+        self.size -= 1
+
+    @staticmethod
+    def _query_block(block, points, k):
+        """
+        Queries a block for the k nearest live points of each query point,
+        asking for more neighbors while dead points hide live ones
+        """
+        num_live = len(block) - block.num_dead
+        wanted = min(k, num_live)
+        num_queried = min(k + min(k, block.num_dead), len(block))
+        while True:
+            distances, positions = block.tree.query(points, k=num_queried)
+            distances = distances.reshape(len(points), -1)
+            positions = positions.reshape(len(points), -1)
+            if block.num_dead == 0:
+                return distances, block.ids[positions]
+            live = block.alive[positions]
+            if num_queried == len(block) or np.all(np.sum(live, axis=1) >= wanted):
+                break
+            num_queried = min(2 * num_queried, len(block))
+        # Dead points are moved past the live ones by giving them infinite distance
+        return np.where(live, distances, np.inf), block.ids[positions]
+
+    def query(self, points, k):
+        """
+        Returns the distances to and the ids of the k nearest indexed
+        points for each of the (m, d) query points, sorted by distance.
+        Fewer than k columns are returned if the index holds fewer points.
+        """
+        points = np.atleast_2d(points)
+        all_distances = []
+        all_ids = []
+        for block in self.blocks.values():
+            distances, ids = self._query_block(block, points, k)
+            all_distances.append(distances)
+            all_ids.append(ids)
+
+        if self.buffer:
+            buffer_ids = np.array(self.buffer, dtype=np.intp)
+            distances = np.linalg.norm(points[:, np.newaxis, :] -
+                                       self.points[buffer_ids][np.newaxis, :, :], axis=-1)
+            all_distances.append(distances)
+            all_ids.append(np.broadcast_to(buffer_ids, distances.shape))
+
+        k = min(k, self.size)
+        if not all_distances or k == 0:
+            return np.empty((len(points), 0)), np.empty((len(points), 0), dtype=np.intp)
+
+        distances = np.hstack(all_distances)
+        ids = np.hstack(all_ids)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return (np.take_along_axis(distances, order, axis=1),
+                np.take_along_axis(ids, order, axis=1))
+
+
+# Levels of the balls of ReachIndex that are not stored in cells, below any
+# level of a positive float radius
+UNBOUNDED = -2 ** 20
+EMPTY = UNBOUNDED + 1
+
+
+class ReachIndex:
+    """
+    Index of balls, one per point id, that finds the balls containing a
+    query point. The streaming mode gives every point a ball as wide as the
+    distance to its k-th neighbor, so the balls containing a new point are
+    those of the points whose kNN lists it enters.
+
+    Balls are grouped by radius into levels of powers of two, and each level
+    is a grid of cells twice as wide as its largest radius. A ball is stored
+    in the cells it overlaps, at most two per dimension, so a query reads one
+    cell per level and only meets the balls of nearby points. A ball only
+    moves between cells when its radius changes enough. Balls of infinite
+    radius contain every point and balls of zero radius none.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty index
+        """
+        self.cells = {}
+        # For each id: (level, lowest cell, highest cell) of a bounded ball,
+        # (UNBOUNDED,) or (EMPTY,)
+        self.balls = {}
+        self.unbounded = set()
+        self.level_sizes = {}
+        self.levels = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.balls)
+
+    def update(self, ids, centers, radii):
+        """
+        Stores the balls of the given ids, replacing their previous balls
+        """
+        centers = np.atleast_2d(centers)
+        radii = np.asarray(radii, dtype=float)
+        bounded = np.isfinite(radii) & (radii > 0)
+        # The radius of a ball is at most 2^level
+        levels = np.frexp(np.where(bounded, radii, 1))[1].astype(np.int64)
+        widths = np.ldexp(1.0, levels + 1)[:, np.newaxis]
+        offsets = np.where(bounded, radii, 0)[:, np.newaxis]
+        balls = np.column_stack((np.where(bounded, levels, np.where(np.isposinf(radii),
+                                                                    UNBOUNDED, EMPTY)),
+                                 np.floor((centers - offsets) / widths),
+                                 np.floor((centers + offsets) / widths))).astype(np.int64)
+        for point_id, ball in zip(np.asarray(ids).tolist(), balls.tolist()):
+            ball = tuple(ball) if ball[0] > EMPTY else (ball[0],)
+            if self.balls.get(point_id) == ball:
+                continue
+            self._unlink(point_id)
+            self.balls[point_id] = ball
+            if ball[0] == UNBOUNDED:
+                self.unbounded.add(point_id)
+            elif ball[0] != EMPTY:
+                for key in self._cell_keys(ball):
+                    self.cells.setdefault(key, set()).add(point_id)
+                self._count_level(ball[0], 1)
+
+    def remove(self, ids):
+        """
+        Removes the balls of the given ids
+        """
+        for point_id in np.asarray(ids).tolist():
+            self._unlink(point_id)
+            self.balls.pop(point_id, None)
+
+    @staticmethod
+    def _cell_keys(ball):
+        """
+        Returns the keys of the cells a bounded ball overlaps
+        """
+        level, dimensions = ball[0], (len(ball) - 1) // 2
+        return [(level,) + cell for cell in
+                product(*(range(low, high + 1) for low, high
+                          in zip(ball[1:dimensions + 1], ball[dimensions + 1:])))]
+
+    def _unlink(self, point_id):
+        """
+        Takes the ball of an id out of its cells
+        """
+        ball = self.balls.get(point_id, (EMPTY,))
+        if ball[0] == UNBOUNDED:
+            self.unbounded.discard(point_id)
+        elif ball[0] != EMPTY:
+            for key in self._cell_keys(ball):
+                cell = self.cells[key]
+                cell.discard(point_id)
+                if not cell:
+                    del self.cells[key]
+            self._count_level(ball[0], -1)
+
+    def _count_level(self, level, change):
+        """
+        Counts the balls of a level, keeping the array of non-empty levels
+        """
+        size = self.level_sizes.get(level, 0) + change
+        if size:
+            self.level_sizes[level] = size
+        else:
+            del self.level_sizes[level]
+        if size in (0, change):
+            self.levels = np.array(sorted(self.level_sizes), dtype=np.int64)
+
+    def query(self, point):
+        """
+        Returns the ids of the balls that may contain the point: a superset
+        of those that do, which the caller narrows down with the distances
+        """
+        found = set(self.unbounded)
+        cells = np.floor(point / np.ldexp(1.0, self.levels + 1)[:, np.newaxis]).astype(np.int64)
+        for level, cell in zip(self.levels.tolist(), cells.tolist()):
+            members = self.cells.get((level,) + tuple(cell))
+            if members:
+                found |= members
+        return np.fromiter(found, dtype=np.intp, count=len(found))
+
+
+class NeighborIndex(ABC):
+    """
+    Base class of the batch kNN backends. A backend is built over a set of
+    points, answers batches of k-nearest-neighbor queries, and grows with
+    add(). Indexed points get consecutive ids in insertion order.
+    Subclasses implement query().
+    """
+    exact = True
+
+    def __init__(self):
+        """
+        Initializes an empty index
+        """
+        self.points = None
+
+    def __len__(self):
+        return 0 if self.points is None else len(self.points)
+
+    def build(self, points):
+        """
+        Indexes the (n, d) points and returns the index
+        """
+        self.points = np.array(points, dtype=float)
+        return self
+
+    def add(self, points):
+        """
+        Adds a (m, d) block of points and returns their ids
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        ids = np.arange(len(self), len(self) + len(points))
+        self.points = points.copy() if self.points is None else np.vstack((self.points, points))
+        return ids
+
+    @abstractmethod
+    def query(self, points, k):
+        """
+        Returns the distances to and the ids of the k nearest indexed
+        points for each of the (m, d) query points, sorted by distance
+        """
+
+    def self_neighbors(self, k):
+        """
+        Returns the distances to and the ids of the k nearest indexed points
+        of every indexed point, the point itself included
+        """
+        return self.query(self.points, k)
+
+
+class BruteForceIndex(NeighborIndex):
+    """
+    Exact backend comparing every query with every indexed point. Squared
+    distances are computed tile by tile as |q|^2 - 2 q.p + |p|^2, so the work
+    is done by matrix products, and the distances of the selected neighbors
+    are then recomputed exactly. Unlike the trees, it does not degrade with
+    the dimension.
+    """
+
+    def __init__(self, query_block_size=BRUTE_FORCE_QUERY_BLOCK_SIZE,
+                 point_block_size=BRUTE_FORCE_POINT_BLOCK_SIZE):
+        """
+        Initializes an empty index
+        """
+        super().__init__()
+        self.query_block_size = query_block_size
+        self.point_block_size = point_block_size
+
+    def query(self, points, k):
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        k = min(k, len(self))
+        all_distances = np.empty((len(points), k))
+        all_ids = np.empty((len(points), k), dtype=np.intp)
+        squared_norms = np.einsum('ij,ij->i', self.points, self.points)
+        for start in range(0, len(points), self.query_block_size):
+            queries = points[start:start + self.query_block_size]
+            best_scores = np.empty((len(queries), 0))
+            best_ids = np.empty((len(queries), 0), dtype=np.intp)
+            for point_start in range(0, len(self), self.point_block_size):
+                tile = slice(point_start, point_start + self.point_block_size)
+                # |q|^2 is the same for the whole row, so it does not change the ranking
+                scores = queries @ self.points[tile].T
+                scores *= -2
+                scores += squared_norms[tile]
+                ids = np.arange(point_start, point_start + scores.shape[1])
+                if scores.shape[1] > k:
+                    keep = np.argpartition(scores, k - 1, axis=1)[:, :k]
+                    scores = np.take_along_axis(scores, keep, axis=1)
+                    ids = ids[keep]
+                else:
+                    ids = np.broadcast_to(ids, scores.shape)
+                best_scores = np.hstack((best_scores, scores))
+                best_ids = np.hstack((best_ids, ids))
+                if best_scores.shape[1] > k:
+                    keep = np.argpartition(best_scores, k - 1, axis=1)[:, :k]
+                    best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                    best_ids = np.take_along_axis(best_ids, keep, axis=1)
+            distances = np.linalg.norm(self.points[best_ids] - queries[:, np.newaxis], axis=-1)
+            order = np.argsort(distances, axis=1, kind='stable')
+            all_distances[start:start + len(queries)] = np.take_along_axis(distances, order, 1)
+            all_ids[start:start + len(queries)] = np.take_along_axis(best_ids, order, 1)
+        return all_distances, all_ids
+
+
+class TreeIndex(NeighborIndex):
+    """
+    Exact backend over a sklearn ball tree or KD-tree. The tree covers the
+    points given to build(); added points go to an IncrementalNeighborIndex,
+    whose blocks are merged by the logarithmic method, so add() never
+    rebuilds the whole tree. Queries merge the neighbors found in both.
+    """
+
+    def __init__(self, algorithm='ball_tree', n_jobs=None):
+        """
+        Initializes an empty index using the given sklearn algorithm
+        """
+        super().__init__()
+        self.algorithm = algorithm
+        self.n_jobs = n_jobs
+        self.model = None
+        self.num_built = 0
+        self.added = None
+
+    def build(self, points):
+        super().build(points)
+        self.model = NearestNeighbors(algorithm=self.algorithm, n_jobs=self.n_jobs).fit(
+            self.points)
+        self.num_built = len(self.points)
+        self.added = None
+        return self
+
+    def add(self, points):
+        if self.model is None:
+            first_id = len(self)
+            self.build(np.atleast_2d(points))
+            return np.arange(first_id, len(self))
+        ids = super().add(points)
+        if self.added is None:
+            self.added = IncrementalNeighborIndex(self.points.shape[1])
+        # The incremental index hands out consecutive ids from 0 as nothing is removed
+        self.added.add(self.points[ids])
+        return ids
+
+    def query(self, points, k):
+        points = np.atleast_2d(points)
+        distances, ids = self.model.kneighbors(points, n_neighbors=min(k, self.num_built))
+        if self.added is None:
+            return distances, ids
+        added_distances, added_ids = self.added.query(points, k)
+        distances = np.hstack((distances, added_distances))
+        ids = np.hstack((ids, added_ids + self.num_built))
+        order = np.argsort(distances, axis=1, kind='stable')[:, :min(k, len(self))]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+# pylint: disable=R0902
+class NNDescentIndex(NeighborIndex):
+    """
+    Approximate backend holding a kNN graph of the indexed points, built with
+    NN-descent: starting from the points sharing its leaves in a few random
+    projection trees, each point repeatedly takes
+    the closest of its neighbors' neighbors (forward and reverse, sampled)
+    until almost no neighborhood improves. Queries walk the graph with a
+    beam search from random entry points, and added points are linked into
+    the graph the same way. Its recall is estimated by neighbor_recall().
+    """
+    exact = False
+
+    # pylint: disable=R0913
+    def __init__(self, n_neighbors, num_trees=4, sample_size=6, max_iterations=12,
+                 tolerance=0.001, search_width=32, seed=90):
+        """
+        Initializes an empty index whose graph links every point to its
+        n_neighbors nearest other points
+        """
+        super().__init__()
+        self.n_neighbors = n_neighbors
+        self.num_trees = num_trees
+        self.sample_size = sample_size
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.search_width = search_width
+        self.random_state = np.random.default_rng(seed)
+        self.graph = None
+        self.graph_distances = None
+
+    # pylint: disable=R0913,R0914
+    def _select(self, rows, ids, distances, width, flags=None, points=None):
+        """
+        Keeps the width closest distinct ids of each row, sorted by distance.
+        Missing ids (-1) and the row itself are never kept. NaN distances are
+        computed from the query points (the indexed points of rows by
+        default), once per distinct id. Boolean flags given for the (m, c)
+        ids are returned for the kept ids as well.
+        """
+        points = self.points[rows] if points is None else points
+        positions = np.argsort(ids, axis=1, kind='stable')
+        sorted_ids = np.take_along_axis(ids, positions, axis=1)
+        sorted_distances = np.take_along_axis(distances, positions, axis=1)
+        duplicate = np.zeros(ids.shape, dtype=bool)
+        duplicate[:, 1:] = sorted_ids[:, 1:] == sorted_ids[:, :-1]
+        invalid = duplicate | (sorted_ids < 0) | (sorted_ids == rows[:, np.newaxis])
+        pending_rows, pending_columns = np.nonzero(np.isnan(sorted_distances) & ~invalid)
+        sorted_distances[pending_rows, pending_columns] = np.linalg.norm(
+            self.points[sorted_ids[pending_rows, pending_columns]] - points[pending_rows], axis=1)
+        sorted_distances[invalid] = np.inf
+        if ids.shape[1] > width:
+            keep = np.argpartition(sorted_distances, width - 1, axis=1)[:, :width]
+            positions = np.take_along_axis(positions, keep, axis=1)
+            sorted_distances = np.take_along_axis(sorted_distances, keep, axis=1)
+        order = np.argsort(sorted_distances, axis=1, kind='stable')
+        positions = np.take_along_axis(positions, order, axis=1)
+        selected_distances = np.take_along_axis(sorted_distances, order, axis=1)
+        missing = np.isinf(selected_distances)
+        selected_ids = np.where(missing, -1, np.take_along_axis(ids, positions, axis=1))
+        if flags is None:
+            return selected_ids, selected_distances
+        return selected_ids, selected_distances, \
+            np.take_along_axis(flags, positions, axis=1) & ~missing
+
+    def _merge(self, rows, candidates, width, flags=None, points=None):
+        """
+        Returns the width closest of the current neighbors of rows and of the
+        (m, c) candidate ids; flags mark the current neighbors
+        """
+        ids = np.hstack((self.graph[rows], candidates))
+        distances = np.hstack((self.graph_distances[rows], np.full(candidates.shape, np.nan)))
+        if flags is not None:
+            flags = np.hstack((flags, np.zeros(candidates.shape, dtype=bool)))
+        return self._select(rows, ids, distances, width, flags, points)
+
+    def _group(self, sources, targets, width):
+        """
+        Returns a (n, width) table listing, for every indexed point, up to
+        width of the sources pointing to it (in random order), padded with -1
+        """
+        order = self.random_state.permutation(len(sources))
+        sources, targets = sources[order], targets[order]
+        order = np.argsort(targets, kind='stable')
+        sources, targets = sources[order], targets[order]
+        rank = np.arange(len(targets)) - np.searchsorted(targets, targets)
+        keep = rank < width
+        table = np.full((len(self), width), -1, dtype=np.intp)
+        table[targets[keep], rank[keep]] = sources[keep]
+        return table
+
+    def _candidates(self, is_new):
+        """
+        Returns the candidate neighbors of every point: the sampled forward and
+        reverse neighbors of its neighbors, where at least one of the two links
+        is new since the last iteration (the pairs seen before are skipped),
+        along with the flags of the sampled new neighbors, which become old
+        """
+        num_points, degree = self.graph.shape
+        sample_size = min(self.sample_size, degree)
+        rows = np.repeat(np.arange(num_points), sample_size)
+        # New neighbors are sampled first, old ones fill the remaining slots
+        keys = self.random_state.random((num_points, degree)) + ~is_new
+        columns = np.argpartition(keys, sample_size - 1, axis=1)[:, :sample_size]
+        sampled = np.take_along_axis(self.graph, columns, axis=1)
+        sampled_new = np.take_along_axis(is_new, columns, axis=1) & (sampled >= 0)
+        sampled_old = ~sampled_new & (sampled >= 0)
+        new = np.where(sampled_new, sampled, -1)
+        old = np.where(sampled_old, sampled, -1)
+        new = np.hstack((new, self._group(rows[sampled_new.ravel()], sampled[sampled_new],
+                                          sample_size)))
+        old = np.hstack((old, self._group(rows[sampled_old.ravel()], sampled[sampled_old],
+                                          sample_size)))
+        every = np.hstack((new, old))
+
+        def neighbors_of(first, second):
+            nested = second[np.maximum(first, 0)]
+            nested[first < 0] = -1
+            return nested.reshape(num_points, -1)
+
+        candidates = np.hstack((new, neighbors_of(new, every), neighbors_of(every, new)))
+        np.put_along_axis(is_new, columns, False, axis=1)
+        return candidates
+
+    def _random_projection_leaves(self, leaf_size):
+        """
+        Splits the indexed points by random hyperplanes, each halfway between
+        two random points of a leaf, until no leaf holds more than leaf_size
+        points. Returns the (num_leaves, leaf_size) table of the members of
+        each leaf padded with -1, and the leaf of every point.
+        """
+        num_points = len(self)
+        leaf_of = np.zeros(num_points, dtype=np.intp)
+        while True:
+            sizes = np.bincount(leaf_of)
+            splitting = sizes[leaf_of] > leaf_size
+            if not np.any(splitting):
+                break
+            # Two random members of every leaf define its hyperplane
+            order = self.random_state.permutation(num_points)
+            order = order[np.argsort(leaf_of[order], kind='stable')]
+            first = np.searchsorted(leaf_of[order], np.arange(len(sizes)))
+            first_points = self.points[order[first]]
+            second_points = self.points[order[np.minimum(first + 1, num_points - 1)]]
+            normals = first_points - second_points
+            offsets = np.einsum('ij,ij->i', normals, (first_points + second_points) / 2)
+            projections = np.einsum('ij,ij->i', self.points, normals[leaf_of]) - offsets[leaf_of]
+            # Points on the hyperplane (duplicates) are sent to a random side
+            sides = np.where(projections == 0, self.random_state.random(num_points) < 0.5,
+                             projections > 0)
+            _, leaf_of = np.unique(2 * leaf_of + (sides & splitting), return_inverse=True)
+            leaf_of = leaf_of.ravel()
+        order = np.argsort(leaf_of, kind='stable')
+        first = np.searchsorted(leaf_of[order], leaf_of[order])
+        table = np.full((leaf_of.max() + 1, leaf_size), -1, dtype=np.intp)
+        table[leaf_of[order], np.arange(num_points) - first] = order
+        return table, leaf_of
+
+    def build(self, points):
+        super().build(points)
+        num_points = len(self.points)
+        degree = min(self.n_neighbors, num_points - 1)
+        rows = np.arange(num_points)
+        self.graph = np.full((num_points, degree), -1, dtype=np.intp)
+        self.graph_distances = np.full((num_points, degree), np.inf)
+        # Points in the same leaf of random projection trees are close, which
+        # gives a good initial graph
+        for _ in range(self.num_trees):
+            table, leaf_of = self._random_projection_leaves(max(2 * degree, 16))
+            for start in range(0, num_points, NN_DESCENT_BLOCK_SIZE):
+                block = rows[start:start + NN_DESCENT_BLOCK_SIZE]
+                self.graph[block], self.graph_distances[block] = self._merge(
+                    block, table[leaf_of[block]], degree)
+
+        is_new = self.graph >= 0
+        for _ in range(self.max_iterations):
+            candidates = self._candidates(is_new)
+            num_updated = 0
+            for start in range(0, num_points, NN_DESCENT_BLOCK_SIZE):
+                block = rows[start:start + NN_DESCENT_BLOCK_SIZE]
+                ids, distances, was_old = self._merge(block, candidates[block], degree,
+                                                      ~is_new[block])
+                num_updated += np.sum(distances < self.graph_distances[block])
+                self.graph[block], self.graph_distances[block] = ids, distances
+                is_new[block] = ~was_old & (ids >= 0)
+            if num_updated <= self.tolerance * num_points * degree:
+                break
+        return self
+
+    def _search(self, points, width):
+        """
+        Beam search of the graph: returns the ids of and the distances to the
+        width closest indexed points found for each query point
+        """
+        rows = np.full(len(points), -1)
+        entries = self.random_state.integers(0, len(self), (len(points), width))
+        ids, distances = self._select(rows, entries, np.full(entries.shape, np.nan),
+                                      width, points=points)
+        expanded = np.zeros(ids.shape, dtype=bool)
+        while True:
+            # Expand the closest unexpanded entry of every beam
+            pending = ~expanded & (ids >= 0)
+            active = np.flatnonzero(np.any(pending, axis=1))
+            if len(active) == 0:
+                break
+            position = np.argmax(pending[active], axis=1)
+            expanded[active, position] = True
+            neighbors = self.graph[ids[active, position]]
+            # Entries that stay in the beam keep their expanded flag; the beam
+            # entries come first, so a duplicate neighbor never hides it
+            ids[active], distances[active], expanded[active] = self._select(
+                rows[active], np.hstack((ids[active], neighbors)),
+                np.hstack((distances[active], np.full(neighbors.shape, np.nan))), width,
+                np.hstack((expanded[active], np.zeros(neighbors.shape, dtype=bool))),
+                points[active])
+        return ids, distances
+
+    def query(self, points, k):
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        k = min(k, len(self))
+        all_distances = np.empty((len(points), k))
+        all_ids = np.empty((len(points), k), dtype=np.intp)
+        for start in range(0, len(points), NN_DESCENT_BLOCK_SIZE):
+            block = slice(start, start + NN_DESCENT_BLOCK_SIZE)
+            ids, distances = self._search(points[block], max(k, self.search_width))
+            all_ids[block], all_distances[block] = ids[:, :k], distances[:, :k]
+        return all_distances, all_ids
+
+    def self_neighbors(self, k):
+        if k - 1 > self.graph.shape[1]:
+            return self.query(self.points, k)
+        rows = np.arange(len(self))
+        return (np.hstack((np.zeros((len(self), 1)), self.graph_distances[:, :k - 1])),
+                np.hstack((rows[:, np.newaxis], self.graph[:, :k - 1])))
+
+    def add(self, points):
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if self.graph is None or len(points) >= len(self):
+            all_points = points if self.points is None else np.vstack((self.points, points))
+            first_id = len(self)
+            self.build(all_points)
+            return np.arange(first_id, len(self))
+
+        degree = self.graph.shape[1]
+        distances, ids = self.query(points, degree)
+        new_ids = super().add(points)
+        self.graph = np.vstack((self.graph, ids))
+        self.graph_distances = np.vstack((self.graph_distances, distances))
+        # The new points become candidates of their neighbors, and the
+        # neighbors of their neighbors become candidates of the new points
+        reverse = self._group(np.repeat(new_ids, degree), ids.ravel(), degree)
+        touched = np.union1d(np.unique(ids[ids >= 0]), new_ids)
+        second = self.graph[np.maximum(self.graph[touched], 0)]
+        second[self.graph[touched] < 0] = -1
+        candidates = np.hstack((reverse[touched], second.reshape(len(touched), -1)))
+        self.graph[touched], self.graph_distances[touched] = self._merge(touched, candidates,
+                                                                         degree)
+        return new_ids
+
+
+NEIGHBOR_BACKENDS = ('brute', 'ball_tree', 'kd_tree', 'nn_descent')
+
+
+def create_neighbor_index(algorithm, n_neighbors, n_jobs=None, seed=90):
+    """
+    Returns an empty index of the given backend: 'brute', 'nn_descent', or a
+    sklearn tree algorithm ('ball_tree', 'kd_tree', 'auto')
+    """
+    if algorithm == 'brute':
+        return BruteForceIndex()
+    if algorithm == 'nn_descent':
+        return NNDescentIndex(n_neighbors, seed=seed)
+    return TreeIndex(algorithm, n_jobs)
+
+
+def neighbor_recall(points, indices, num_samples=1000, seed=90):
+    """
+    Estimates the recall of the (n, k) neighbor indices of the points: the
+    fraction of the exact k nearest neighbors found, over a random sample
+    of num_samples points
+    """
+    random_state = np.random.default_rng(seed)
+    num_points, k = indices.shape
+    sample = random_state.choice(num_points, min(num_samples, num_points), replace=False)
+    _, exact = BruteForceIndex().build(points).query(points[sample], k)
+    found = [len(np.intersect1d(row, exact_row)) for row, exact_row in zip(indices[sample], exact)]
+    return sum(found) / exact.size
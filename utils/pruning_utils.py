@@ -2,10 +2,20 @@
 Contains the utility functions to return the pruned neighbor list
 """
 
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
-from tqdm import tqdm
-from sklearn.neighbors import NearestNeighbors
-from utils import constants, data_utils, extract_data
+from utils import constants, data_utils, instrumentation, neighbor_index
+from utils.neighbor_graph import NeighborGraph
+
+# Number of points whose neighborhoods are pruned together in one block.
+# Bounds the temporary (block, k) arrays built per block, and the
+# (block, k, dimension) differences of the neighbor distances.
+PRUNING_BLOCK_SIZE = 65536
+# Number of points per shard of the parallel pruning. Each shard draws its
+# random weights from its own stream, so the shards (and not the workers)
+# decide the result, which is the same for any number of workers.
+PRUNING_SHARD_SIZE = 16384
 
 
 def calculate_distance(data_point1, data_point2):
@@ -15,64 +25,240 @@ def calculate_distance(data_point1, data_point2):
     return np.sqrt(np.sum((data_point1 - data_point2) ** 2))
 
 
-def find_k_nearest_neighbors(data, k, seed=90):
+def find_k_nearest_neighbors(data, k, seed=90, algorithm=None, n_jobs=None):
+    """
+    Returns the distances to and the indices of the k nearest neighbors.
+    The global NumPy generator is seeded unless seed is None.
+    algorithm names the neighbor_index backend ('brute', 'ball_tree',
+    'kd_tree' or the approximate 'nn_descent', whose recall is estimated
+    on a sample of NEIGHBOR_RECALL_SAMPLES points and reported).
+    n_jobs is the number of parallel jobs of the tree queries.
+    """
+    if seed is not None:
+        np.random.seed(seed)
+    if algorithm is None:
+        algorithm = constants.CLUSTERING_ALGORITHM
+    index = neighbor_index.create_neighbor_index(algorithm, k, n_jobs=n_jobs).build(data)
+    _, indices = index.self_neighbors(k)
+    distances = calculate_neighbor_distances(index.points, indices)
+    if not index.exact and constants.NEIGHBOR_RECALL_SAMPLES:
+        recall = neighbor_index.neighbor_recall(index.points, indices,
+                                                constants.NEIGHBOR_RECALL_SAMPLES)
+        instrumentation.log(f"Estimated recall of the {algorithm} neighbors: {recall:.3f}")
+        instrumentation.set_value('neighbor_recall', recall)
+    return distances, indices
+
+
+def calculate_neighbor_distances(data, indices):
     """
-    Returns the k nearest neighbors
+    Computes the (n, k) distances to the neighbors from the points, block by
+    block. The backends round their distances differently, which could break
+    ties between the weights in another order; computed the same way for
+    every backend, the pruning does not depend on the one used.
     """
-    np.random.seed(seed)
-    nbrs = NearestNeighbors(n_neighbors=k, algorithm=constants.CLUSTERING_ALGORITHM).fit(data)
-    _, indices = nbrs.kneighbors(data)
-    return indices
+    distances = np.empty(np.shape(indices))
+    for start in range(0, len(indices), PRUNING_BLOCK_SIZE):
+        block = slice(start, start + PRUNING_BLOCK_SIZE)
+        distances[block] = np.linalg.norm(data[indices[block]] - data[block, np.newaxis, :],
+                                          axis=-1)
+    return distances
 
 
-def calculate_weight_vector(g_val, gamma):
+def calculate_weight_vector(gamma, sigma):
     """
-    Calculates the weight vector
+    Calculates the weight vectors for a (n, k) block of gamma values.
+    The regularized Gram matrix is sigma * I, so its inverse is
+    applied as an element-wise division instead of a k x k inversion.
     """
-    g_inv = np.linalg.inv(g_val)
-    omega = (gamma / 2) @ g_inv
-    return omega / np.sum(omega)
+    omega = (gamma / 2) / sigma
+    return omega / np.sum(omega, axis=-1, keepdims=True)
 
 
-def calculate_final_contributions(data, omega, i, neigh):
+def calculate_final_contributions(omega, distances):
     """
-    Calculates the neighborhood construction weights.
+    Calculates the neighborhood construction weights
+    from the (n, k) distances to the nearest neighbors.
     """
-    distances = np.linalg.norm(data[neigh] - data[i], axis=1)
-    w_val = omega / distances
+    with np.errstate(divide='ignore'):
+        w_val = omega / distances
     return w_val
 
 
-def prune_neighbors(w_values, neigh, epsilon):
+def prune_neighbors(w_values, neighbors, distances, epsilon):
     """
-    Returns the list of pruned neighbors.
+    Returns the neighbors of each point and their distances sorted by
+    decreasing weight, along with the number of neighbors to keep.
     """
-    sorted_indices = np.argsort(-w_values)
-    sorted_w_values = w_values[sorted_indices]
-    sorted_neigh = np.array(neigh)[sorted_indices]
-    differences = np.abs(np.diff(sorted_w_values) / sorted_w_values[:-1])
-    t_val = np.argmax(differences > epsilon) + 1
-    return sorted_neigh[:t_val]
+    sorted_indices = np.argsort(-w_values, axis=1)
+    sorted_w_values = np.take_along_axis(w_values, sorted_indices, axis=1)
+    sorted_neigh = np.take_along_axis(neighbors, sorted_indices, axis=1)
+    sorted_distances = np.take_along_axis(distances, sorted_indices, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        differences = np.abs(np.diff(sorted_w_values, axis=1) / sorted_w_values[:, :-1])
+    t_val = np.argmax(differences > epsilon, axis=1) + 1
+    return sorted_neigh, sorted_distances, t_val
 
 
-def optimal_neighborhood_selection(k, epsilon, sigma):
+def prune_neighborhoods(neighbors, distances, gamma, epsilon, sigma):
     """
-    Returns the optimal neighborhood list.
+    Prunes a (n, k) block of nearest neighborhoods. Returns the neighbors
+    and their distances sorted by decreasing weight along with the
+    pruned neighborhood sizes.
     """
-    data = data_utils.get_data(extract_data.get_raw_data_path())
-    num_of_data_points = len(data)
-    pruned_neighbors_list = []
-    k_nearest_neighbors_of_all_datapoints = find_k_nearest_neighbors(data, k)
-    sigma_identity_k = sigma * np.identity(k)
+    omega = calculate_weight_vector(gamma, sigma)
+    w_val = calculate_final_contributions(omega, distances)
+    return prune_neighbors(w_val, neighbors, distances, epsilon)
+
 
-    print("\nStarting pruned neighborhood calculation...")
-    for num in tqdm(range(num_of_data_points)):
-        neigh = k_nearest_neighbors_of_all_datapoints[num]
-        actual_k = len(neigh)
-        gamma = np.random.rand(actual_k)
-        omega = calculate_weight_vector(sigma_identity_k[:actual_k, :actual_k], gamma)
-        w_val = calculate_final_contributions(data, omega, num, neigh)
-        pruned_neigh = prune_neighbors(w_val, neigh, epsilon)
-        pruned_neighbors_list.append(pruned_neigh)
+# pylint: disable=R0913
+def optimal_neighborhood_selection(k, epsilon, sigma, return_distances=False, dataset=None,
+                                   random_state=None, algorithm=None, num_workers=0):
+    """
+    Returns the optimal neighborhoods as a NeighborGraph, whose rows are the
+    pruned neighbor arrays. With return_distances=True, the rows of the
+    distances to the pruned neighbors are returned alongside it.
+    The points are taken from dataset, or read from the raw data file.
+    The random weights are drawn from random_state when given, otherwise
+    from the global NumPy generator seeded with 90.
+    With num_workers > 0, the neighborhoods are pruned in shards by that many
+    processes (see prune_all_neighborhoods_parallel); the shard streams are
+    seeded from random_state, or with 90.
+    """
+    data = data_utils.get_dataset_points(dataset)
+    k_distances, k_nearest_neighbors_of_all_datapoints = find_k_nearest_neighbors(
+        data, k, seed=None if random_state is not None else 90, algorithm=algorithm,
+        n_jobs=num_workers or None)
 
+    if num_workers:
+        seed = 90 if random_state is None else random_state.randint(2 ** 31 - 1)
+        pruned_neighbors_list, pruned_distances_list = prune_all_neighborhoods_parallel(
+            k_nearest_neighbors_of_all_datapoints, k_distances, epsilon, sigma, seed,
+            num_workers)
+    else:
+        if random_state is None:
+            random_state = np.random
+        pruned_neighbors_list, pruned_distances_list = prune_all_neighborhoods(
+            k_nearest_neighbors_of_all_datapoints, k_distances, epsilon, sigma, random_state)
+    if return_distances:
+        return pruned_neighbors_list, pruned_distances_list
     return pruned_neighbors_list
+
+
+def prune_all_neighborhoods(neighbors, distances, epsilon, sigma, random_state):
+    """
+    Prunes the (n, k) nearest neighborhoods of all points in blocks, drawing
+    the random weights from random_state. Returns the pruned neighborhoods as
+    a NeighborGraph and the rows of the distances to the pruned neighbors.
+    """
+    num_of_data_points = len(neighbors)
+    blocks = []
+
+    instrumentation.log("\nStarting pruned neighborhood calculation...")
+    for start in range(0, num_of_data_points, PRUNING_BLOCK_SIZE):
+        block = slice(start, min(start + PRUNING_BLOCK_SIZE, num_of_data_points))
+        neigh = neighbors[block]
+        # Drawn block by block, gamma follows the same random stream
+        # as drawing one row per point
+        gamma = random_state.rand(*neigh.shape)
+        sorted_neigh, sorted_distances, t_val = prune_neighborhoods(neigh, distances[block],
+                                                                    gamma, epsilon, sigma)
+        blocks.append(NeighborGraph.from_sorted(sorted_neigh, sorted_distances, t_val))
+        instrumentation.count('neighbors_pruned', int(neigh.size - np.sum(t_val)))
+    instrumentation.count('points', num_of_data_points)
+    if not blocks:
+        blocks.append(NeighborGraph.from_rows([], []))
+    graph = NeighborGraph.concatenate(blocks)
+    return graph, graph.distances
+
+
+def create_shared_array(shape, dtype, values=None):
+    """
+    Allocates an array in shared memory, optionally filled with values.
+    Returns the shared memory block and the array backed by it.
+    """
+    dtype = np.dtype(dtype)
+    size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    if values is not None:
+        array[...] = values
+    return block, array
+
+
+def attach_shared_array(descriptor):
+    """
+    Attaches to an array created by create_shared_array from its
+    (name, shape, dtype) descriptor. Returns the block and the array.
+    """
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+# pylint: disable=R0913,R0914
+def prune_shard(descriptors, shard_index, start, stop, epsilon, sigma, seed):
+    """
+    Prunes the neighborhoods of the points in [start, stop) read from the shared
+    kNN arrays and writes the sorted neighbors, their distances and the pruned
+    neighborhood sizes to the shared output arrays. The random weights of
+    the shard are drawn from a stream seeded with (seed, shard_index).
+    Returns the number of pruned neighbors.
+    """
+    blocks, arrays = zip(*(attach_shared_array(descriptor) for descriptor in descriptors))
+    neighbors, distances, sorted_neighbors, sorted_distances, sizes = arrays
+    try:
+        random_state = np.random.default_rng([seed, shard_index])
+        gamma = random_state.random((stop - start, neighbors.shape[1]))
+        sorted_neigh, sorted_dist, t_val = prune_neighborhoods(
+            neighbors[start:stop], distances[start:stop], gamma, epsilon, sigma)
+        sorted_neighbors[start:stop] = sorted_neigh
+        sorted_distances[start:stop] = sorted_dist
+        sizes[start:stop] = t_val
+        return int(sorted_neigh.size - np.sum(t_val))
+    finally:
+        del neighbors, distances, sorted_neighbors, sorted_distances, sizes, arrays
+        for block in blocks:
+            block.close()
+
+
+# pylint: disable=R0913,R0914
+def prune_all_neighborhoods_parallel(neighbors, distances, epsilon, sigma, seed=90,
+                                     num_workers=None, shard_size=PRUNING_SHARD_SIZE):
+    """
+    Prunes the (n, k) nearest neighborhoods of all points in shards of shard_size
+    points spread over num_workers processes (all CPUs by default). The kNN
+    arrays and the results live in shared memory, so no array is pickled.
+    Shard i draws its random weights from a stream seeded with (seed, i),
+    so the result does not depend on the number of workers. Returns the
+    pruned neighborhoods as a NeighborGraph and the rows of the distances
+    to the pruned neighbors.
+    """
+    num_of_data_points = len(neighbors)
+    shape = np.shape(neighbors)
+    instrumentation.log("\nStarting parallel pruned neighborhood calculation...")
+    shared = [create_shared_array(shape, np.asarray(neighbors).dtype, neighbors),
+              create_shared_array(shape, np.asarray(distances).dtype, distances),
+              create_shared_array(shape, np.asarray(neighbors).dtype),
+              create_shared_array(shape, np.asarray(distances).dtype),
+              create_shared_array(num_of_data_points, np.intp)]
+    descriptors = [(block.name, array.shape, array.dtype.str) for block, array in shared]
+    starts = list(range(0, num_of_data_points, shard_size))
+    stops = [min(start + shard_size, num_of_data_points) for start in starts]
+    shard_arguments = ([descriptors] * len(starts), range(len(starts)), starts, stops,
+                       [epsilon] * len(starts), [sigma] * len(starts), [seed] * len(starts))
+    try:
+        if num_workers == 1:
+            num_pruned = list(map(prune_shard, *shard_arguments))
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                num_pruned = list(executor.map(prune_shard, *shard_arguments))
+        sorted_neighbors, sorted_distances, sizes = (array.copy() for _, array in shared[2:])
+    finally:
+        for block, _ in shared:
+            block.close()
+            block.unlink()
+
+    instrumentation.count('neighbors_pruned', sum(num_pruned))
+    instrumentation.count('points', num_of_data_points)
+    graph = NeighborGraph.from_sorted(sorted_neighbors, sorted_distances, sizes)
+    return graph, graph.distances
@@ -0,0 +1,432 @@
+"""
+Serves the anomaly decisions of a fitted model over HTTP with asyncio.
+Concurrent requests are collected into micro-batches scored together.
+Usage: python -m utils.scoring_server --loadSnapshot model_snapshot --port 8765
+"""
+
+import argparse
+import asyncio
+import bisect
+import json
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+from utils import instrumentation, snapshot
+
+MAX_BATCH_SIZE = 256  # Points scored together at most
+MAX_WAIT = 0.002  # Seconds a batch waits for more points after its first one
+MAX_QUEUE_SIZE = 4096  # Points waiting to be scored before new requests are rejected
+# Upper bounds (in seconds) of the latency histogram buckets, from 50 us to about 5 s
+LATENCY_BUCKETS = tuple(5e-5 * 2 ** (exponent / 2) for exponent in range(34))
+MAX_REQUEST_BYTES = 1 << 24
+
+
+class AnomalyScorer:
+    """
+    Applies the filtration rule of filter_potential_anomalies to new points:
+    a point joins the cluster of its nearest inlier when it is closer to it
+    than delta_for_filtration times the ICD of that cluster, and is an
+    anomaly otherwise. The inliers and the cluster thresholds are fixed
+    when the scorer is built, so a batch is scored with one KD-tree query.
+    """
+
+    def __init__(self, points, labels, icd_cache, delta_for_filtration):
+        """
+        Indexes the inliers of a fitted model and computes the cluster thresholds
+        """
+        labels = np.asarray(labels)
+        self.inliers = np.flatnonzero(labels > 0)
+        if self.inliers.size == 0:
+            raise ValueError("The model has no clustered points to score against")
+        self.inlier_labels = labels[self.inliers]
+        self.tree = cKDTree(np.asarray(points)[self.inliers])
+        self.thresholds = np.zeros(labels.max() + 1)
+        for cluster_id in np.unique(self.inlier_labels).tolist():
+            members = np.flatnonzero(labels == cluster_id)
+            self.thresholds[cluster_id] = delta_for_filtration * icd_cache.icd(cluster_id,
+                                                                               members)
+
+    @classmethod
+    def from_estimator(cls, estimator):
+        """
+        Builds the scorer of a fitted DyTrAno estimator
+        """
+        return cls(estimator.icd_cache_.data, estimator.labels_, estimator.icd_cache_,
+                   estimator.delta_for_filtration)
+
+    def score(self, points):
+        """
+        Scores a (m, d) block of points. Returns their labels (the cluster id,
+        or -1 for an anomaly), the distances to their nearest inliers and the
+        thresholds of the clusters of those inliers.
+        """
+        distances, positions = self.tree.query(np.atleast_2d(points), k=1)
+        cluster_ids = self.inlier_labels[positions]
+        thresholds = self.thresholds[cluster_ids]
+        labels = np.where(distances < thresholds, cluster_ids, -1)
+        return labels, distances, thresholds
+
+
+class LatencyHistogram:
+    """
+    Counts latencies in exponentially growing buckets
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Initializes an empty histogram; the last bucket counts everything above buckets[-1]
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def record(self, seconds):
+        """
+        Adds a latency to the histogram
+        """
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.total += 1
+        self.sum += seconds
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket holding the given percentile,
+        or None when the histogram is empty or the percentile overflows
+        """
+        if not self.total:
+            return None
+        rank = percent / 100 * self.total
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[position] if position < len(self.buckets) else None
+        return None
+
+    def to_dict(self):
+        """
+        Returns the count, the mean and the main percentiles
+        """
+        return {'count': self.total, 'mean': self.sum / self.total if self.total else None,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+
+class ServerBusy(Exception):
+    """
+    Raised when the scoring queue is full
+    """
+
+
+class ScoringServer:  # pylint: disable=R0902
+    """
+    Scores points in micro-batches: every point waits in a bounded queue
+    until max_batch_size points are queued or max_wait seconds went by
+    since the first one, and the batch is then scored in one call off the
+    event loop. When max_queue_size points are waiting, score() waits for
+    room, while HTTP requests are turned away with a 503 (backpressure).
+    """
+
+    def __init__(self, scorer, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT,
+                 max_queue_size=MAX_QUEUE_SIZE):
+        """
+        Initializes a stopped server
+        """
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.request_latency = LatencyHistogram()
+        self.batch_latency = LatencyHistogram()
+        self.batch_sizes = {}
+        self.rejected = 0
+        self._queue = None
+        self._batcher = None
+        self._server = None
+
+    async def start(self, host=None, port=None):
+        """
+        Starts the batching task and, if a port is given, the HTTP endpoint
+        (port 0 picks a free port, available in self.port)
+        """
+        # Created here so that the queue belongs to the running event loop
+        self._queue = asyncio.Queue(self.max_queue_size)
+        self._batcher = asyncio.ensure_future(self._run_batches())
+        if port is not None:
+            self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self
+
+    @property
+    def port(self):
+        """
+        Returns the port of the HTTP endpoint
+        """
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """
+        Stops the HTTP endpoint and the batching task
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+
+    async def score(self, point, wait=True):
+        """
+        Scores one point with the next batch and returns its label, the
+        distance to its nearest inlier and the threshold of that inlier's
+        cluster. Without wait, ServerBusy is raised if the queue is full.
+        """
+        future = asyncio.get_running_loop().create_future()
+        item = (np.asarray(point, dtype=float), future, time.perf_counter())
+        if wait:
+            await self._queue.put(item)
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except asyncio.QueueFull as error:
+                self.rejected += 1
+                raise ServerBusy from error
+        return await future
+
+    async def score_many(self, points, wait=True):
+        """
+        Scores several points, which may end up in different batches
+        """
+        if not wait and self._queue.maxsize and \
+                self._queue.qsize() + len(points) > self._queue.maxsize:
+            self.rejected += 1
+            raise ServerBusy
+        return await asyncio.gather(*(self.score(point) for point in points))
+
+    async def _next_batch(self):
+        """
+        Waits for a first point, then collects more until the batch is full or max_wait expires
+        """
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # Points queued while waiting are taken without waiting any longer
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run_batches(self):
+        """
+        Scores the queued points batch after batch
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            points, futures, queued_at = zip(*batch)
+            start = time.perf_counter()
+            try:
+                labels, distances, thresholds = await loop.run_in_executor(
+                    None, self.scorer.score, np.stack(points))
+            except Exception as error:  # pylint: disable=W0703
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            finished = time.perf_counter()
+            self.batch_latency.record(finished - start)
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+            for position, future in enumerate(futures):
+                self.request_latency.record(finished - queued_at[position])
+                # A cancelled request leaves its future done
+                if not future.done():
+                    future.set_result((int(labels[position]), float(distances[position]),
+                                       float(thresholds[position])))
+
+    def stats(self):
+        """
+        Returns the latency histograms, the batch size counts and the number of rejected requests
+        """
+        return {'request_latency': self.request_latency.to_dict(),
+                'batch_latency': self.batch_latency.to_dict(),
+                'batch_sizes': dict(sorted(self.batch_sizes.items())),
+                'queued': self._queue.qsize() if self._queue is not None else 0,
+                'rejected': self.rejected}
+
+    async def _handle_connection(self, reader, writer):
+        """
+        Answers the HTTP requests of a connection until the client closes it:
+        POST /score with {"points": [[...], ...]}, and GET /stats
+        """
+        try:
+            while True:
+                request = await read_http_message(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                status, response = await self._respond(method, target, body)
+                write_http_message(writer, f"HTTP/1.1 {status}", response)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, method, target, body):
+        """
+        Returns the status line and the JSON body answering a request
+        """
+        if method == 'GET' and target == '/stats':
+            return '200 OK', self.stats()
+        if method != 'POST' or target != '/score':
+            return '404 Not Found', {'error': f"No route for {method} {target}"}
+        try:
+            points = np.asarray(json.loads(body)['points'], dtype=float)
+            if points.ndim != 2 or points.shape[1] != self.scorer.tree.m:
+                raise ValueError(f"Expected points of dimension {self.scorer.tree.m}")
+        except (ValueError, KeyError, TypeError) as error:
+            return '400 Bad Request', {'error': str(error)}
+        try:
+            results = await self.score_many(points, wait=False)
+        except ServerBusy:
+            return '503 Service Unavailable', {'error': "The scoring queue is full"}
+        return '200 OK', {'results': [{'label': label, 'anomaly': label == -1,
+                                       'distance': distance, 'threshold': threshold}
+                                      for label, distance, threshold in results]}
+
+
+async def read_http_message(reader):
+    """
+    Reads an HTTP/1.1 request or response. Returns its start line split in
+    three, its lower-cased headers and its body, or None at end of stream.
+    """
+    start_line = await reader.readline()
+    if not start_line.strip():
+        return None
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_REQUEST_BYTES:
+        raise ConnectionError(f"Message of {length} bytes is too large")
+    body = await reader.readexactly(length) if length else b''
+    first, second, *_ = start_line.decode('latin-1').split(' ', 2) + ['']
+    return first, second, headers, body
+
+
+def write_http_message(writer, start_line, payload, headers=None):
+    """
+    Writes an HTTP/1.1 message with a JSON body
+    """
+    body = json.dumps(payload).encode()
+    lines = [start_line, 'Content-Type: application/json', f"Content-Length: {len(body)}"]
+    lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+
+class ScoringClient:
+    """
+    Minimal HTTP client of a ScoringServer, keeping one connection open
+    """
+
+    def __init__(self, host, port):
+        """
+        Initializes a client; the connection is opened by the first request
+        """
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def _request(self, method, target, payload=None):
+        """
+        Sends a request and returns the status code and the decoded JSON body
+        """
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        write_http_message(self._writer, f"{method} {target} HTTP/1.1", payload,
+                           {'Host': f"{self.host}:{self.port}"})
+        await self._writer.drain()
+        _, status, _, body = await read_http_message(self._reader)
+        return int(status), json.loads(body)
+
+    async def score(self, points):
+        """
+        Scores a list of points; returns the status code and the response
+        """
+        return await self._request('POST', '/score', {'points': np.asarray(points).tolist()})
+
+    async def stats(self):
+        """
+        Returns the status code and the statistics of the server
+        """
+        return await self._request('GET', '/stats')
+
+    async def close(self):
+        """
+        Closes the connection
+        """
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+
+def parse_arguments():
+    """
+    This is used to parse the arguments passed from the CML
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loadSnapshot', type=str, required=True,
+                        help='Snapshot directory of the fitted model to serve')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--maxBatchSize', type=int, default=MAX_BATCH_SIZE,
+                        help='Maximum number of points scored together')
+    parser.add_argument('--maxWait', type=float, default=MAX_WAIT,
+                        help='Seconds a batch waits for more points after its first one')
+    parser.add_argument('--maxQueueSize', type=int, default=MAX_QUEUE_SIZE,
+                        help='Points waiting to be scored before requests are rejected')
+    return parser.parse_args()
+
+
+async def serve(arguments):
+    """
+    Serves the model until interrupted
+    """
+    scorer = AnomalyScorer.from_estimator(snapshot.load_estimator(arguments.loadSnapshot))
+    server = await ScoringServer(scorer, arguments.maxBatchSize, arguments.maxWait,
+                                 arguments.maxQueueSize).start(arguments.host, arguments.port)
+    instrumentation.log(f"Scoring on http://{arguments.host}:{server.port}/score")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main():
+    """
+    Loads the snapshot and starts the server
+    """
+    try:
+        asyncio.run(serve(parse_arguments()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+Contains the on-disk snapshots of fitted models, which restore a model
+without running the pipeline again
+"""
+
+from collections import deque
+import json
+import os
+import numpy as np
+from utils import data_utils, icd_utils
+from utils.estimator import DyTrAno
+from utils.forest import ArrayForest
+from utils.neighbor_graph import CSRRows, NeighborGraph
+from utils.neighbor_index import IncrementalNeighborIndex, ReachIndex
+from utils.streaming import StreamingDyTrAno
+
+SNAPSHOT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+ESTIMATOR_KIND = 'dytrano'
+STREAMING_KIND = 'streaming'
+# Parameters stored with the snapshots, to rebuild the models
+ESTIMATOR_PARAMETERS = ('k', 'delta', 'beta', 'epsilon', 'sigma', 'delta_for_filtration',
+                        'algorithm', 'seed', 'icd_sample_threshold', 'merge_engine',
+                        'merge_compatible_fraction')
+STREAMING_PARAMETERS = ('k', 'delta', 'beta', 'epsilon', 'sigma', 'seed', 'window_size',
+                        'window_duration')
+
+
+def write_snapshot(path, kind, parameters, arrays, state=None):
+    """
+    Writes a snapshot directory: one .npy file per array, and a JSON manifest
+    with the format version, the model kind, its parameters, its scalar
+    state and the shape, dtype and checksum of every array
+    """
+    os.makedirs(path, exist_ok=True)
+    headers = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        np.save(os.path.join(path, f"{name}.npy"), array)
+        headers[name] = {'shape': list(array.shape), 'dtype': array.dtype.str,
+                         'checksum': data_utils.calculate_checksum(array)}
+    manifest = {'version': SNAPSHOT_VERSION, 'kind': kind, 'parameters': parameters,
+                'state': state or {}, 'arrays': headers}
+    # The manifest is written last, so a partly written snapshot is never loaded
+    with open(os.path.join(path, MANIFEST_NAME), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+
+
+def read_snapshot(path, kind, verify=False):
+    """
+    Maps the arrays of a snapshot copy-on-write: they are read lazily from
+    disk, and writing to them never changes the files. Returns the manifest
+    and the arrays. Raises a ValueError if the snapshot has another version
+    or kind, or if an array does not match the manifest (or its checksum,
+    if verify is True).
+    """
+    with open(os.path.join(path, MANIFEST_NAME), 'r', encoding='utf-8') as file:
+        manifest = json.load(file)
+    if manifest['version'] != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is a version {manifest['version']} snapshot, "
+                         f"expected version {SNAPSHOT_VERSION}")
+    if manifest['kind'] != kind:
+        raise ValueError(f"{path} is a {manifest['kind']} snapshot, expected {kind}")
+    arrays = {}
+    for name, header in manifest['arrays'].items():
+        array = np.load(os.path.join(path, f"{name}.npy"), mmap_mode='c')
+        if list(array.shape) != header['shape'] or array.dtype.str != header['dtype']:
+            raise ValueError(f"The {name} array of {path} does not match the manifest")
+        if verify and data_utils.calculate_checksum(array) != header['checksum']:
+            raise ValueError(f"The checksum of the {name} array of {path} does not match")
+        arrays[name] = array
+    return manifest, arrays
+
+
+def to_csr(rows):
+    """
+    Returns a list of index arrays or sets as CSR arrays (indptr, indices)
+    """
+    if isinstance(rows, CSRRows):
+        return rows.indptr, rows.values
+    rows = [np.fromiter(row, dtype=np.intp, count=len(row)) for row in rows]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row) for row in rows], out=indptr[1:])
+    indices = np.concatenate(rows) if rows else np.empty(0, dtype=np.intp)
+    return indptr, indices
+
+
+def from_csr(indptr, indices):
+    """
+    Returns the rows of CSR arrays as a list of views of the indices
+    """
+    return np.split(indices, indptr[1:-1])
+
+
+def forest_arrays(forest):
+    """
+    Returns the arrays of an ArrayForest and of its roots
+    """
+    return {'forest_parent': forest.parent, 'forest_first_child': forest.first_child,
+            'forest_next_sibling': forest.next_sibling, 'forest_density': forest.density,
+            'forest_cluster_id': forest.cluster_id,
+            'root_cluster_ids': np.array(list(forest.roots), dtype=np.int64),
+            'root_indexes': np.array(list(forest.roots.values()), dtype=np.int64)}
+
+
+def restore_forest(arrays):
+    """
+    Rebuilds an ArrayForest from the arrays written by forest_arrays
+    """
+    forest = ArrayForest(0)
+    forest.parent = arrays['forest_parent']
+    forest.first_child = arrays['forest_first_child']
+    forest.next_sibling = arrays['forest_next_sibling']
+    forest.density = arrays['forest_density']
+    forest.cluster_id = arrays['forest_cluster_id']
+    forest.roots = dict(zip(arrays['root_cluster_ids'].tolist(),
+                            arrays['root_indexes'].tolist()))
+    return forest
+
+
+# pylint: disable=R0913
+def save_model(path, points, labels, filtered_labels, densities, pruned_neighbors, forest,
+               icd_cache=None, parameters=None):
+    """
+    Writes the state of a fitted batch run: its points, labels, densities,
+    pruned neighborhoods, cluster forest (an ArrayForest or TreeNode maps)
+    and the cached cluster ICDs
+    """
+    if not isinstance(forest, ArrayForest):
+        forest = ArrayForest.from_node_maps(forest, len(points))
+    pruned_indptr, pruned_indices = to_csr(pruned_neighbors)
+    arrays = {'points': points, 'labels': np.asarray(labels),
+              'filtered_labels': np.asarray(filtered_labels), 'densities': densities,
+              'pruned_indptr': pruned_indptr, 'pruned_indices': pruned_indices}
+    arrays.update(forest_arrays(forest))
+    if icd_cache is not None:
+        icd_cache.refresh()
+        cluster_ids = list(icd_cache.distance_sums)
+        member_indptr, member_indices = to_csr([icd_cache.members[cluster_id]
+                                                for cluster_id in cluster_ids])
+        arrays.update({'icd_cluster_ids': np.array(cluster_ids, dtype=np.int64),
+                       'icd_distance_sums': np.array([icd_cache.distance_sums[cluster_id]
+                                                      for cluster_id in cluster_ids]),
+                       'icd_distance_sum_errors': np.array(
+                           [icd_cache.distance_sum_errors[cluster_id]
+                            for cluster_id in cluster_ids]),
+                       'icd_member_indptr': member_indptr, 'icd_member_indices': member_indices})
+    write_snapshot(path, ESTIMATOR_KIND, parameters or {}, arrays)
+
+
+def save_estimator(estimator, path):
+    """
+    Writes a snapshot of a fitted DyTrAno estimator
+    """
+    if estimator.labels_ is None:
+        raise ValueError("Only a fitted estimator can be saved")
+    save_model(path, estimator.icd_cache_.data, estimator.labels_, estimator.filtered_labels_,
+               estimator.densities_, estimator.pruned_neighbors_, estimator.forest_,
+               estimator.icd_cache_,
+               {name: getattr(estimator, name) for name in ESTIMATOR_PARAMETERS})
+
+
+def load_estimator(path, verify=False):
+    """
+    Restores a fitted DyTrAno estimator from a snapshot. The arrays stay
+    mapped from the snapshot files until they are written to.
+    """
+    manifest, arrays = read_snapshot(path, ESTIMATOR_KIND, verify)
+    estimator = DyTrAno(**manifest['parameters'])
+    estimator.labels_ = arrays['labels']
+    estimator.filtered_labels_ = arrays['filtered_labels']
+    estimator.densities_ = arrays['densities']
+    estimator.pruned_neighbors_ = NeighborGraph(arrays['pruned_indptr'], arrays['pruned_indices'])
+    estimator.forest_ = restore_forest(arrays)
+
+    icd_cache = icd_utils.ICDCache(arrays['points'],
+                                   sample_threshold=estimator.icd_sample_threshold)
+    if 'icd_cluster_ids' in arrays:
+        members = from_csr(arrays['icd_member_indptr'], arrays['icd_member_indices'])
+        for position, cluster_id in enumerate(arrays['icd_cluster_ids'].tolist()):
+            icd_cache.members[cluster_id] = members[position].tolist()
+            icd_cache.distance_sums[cluster_id] = float(arrays['icd_distance_sums'][position])
+            icd_cache.distance_sum_errors[cluster_id] = \
+                float(arrays['icd_distance_sum_errors'][position])
+    estimator.icd_cache_ = icd_cache
+    return estimator
+
+
+def save_streaming(engine, path):
+    """
+    Writes a snapshot of a bootstrapped streaming engine, from which
+    it can go on inserting points
+    """
+    if engine.index is None:
+        raise ValueError("Only a bootstrapped engine can be saved")
+    size = engine.size
+    forest = ArrayForest.from_node_maps(engine.all_node_maps, size)
+    forest.roots = {cluster_id: root.get_index() for cluster_id, root in engine.roots.items()}
+    _, keys, position, has_gauss, cached_gaussian = engine.random_state.get_state()
+    index = engine.index
+    arrays = {'points': index.points[:index.high_water],
+              'free_ids': np.array(index.free_ids, dtype=np.int64),
+              'random_keys': keys,
+              'arrival_slots': np.array([slot for slot, _ in engine.arrivals], dtype=np.int64),
+              'arrival_timestamps': np.array([np.nan if timestamp is None else timestamp
+                                              for _, timestamp in engine.arrivals], dtype=float)}
+    for name in ('knn_indices', 'knn_distances', 'gamma', 'sorted_neighbors', 'pruned_lengths',
+                 'densities', 'ewma_values', 'labels', 'alive'):
+        arrays[name] = getattr(engine, f"_{name}")[:size]
+    arrays.update(forest_arrays(forest))
+    if engine.reverse_neighbors is not None:
+        arrays['reverse_indptr'], arrays['reverse_indices'] = \
+            to_csr(engine.reverse_neighbors[:size])
+    state = {'size': size, 'num_seen': engine.num_seen,
+             'next_cluster_id': engine.next_cluster_id,
+             'random_position': position, 'random_has_gauss': has_gauss,
+             'random_cached_gaussian': cached_gaussian,
+             'index_buffer_size': index.buffer_size}
+    write_snapshot(path, STREAMING_KIND,
+                   {name: getattr(engine, name) for name in STREAMING_PARAMETERS}, arrays, state)
+
+
+def load_streaming(path, verify=False):
+    """
+    Restores a streaming engine from a snapshot, ready to insert new points
+    """
+    manifest, arrays = read_snapshot(path, STREAMING_KIND, verify)
+    state = manifest['state']
+    engine = StreamingDyTrAno(**manifest['parameters'])
+    engine.size = state['size']
+    engine.num_seen = state['num_seen']
+    engine.next_cluster_id = state['next_cluster_id']
+    engine.random_state.set_state(('MT19937', np.array(arrays['random_keys']),
+                                   state['random_position'], state['random_has_gauss'],
+                                   state['random_cached_gaussian']))
+    for name in ('knn_indices', 'knn_distances', 'gamma', 'sorted_neighbors', 'pruned_lengths',
+                 'densities', 'ewma_values', 'labels', 'alive'):
+        setattr(engine, f"_{name}", np.array(arrays[name]))
+
+    forest = restore_forest(arrays)
+    engine.all_node_maps = forest.to_node_maps()
+    nodes = {index: node for node_map in engine.all_node_maps.values()
+             for index, node in node_map.items()}
+    engine.roots = {cluster_id: nodes[index] for cluster_id, index in forest.roots.items()}
+
+    # The index gets the same ids back: every point is added, and the points
+    # of the free ids are removed again, which hands them out in the same order
+    points = arrays['points']
+    engine.index = IncrementalNeighborIndex(points.shape[1], state['index_buffer_size'])
+    if len(points):
+        engine.index.add(points)
+    free_ids = arrays['free_ids'].tolist()
+    for point_id in free_ids:
+        engine.index.remove(point_id)
+    engine.index.free_ids = free_ids
+    engine.reach_index = ReachIndex()
+    live = np.flatnonzero(engine.alive)
+    engine.reach_index.update(live, points[live], arrays['knn_distances'][live, -1])
+
+    timestamps = [None if np.isnan(timestamp) else timestamp
+                  for timestamp in arrays['arrival_timestamps'].tolist()]
+    engine.arrivals = deque(zip(arrays['arrival_slots'].tolist(), timestamps))
+    if 'reverse_indptr' in arrays:
+        engine.reverse_neighbors = [set(row.tolist()) for row in
+                                    from_csr(arrays['reverse_indptr'], arrays['reverse_indices'])]
+    return engine
@@ -0,0 +1,736 @@
+"""
+Contains the streaming DyTrAno engine which clusters points one at a time
+"""
+
+from collections import deque
+import numpy as np
+from utils import clustering_utils, constants, pruning_utils
+from utils.neighbor_graph import NeighborGraph
+from utils.neighbor_index import IncrementalNeighborIndex, ReachIndex
+
+
+def passes_density_change_threshold(ewma_value, density, delta):
+    """
+    Checks the EWMA/delta rule used by cluster_tree to accept a child
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return bool(abs((ewma_value - density) / ewma_value) <= delta)
+
+
+# pylint: disable=R0902
+class StreamingDyTrAno:
+    """
+    Holds the neighbor index, the kNN neighborhoods, the densities, the labels
+    and the TreeNode forest of a DyTrAno run, and updates them incrementally.
+
+    The engine is bootstrapped with fit() on an initial batch, which runs the
+    same pruning and tree-based clustering as the batch pipeline. Every point
+    passed to insert() afterwards only touches its own neighborhood and the
+    neighborhoods it enters. The kNN lists stay exact: the points whose k-th
+    neighbor is farther than the new point are looked up in a ReachIndex of
+    the balls reaching to every point's k-th neighbor, which is updated
+    along with the kNN lists, so an insert only compares the new point with
+    points that it may be close enough to.
+
+    With window_size (a number of points) or window_duration (a timestamp
+    span) set, points that leave the window are removed from the index and
+    the forest. Their slots are reused by later points, so in window mode the
+    per-point arrays are indexed by slot rather than by arrival order.
+    """
+
+    # pylint: disable=R0913
+    def __init__(self, k=None, delta=None, beta=None, epsilon=None, sigma=None, seed=90,
+                 window_size=None, window_duration=None):
+        """
+        Initializes the engine; parameters default to the values in constants
+        """
+        if window_size is not None and window_duration is not None:
+            raise ValueError("Use either a count-based or a timestamp-based window, not both")
+        self.k = constants.NUMBER_OF_NEIGHBORS if k is None else k
+        self.delta = constants.DELTA if delta is None else delta
+        self.beta = constants.BETA if beta is None else beta
+        self.epsilon = constants.NEIGHBORHOOD_CONTRIBUTION_DIFFERENCE if epsilon is None \
+            else epsilon
+        self.sigma = constants.SIGMA if sigma is None else sigma
+        self.seed = seed
+        # Same legacy generator as the batch pipeline, so fit() draws the same gamma values
+        self.random_state = np.random.RandomState(seed)  # pylint: disable=E1101
+        self.index = None
+        # Balls reaching to the k-th neighbor of every point, to find the
+        # kNN lists a new point enters
+        self.reach_index = None
+        self.size = 0
+        # Number of points passed to fit() and insert(), including expired ones
+        self.num_seen = 0
+        self.all_node_maps = {}
+        self.roots = {}
+        self.next_cluster_id = 1
+        if window_size is not None and window_size < self.k:
+            raise ValueError(f"The window must hold at least {self.k} points")
+        self.window_size = window_size
+        self.window_duration = window_duration
+        # (slot, timestamp) of the live points in arrival order, used for expiry
+        self.arrivals = deque()
+        # For each slot, the slots whose kNN lists contain it (window mode only)
+        self.reverse_neighbors = None
+        # Per-point storage, grown geometrically as points are inserted
+        self._knn_indices = None
+        self._knn_distances = None
+        self._gamma = None
+        self._sorted_neighbors = None
+        self._pruned_lengths = None
+        self._densities = None
+        self._ewma_values = None
+        self._labels = None
+        self._alive = None
+
+    @property
+    def windowed(self):
+        """
+        Returns whether points expire from the engine
+        """
+        return self.window_size is not None or self.window_duration is not None
+
+    @property
+    def labels(self):
+        """
+        Returns the labels of all points seen so far (-1 for anomalies).
+        In window mode the slots of expired points are labeled 0.
+        """
+        return self._labels[:self.size]
+
+    @property
+    def alive(self):
+        """
+        Returns a mask of the slots holding a point of the current window
+        """
+        return self._alive[:self.size]
+
+    @property
+    def densities(self):
+        """
+        Returns the densities of all points seen so far
+        """
+        return self._densities[:self.size]
+
+    def pruned_neighbors(self, index):
+        """
+        Returns the pruned neighborhood of a point
+        """
+        return self._sorted_neighbors[index, :self._pruned_lengths[index]]
+
+    def _reserve(self, required):
+        """
+        Grows the per-point storage so that it can hold the required number of points
+        """
+        capacity = len(self._labels)
+        if required <= capacity:
+            return
+        capacity = max(required, 2 * capacity)
+
+        def grow(array):
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            return grown
+
+        self._knn_indices = grow(self._knn_indices)
+        self._knn_distances = grow(self._knn_distances)
+        self._gamma = grow(self._gamma)
+        self._sorted_neighbors = grow(self._sorted_neighbors)
+        self._pruned_lengths = grow(self._pruned_lengths)
+        self._densities = grow(self._densities)
+        self._ewma_values = grow(self._ewma_values)
+        self._labels = grow(self._labels)
+        self._alive = grow(self._alive)
+        if self.reverse_neighbors is not None:
+            self.reverse_neighbors.extend(set() for _ in
+                                          range(capacity - len(self.reverse_neighbors)))
+
+    def fit(self, data, timestamps=None):
+        """
+        Bootstraps the engine from an initial batch of points using the
+        batch pruning and tree-based clustering
+        """
+        if self.window_duration is not None and timestamps is None:
+            raise ValueError("A timestamp-based window needs the timestamps of the points")
+        data = np.ascontiguousarray(data, dtype=float)
+        num_points = len(data)
+        if num_points < self.k:
+            raise ValueError(f"At least {self.k} points are needed to bootstrap, "
+                             f"got {num_points}")
+
+        distances, indices = pruning_utils.find_k_nearest_neighbors(data, self.k, seed=None)
+        gamma = self.random_state.rand(num_points, self.k)
+        sorted_neighbors, sorted_distances, pruned_lengths = pruning_utils.prune_neighborhoods(
+            indices, distances, gamma, self.epsilon, self.sigma)
+        densities = clustering_utils.calculate_density_from_sorted_distances(sorted_distances,
+                                                                             pruned_lengths)
+        ewma_values = np.zeros(num_points)
+        pruned_graph = NeighborGraph.from_sorted(sorted_neighbors, None, pruned_lengths)
+        labels, all_node_maps = clustering_utils.grow_cluster_trees(
+            pruned_graph, densities, self.delta, self.beta, ewma_values)
+
+        self.size = num_points
+        self.num_seen = num_points
+        self._knn_indices = indices
+        self._knn_distances = distances
+        self._gamma = gamma
+        self._sorted_neighbors = sorted_neighbors
+        self._pruned_lengths = pruned_lengths
+        self._densities = densities
+        self._ewma_values = ewma_values
+        self._labels = np.array(labels)
+        self._alive = np.ones(num_points, dtype=bool)
+
+        self.all_node_maps = all_node_maps
+        self.roots = {cluster_id: next(node for node in node_map.values() if node.parent is None)
+                      for cluster_id, node_map in all_node_maps.items()}
+        self.next_cluster_id = max(all_node_maps, default=0) + 1
+
+        self.index = IncrementalNeighborIndex(data.shape[1])
+        self.index.add(data)
+        self.reach_index = ReachIndex()
+        self._update_reaches(np.arange(num_points))
+
+        if self.windowed:
+            self.reverse_neighbors = [set() for _ in range(num_points)]
+            self._link_rows(np.arange(num_points), None)
+            if timestamps is None:
+                timestamps = [None] * num_points
+            self.arrivals = deque(zip(range(num_points), timestamps))
+            self._expire(timestamps[-1], incoming=0)
+        return self
+
+    def insert(self, point, timestamp=None):
+        """
+        Inserts a new point and returns its label (-1 for an anomaly)
+        """
+        if self.index is None:
+            raise RuntimeError("The engine must be bootstrapped with fit() before insert()")
+        if self.window_duration is not None and timestamp is None:
+            raise ValueError("A timestamp-based window needs the timestamp of every point")
+        if self.windowed:
+            self._expire(timestamp)
+
+        new_index = int(self.index.add(np.asarray(point, dtype=float))[0])
+        self._reserve(new_index + 1)
+        self.size = max(self.size, new_index + 1)
+        self.num_seen += 1
+        distances, indices = self._query_neighborhoods(np.array([new_index]))
+        _, reverse_rows, reverse_distances = self._reverse_neighbors(
+            self.index.points[[new_index]])
+        self._knn_distances[new_index] = distances[0]
+        self._knn_indices[new_index] = indices[0]
+        self._gamma[new_index] = self.random_state.rand(self.k)
+        self._labels[new_index] = 0
+        self._alive[new_index] = True
+        if self.windowed:
+            self._link_rows(np.array([new_index]), None)
+            self.arrivals.append((new_index, timestamp))
+
+        affected = self._enter_neighborhoods(new_index, reverse_rows, reverse_distances)
+        self._update_reaches(np.concatenate(([new_index], affected)))
+        old_densities = self._densities[affected]
+        self._prune(np.concatenate(([new_index], affected)))
+        self._refresh_densities(affected, old_densities)
+
+        # Points that now list the new point as a pruned neighbor may adopt it,
+        # as they would while growing their cluster tree
+        in_pruned = (self._sorted_neighbors[affected] == new_index) & \
+            (np.arange(self.k) < self._pruned_lengths[affected][:, np.newaxis])
+        adopters = affected[np.any(in_pruned, axis=1)]
+        return self._assign(new_index, adopters.tolist())
+
+    def insert_many(self, points, timestamps=None):
+        """
+        Inserts a (m, d) batch of new points and returns their labels.
+        The batch shares its kNN queries, one update of the neighborhoods it
+        enters and one pruning pass; its points are then assigned to the
+        forest in decreasing density order, so that the denser new points
+        are in place when the sparser ones look for a cluster. In window
+        mode the expiry runs once per batch. Of a batch larger than
+        window_size, only the last window_size points are inserted, as the
+        others would leave the window before the end of the batch; they are
+        counted as seen and labeled 0, like expired points.
+        """
+        if self.index is None:
+            raise RuntimeError("The engine must be bootstrapped with fit() before insert_many()")
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if self.window_duration is not None and timestamps is None:
+            raise ValueError("A timestamp-based window needs the timestamp of every point")
+        if timestamps is None:
+            timestamps = [None] * len(points)
+        if self.window_size is not None and len(points) > self.window_size:
+            skipped = len(points) - self.window_size
+            labels = np.zeros(len(points), dtype=self._labels.dtype)
+            labels[skipped:] = self.insert_many(points[skipped:], timestamps[skipped:])
+            self.num_seen += skipped
+            return labels
+        if len(points) == 0:
+            return np.empty(0, dtype=self._labels.dtype)
+        if self.windowed:
+            self._expire(timestamps[-1], incoming=len(points))
+
+        # Looked up before the batch is indexed, so only existing points are found
+        reverse_positions, reverse_rows, reverse_distances = self._reverse_neighbors(points)
+        new_rows = self.index.add(points)
+        self._reserve(int(new_rows.max()) + 1)
+        self.size = max(self.size, int(new_rows.max()) + 1)
+        self.num_seen += len(points)
+        self._knn_distances[new_rows], self._knn_indices[new_rows] = \
+            self._query_neighborhoods(new_rows)
+        # Drawn row by row, as by consecutive insert() calls
+        self._gamma[new_rows] = self.random_state.rand(len(points), self.k)
+        self._labels[new_rows] = 0
+        self._alive[new_rows] = True
+        if self.windowed:
+            self._link_rows(new_rows, None)
+            self.arrivals.extend(zip(new_rows.tolist(), timestamps))
+
+        affected = self._enter_neighborhoods_batch(new_rows[reverse_positions], reverse_rows,
+                                                   reverse_distances)
+        rows = np.concatenate((new_rows, affected))
+        self._update_reaches(rows)
+        old_densities = self._densities[affected]
+        self._prune(rows)
+        self._refresh_densities(affected, old_densities)
+
+        # The points listing a new point as a pruned neighbor may adopt it,
+        # the closest ones first
+        is_new = np.zeros(self.size, dtype=bool)
+        is_new[new_rows] = True
+        pruned = self._sorted_neighbors[rows]
+        in_pruned = is_new[pruned] & \
+            (np.arange(self.k) < self._pruned_lengths[rows][:, np.newaxis])
+        adopter_positions, columns = np.nonzero(in_pruned)
+        adopter_rows = rows[adopter_positions]
+        adopted_rows = pruned[adopter_positions, columns]
+        edge_distances = np.linalg.norm(self.index.points[adopter_rows] -
+                                        self.index.points[adopted_rows], axis=1)
+        adopters = {row: [] for row in new_rows.tolist()}
+        for edge in np.lexsort((edge_distances, adopted_rows)).tolist():
+            if adopter_rows[edge] != adopted_rows[edge]:
+                adopters[int(adopted_rows[edge])].append(int(adopter_rows[edge]))
+
+        order = np.argsort(-self._densities[new_rows], kind='stable')
+        for row in new_rows[order].tolist():
+            self._assign(row, adopters[row])
+        return self._labels[new_rows].copy()
+
+    def _enter_neighborhoods_batch(self, sources, targets, candidate_distances):
+        """
+        Inserts the new points (sources) into the kNN lists of their candidate
+        existing points (targets) whose current k-th neighbor is farther,
+        keeping for every list the k closest of its old and new candidates.
+        Returns those points.
+        """
+        keep = candidate_distances < self._knn_distances[targets, -1]
+        sources, targets, candidate_distances = \
+            sources[keep], targets[keep], candidate_distances[keep]
+        if len(targets) == 0:
+            return np.empty(0, dtype=np.intp)
+
+        # At most k candidates per list can enter it
+        order = np.lexsort((candidate_distances, targets))
+        sources, targets, candidate_distances = \
+            sources[order], targets[order], candidate_distances[order]
+        rows, first, counts = np.unique(targets, return_index=True, return_counts=True)
+        rank = np.arange(len(targets)) - np.repeat(first, counts)
+        keep = rank < self.k
+        row_positions = np.repeat(np.arange(len(rows)), counts)[keep]
+        new_indices = np.repeat(rows[:, np.newaxis], self.k, axis=1)
+        new_distances = np.full((len(rows), self.k), np.inf)
+        new_indices[row_positions, rank[keep]] = sources[keep]
+        new_distances[row_positions, rank[keep]] = candidate_distances[keep]
+
+        # The lists are updated in the order of their closest candidates
+        by_distance = np.argsort(candidate_distances[first], kind='stable')
+        rows, new_indices, new_distances = \
+            rows[by_distance], new_indices[by_distance], new_distances[by_distance]
+
+        # A stable merge keeps the old neighbors ahead of new ones at equal
+        # distances, like consecutive insert() calls
+        previous_indices = self._knn_indices[rows]
+        merged_distances = np.concatenate((self._knn_distances[rows], new_distances), axis=1)
+        merged_indices = np.concatenate((previous_indices, new_indices), axis=1)
+        merged = np.argsort(merged_distances, axis=1, kind='stable')[:, :self.k]
+        self._knn_distances[rows] = np.take_along_axis(merged_distances, merged, axis=1)
+        self._knn_indices[rows] = np.take_along_axis(merged_indices, merged, axis=1)
+        if self.windowed:
+            self._link_rows(rows, previous_indices)
+        return rows
+
+    def _reverse_neighbors(self, points):
+        """
+        Finds the indexed points that the (m, d) query points are closer to
+        than their current k-th neighbor, so that the query points enter
+        their kNN lists. Returns the positions of the query points, the found
+        points and the distances between them, by distance for each query point.
+        """
+        kth_distances = self._knn_distances[:, -1]
+        positions, rows, distances = [], [], []
+        for position, point in enumerate(points):
+            candidates = self.reach_index.query(point)
+            candidate_distances = np.linalg.norm(self.index.points[candidates] - point, axis=1)
+            closer = candidate_distances < kth_distances[candidates]
+            candidates, candidate_distances = candidates[closer], candidate_distances[closer]
+            order = np.lexsort((candidates, candidate_distances))
+            positions.append(np.full(len(order), position, dtype=np.intp))
+            rows.append(candidates[order])
+            distances.append(candidate_distances[order])
+        if not rows:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0)
+        return np.concatenate(positions), np.concatenate(rows), np.concatenate(distances)
+
+    def _update_reaches(self, rows):
+        """
+        Updates the balls of the given rows after their k-th distances changed
+        """
+        self.reach_index.update(rows, self.index.points[rows], self._knn_distances[rows, -1])
+
+    def _query_neighborhoods(self, rows):
+        """
+        Queries the kNN lists of indexed points. Each point comes first in its
+        own list, and lists are padded with the point itself at infinite
+        distance while the index holds too few points.
+        """
+        num_neighbors = self.k
+        distances, indices = self.index.query(self.index.points[rows], num_neighbors)
+        others = indices != rows[:, np.newaxis]
+        order = np.argsort(~others, axis=1, kind='stable')[:, :num_neighbors - 1]
+        found = np.take_along_axis(others, order, axis=1)
+
+        knn_distances = np.full((len(rows), num_neighbors), np.inf)
+        knn_indices = np.repeat(rows[:, np.newaxis], num_neighbors, axis=1)
+        knn_distances[:, 0] = 0
+        num_columns = order.shape[1]
+        knn_distances[:, 1:num_columns + 1] = np.where(
+            found, np.take_along_axis(distances, order, axis=1), np.inf)
+        knn_indices[:, 1:num_columns + 1] = np.where(
+            found, np.take_along_axis(indices, order, axis=1), rows[:, np.newaxis])
+        return knn_distances, knn_indices
+
+    def _link_rows(self, rows, previous_indices):
+        """
+        Updates the reverse neighbor sets after the kNN lists of the given
+        rows changed from previous_indices (None for new rows)
+        """
+        for position, row in enumerate(rows.tolist()):
+            current = set(self._knn_indices[row].tolist())
+            previous = set() if previous_indices is None \
+                else set(previous_indices[position].tolist())
+            for neighbor in previous - current:
+                self.reverse_neighbors[neighbor].discard(row)
+            for neighbor in current - previous:
+                self.reverse_neighbors[neighbor].add(row)
+
+    def _enter_neighborhoods(self, new_index, indices, distances):
+        """
+        Inserts the new point into the kNN lists of the neighbors it is closer
+        to than their current k-th neighbor. Returns those neighbors.
+        """
+        closer = distances < self._knn_distances[indices, -1]
+        rows = indices[closer]
+        new_distances = distances[closer][:, np.newaxis]
+        row_distances = self._knn_distances[rows]
+        row_indices = self._knn_indices[rows]
+
+        columns = np.arange(self.k)
+        position = np.sum(row_distances <= new_distances, axis=1)[:, np.newaxis]
+        shifted = np.maximum(columns - 1, 0)
+        self._knn_distances[rows] = np.where(
+            columns < position, row_distances,
+            np.where(columns == position, new_distances, row_distances[:, shifted]))
+        self._knn_indices[rows] = np.where(
+            columns < position, row_indices,
+            np.where(columns == position, new_index, row_indices[:, shifted]))
+        if self.windowed:
+            # Each list gained the new point and lost its last neighbor
+            dropped = row_indices[:, -1]
+            still_listed = np.any(self._knn_indices[rows] == dropped[:, np.newaxis], axis=1)
+            for row, neighbor, listed in zip(rows.tolist(), dropped.tolist(),
+                                             still_listed.tolist()):
+                self.reverse_neighbors[new_index].add(row)
+                if not listed:
+                    self.reverse_neighbors[neighbor].discard(row)
+        return rows
+
+    def _prune(self, rows):
+        """
+        Recomputes the pruned neighborhoods and densities of the given points
+        """
+        sorted_neighbors, sorted_distances, pruned_lengths = pruning_utils.prune_neighborhoods(
+            self._knn_indices[rows], self._knn_distances[rows], self._gamma[rows],
+            self.epsilon, self.sigma)
+        self._sorted_neighbors[rows] = sorted_neighbors
+        self._pruned_lengths[rows] = pruned_lengths
+        self._densities[rows] = clustering_utils.calculate_density_from_sorted_distances(
+            sorted_distances, pruned_lengths)
+
+    def _refresh_densities(self, rows, old_densities):
+        """
+        Moves the clustered points among rows whose density changed
+        so that their trees stay density ordered
+        """
+        for index, old_density in zip(rows, old_densities):
+            if self._labels[index] > 0 and self._densities[index] != old_density:
+                self._update_node_density(index)
+
+    def _place(self, node, start):
+        """
+        Attaches a detached node below the first node, walking up from start,
+        whose density is not lower than its own. If there is none, the node
+        becomes the root of its cluster and the previous root its child.
+        """
+        parent = start
+        while parent is not None and node.get_density() > parent.get_density():
+            parent = parent.get_parent()
+
+        if parent is None:
+            root = self.roots[node.cluster_id]
+            node.set_parent(None)
+            if root is not node:
+                root.set_parent(node)
+                node.add_child(root)
+            self.roots[node.cluster_id] = node
+        else:
+            node.set_parent(parent)
+            parent.add_child(node)
+
+    @staticmethod
+    def _detach(node):
+        """
+        Removes a node, together with its subtree, from its parent
+        """
+        parent = node.get_parent()
+        if parent is not None:
+            parent.get_children().remove(node)
+            node.set_parent(None)
+        return parent
+
+    def _update_node_density(self, index):
+        """
+        Updates the density of a clustered point and restores the density
+        ordering of its tree by moving the node or its children
+        """
+        density = self._densities[index]
+        node = self.all_node_maps[self._labels[index]][index]
+        node.density = density
+
+        parent = node.get_parent()
+        if parent is not None and density > parent.get_density():
+            self._detach(node)
+            self._place(node, parent)
+
+        lifted = sorted((child for child in node.get_children() if child.get_density() > density),
+                        key=lambda child: -child.get_density())
+        for child in lifted:
+            self._detach(child)
+            self._place(child, node.get_parent())
+
+    def _add_node(self, index, cluster_id, start, ewma_value):
+        """
+        Adds a point to an existing cluster tree
+        """
+        node = clustering_utils.TreeNode(index, self._densities[index], None, cluster_id)
+        self._place(node, start)
+        self.all_node_maps[cluster_id][index] = node
+        self._labels[index] = cluster_id
+        self._ewma_values[index] = ewma_value
+
+    def _assign(self, index, adopters):
+        """
+        Assigns a new point to a cluster with the EWMA/delta rule, starts a new
+        cluster with a neighboring anomaly, or labels it as an anomaly
+        """
+        density = self._densities[index]
+        pruned = [neighbor for neighbor in self.pruned_neighbors(index) if neighbor != index]
+
+        for neighbor in adopters + pruned:
+            cluster_id = self._labels[neighbor]
+            if cluster_id <= 0:
+                continue
+            ewma_value = clustering_utils.ewma(density, self._ewma_values[neighbor], self.beta)
+            if passes_density_change_threshold(ewma_value, density, self.delta):
+                self._add_node(index, cluster_id, self.all_node_maps[cluster_id][neighbor],
+                               ewma_value)
+                return int(cluster_id)
+
+        for neighbor in pruned:
+            if self._labels[neighbor] != -1:
+                continue
+            root_index, child_index = (neighbor, index) \
+                if self._densities[neighbor] >= density else (index, neighbor)
+            root_density = self._densities[root_index]
+            ewma_value = clustering_utils.ewma(self._densities[child_index], root_density,
+                                               self.beta)
+            if passes_density_change_threshold(ewma_value, self._densities[child_index],
+                                               self.delta):
+                cluster_id = self.next_cluster_id
+                self.next_cluster_id += 1
+                root_node = clustering_utils.TreeNode(root_index, root_density, None, cluster_id)
+                self.all_node_maps[cluster_id] = {root_index: root_node}
+                self.roots[cluster_id] = root_node
+                self._labels[root_index] = cluster_id
+                self._ewma_values[root_index] = root_density
+                self._add_node(child_index, cluster_id, root_node, ewma_value)
+                return cluster_id
+
+        self._labels[index] = -1
+        return -1
+
+    def _expire(self, timestamp, incoming=1):
+        """
+        Removes the oldest points until the window has room for
+        the incoming points and holds no point older than the window
+        """
+        while self.arrivals:
+            index, arrived = self.arrivals[0]
+            if self.window_size is not None:
+                if len(self.index) + incoming <= self.window_size:
+                    break
+            elif timestamp - arrived <= self.window_duration:
+                break
+            self.arrivals.popleft()
+            self._remove(index)
+
+    def _remove(self, index):
+        """
+        Removes an expired point from the forest, the index and the kNN
+        lists of the points that had it as a neighbor
+        """
+        if self._labels[index] > 0:
+            self._remove_node(index)
+        self.index.remove(index)
+        self.reach_index.remove([index])
+        self._alive[index] = False
+        self._labels[index] = 0
+        for neighbor in set(self._knn_indices[index].tolist()):
+            self.reverse_neighbors[neighbor].discard(index)
+        affected = np.array(sorted(self.reverse_neighbors[index] - {index}), dtype=np.intp)
+        self.reverse_neighbors[index] = set()
+        if len(affected) == 0:
+            return
+
+        previous_indices = self._knn_indices[affected]
+        old_densities = self._densities[affected]
+        self._knn_distances[affected], self._knn_indices[affected] = \
+            self._query_neighborhoods(affected)
+        self._link_rows(affected, previous_indices)
+        self._update_reaches(affected)
+        self._prune(affected)
+        self._refresh_densities(affected, old_densities)
+
+    def _remove_node(self, index):
+        """
+        Removes a point from its tree. If it was the root, its densest child
+        takes its place. Its other children are taken out of the cluster with
+        their subtrees, which are then attached again next to their nearest
+        neighbors in a tree.
+        """
+        cluster_id = int(self._labels[index])
+        node_map = self.all_node_maps[cluster_id]
+        node = node_map.pop(index)
+        self._labels[index] = 0
+        self._detach(node)
+        children = list(node.get_children())
+        node.get_children().clear()
+        for child in children:
+            child.set_parent(None)
+        if not node_map:
+            del self.all_node_maps[cluster_id]
+            del self.roots[cluster_id]
+            return
+
+        if self.roots[cluster_id] is node:
+            new_root = max(children, key=lambda child: child.get_density())
+            children.remove(new_root)
+            self.roots[cluster_id] = new_root
+        subtrees = [self._take_subtree(child) for child in children]
+        # Subtrees that only neighbor other detached subtrees wait for them
+        while subtrees:
+            pending = [subtree for subtree in subtrees if not self._reattach(*subtree)]
+            if len(pending) == len(subtrees):
+                break
+            subtrees = pending
+        for subtree in subtrees:
+            self._split(*subtree)
+        if len(node_map) == 1:
+            self._dissolve(cluster_id)
+
+    def _take_subtree(self, node):
+        """
+        Takes the detached subtree of a node out of its cluster. Its members
+        are labeled 0 until the subtree is attached again, so that they are
+        not mistaken for points of a tree. Returns the node and the members.
+        """
+        node_map = self.all_node_maps[node.cluster_id]
+        members = [node]
+        for member in members:
+            members.extend(member.get_children())
+        for member in members:
+            del node_map[member.index]
+            self._labels[member.index] = 0
+        return node, members
+
+    def _join(self, members, cluster_id):
+        """
+        Adds the members of a detached subtree to a cluster
+        """
+        node_map = self.all_node_maps[cluster_id]
+        for member in members:
+            member.cluster_id = cluster_id
+            self._labels[member.index] = cluster_id
+            node_map[member.index] = member
+
+    def _reattach(self, node, members):
+        """
+        Attaches a detached subtree near the nearest of its root's kNN
+        neighbors in the cluster the subtree comes from, else near the first
+        such neighbor of its other members, else near the nearest of its
+        root's neighbors in any cluster whose EWMA/delta rule accepts the
+        root, as when a new point is assigned. Returns False if there is none.
+        """
+        neighbors = [neighbor for neighbor in self._knn_indices[node.index].tolist()
+                     if self._labels[neighbor] > 0]
+        target = next((neighbor for neighbor in neighbors
+                       if self._labels[neighbor] == node.cluster_id), None)
+        if target is None:
+            member_neighbors = self._knn_indices[[member.index for member in members]].ravel()
+            member_neighbors = member_neighbors[self._labels[member_neighbors] == node.cluster_id]
+            target = int(member_neighbors[0]) if len(member_neighbors) else None
+        if target is None:
+            density = node.get_density()
+            target = next((neighbor for neighbor in neighbors if passes_density_change_threshold(
+                clustering_utils.ewma(density, self._ewma_values[neighbor], self.beta),
+                density, self.delta)), None)
+        if target is None:
+            return False
+        cluster_id = int(self._labels[target])
+        self._join(members, cluster_id)
+        self._place(node, self.all_node_maps[cluster_id][target])
+        return True
+
+    def _split(self, node, members):
+        """
+        Moves a detached subtree that lost its link to the trees into a new
+        cluster, or into the anomalies if it is a single point
+        """
+        if len(members) == 1:
+            node.cluster_id = -1
+            self._labels[node.index] = -1
+            return
+
+        cluster_id = self.next_cluster_id
+        self.next_cluster_id += 1
+        self.all_node_maps[cluster_id] = {}
+        self.roots[cluster_id] = node
+        self._join(members, cluster_id)
+
+    def _dissolve(self, cluster_id):
+        """
+        Turns the points of a cluster into anomalies
+        """
+        for index in self.all_node_maps.pop(cluster_id):
+            self._labels[index] = -1
+        del self.roots[cluster_id]
@@ -0,0 +1,106 @@
+"""
+Contains the sweep engine which clusters a dataset for a grid of parameters
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+import io
+import itertools
+import time
+import numpy as np
+from utils import constants, pruning_utils, clustering_utils, filtration_utils, \
+    merge_clusters, data_utils
+from utils.neighbor_graph import NeighborGraph
+
+SWEEP_COLUMNS = ('k', 'epsilon', 'delta', 'beta', 'clusters', 'anomalies',
+                 'pruning_time', 'clustering_time')
+
+
+# pylint: disable=R0913,R0914
+def run_sweep(data, k_values, delta_values, beta_values, epsilon_values,
+              sigma=None, delta_for_filtration=None, algorithm=None, seed=90,
+              max_workers=None):
+    """
+    Clusters the points for every combination of the given parameter values
+    and returns one result row (a dict keyed by SWEEP_COLUMNS) per combination.
+
+    The kNN search runs once at the largest k: the neighbors for a smaller k
+    are the first columns of that result (up to ties in distance). Pruning
+    and densities only depend on k and epsilon, so they are computed once
+    per (k, epsilon) and shared by all delta/beta values. The clustering,
+    filtration and merging runs are spread over a pool of max_workers
+    processes (all CPUs by default, in-process with max_workers=1).
+    Each (k, epsilon) draws the same random weights as main.py with that k,
+    so every row matches a separate run.
+    """
+    data = np.ascontiguousarray(data, dtype=float)
+    sigma = constants.SIGMA if sigma is None else sigma
+    delta_for_filtration = constants.DELTA_FOR_FILTRATION if delta_for_filtration is None \
+        else delta_for_filtration
+    distances, indices = pruning_utils.find_k_nearest_neighbors(data, max(k_values), seed=None,
+                                                                algorithm=algorithm)
+
+    rows = []
+    tasks = []
+    for k, epsilon in itertools.product(sorted(set(k_values)), epsilon_values):
+        start = time.perf_counter()
+        random_state = np.random.RandomState(seed)  # pylint: disable=E1101
+        with redirect_stdout(io.StringIO()):
+            pruned_neighbors, pruned_distances = pruning_utils.prune_all_neighborhoods(
+                indices[:, :k], distances[:, :k], epsilon, sigma, random_state)
+        densities = clustering_utils.calculate_density(data, pruned_neighbors, pruned_distances)
+        pruning_time = time.perf_counter() - start
+
+        for delta, beta in itertools.product(delta_values, beta_values):
+            rows.append({'k': k, 'epsilon': epsilon, 'delta': delta, 'beta': beta,
+                         'pruning_time': pruning_time})
+            # The CSR arrays are sent to the workers rather than the graph object
+            tasks.append((data, pruned_neighbors.indptr, pruned_neighbors.indices, densities,
+                          delta, beta, delta_for_filtration))
+
+    if max_workers == 1:
+        results = [run_configuration(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(run_configuration, *zip(*tasks)))
+    for row, result in zip(rows, results):
+        row.update(result)
+    return rows
+
+
+# pylint: disable=R0913
+def run_configuration(data, pruned_indptr, pruned_indices, densities, delta, beta,
+                      delta_for_filtration):
+    """
+    Runs clustering, filtration and merging for one configuration on
+    precomputed pruned neighborhoods and returns its counts and timing
+    """
+    start = time.perf_counter()
+    pruned_neighbors = NeighborGraph(pruned_indptr, pruned_indices)
+    dataset = data_utils.Dataset(data)
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        labels, all_node_maps = clustering_utils.grow_cluster_trees(pruned_neighbors, densities,
+                                                                    delta, beta)
+        filtered_labels = filtration_utils.filter_potential_anomalies(
+            labels, all_node_maps, densities, dataset=dataset,
+            delta_for_filtration=delta_for_filtration)
+        merged_labels, _ = merge_clusters.process_different_cluster_neighbors(
+            filtered_labels, pruned_neighbors, all_node_maps, densities,
+            dataset=dataset, beta=beta, delta=delta)
+    merged_labels = np.asarray(merged_labels)
+    return {'clusters': len(np.unique(merged_labels[merged_labels > 0])),
+            'anomalies': int(np.sum(merged_labels == -1)),
+            'clustering_time': time.perf_counter() - start}
+
+
+def format_sweep_table(rows):
+    """
+    Returns the sweep results as a text table, one line per configuration
+    """
+    lines = [f"{'k':>5} {'epsilon':>8} {'delta':>6} {'beta':>6} {'clusters':>9} "
+             f"{'anomalies':>10} {'pruning (s)':>12} {'clustering (s)':>15}"]
+    for row in rows:
+        lines.append(f"{row['k']:>5} {row['epsilon']:>8.3f} {row['delta']:>6.3f} "
+                     f"{row['beta']:>6.3f} {row['clusters']:>9} {row['anomalies']:>10} "
+                     f"{row['pruning_time']:>12.3f} {row['clustering_time']:>15.3f}")
+    return '\n'.join(lines)
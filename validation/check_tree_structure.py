@@ -2,31 +2,219 @@
 Validate tree structures by checking parent-child density relationships.
 """
 
-from tqdm import tqdm
-
-
-def check_tree_structure(all_node_maps):
-    """Test the validity of tree structures in all_node_maps."""
-
-    def is_valid_node(node):
-        """Check if a node has valid parent-child density relationships."""
-        if node_map[node.index].parent is not None and node_map[node.index].get_density() > \
-                node_map[node.index].get_parent().get_density():
-            print(f"{node.index} has higher density ({node_map[node.index].get_density()}) "
-                  f"than its parent "
-                  f"{node_map[node.index].get_parent_index()} "
-                  f"({node_map[node.index].get_parent().get_density()})")
-            return False
-        for child in node_map[node.index].get_children():
-            if node_map[node.index].get_density() < node_map[child.index].get_density():
-                print(f"{node.index} has lower density ({node_map[node.index].get_density()}) "
-                      f"than its child {node.index} ({node_map[child.index].get_density()})")
-                return False
-        return True
-
-    print("\nStarting tree structure validation...")
-    for _, node_map in tqdm(all_node_maps.items()):
-        for index, node in node_map.items():
-            assert is_valid_node(node), f"Node {index} does not " \
-                                        f"have a valid parent-child relationship."
-    print("Tree structure validation passed successfully.")
+import numpy as np
+from utils import constants, forest, instrumentation
+
+VALIDATION_LEVELS = ('full', 'sample', 'off')
+MAX_REPORTED_NODES = 10  # Offending nodes printed per kind of error
+
+
+def report(errors, kind, nodes, describe):
+    """Record the offending nodes of one kind of error, with a few examples."""
+    nodes = np.asarray(nodes)
+    if len(nodes):
+        for node in nodes[:MAX_REPORTED_NODES].tolist():
+            instrumentation.log(describe(node))
+        errors.append(f"{len(nodes)} nodes {kind}")
+
+
+def walk_to_roots(parent, nodes):
+    """Follow the parent links of the given nodes; return False if they loop."""
+    current = np.asarray(nodes)
+    for _ in range(len(parent) + 1):
+        current = parent[current]
+        current = current[current != forest.NO_NODE]
+        if len(current) == 0:
+            return True
+    return False
+
+
+# pylint: disable=R0914
+def find_forest_errors(array_forest, labels=None, nodes=None):
+    """
+    Check the tree nodes of an ArrayForest (or the given subset of them) with
+    array operations: density ordering along the parent links and the child
+    lists, acyclicity, parents in the same cluster, child lists that agree
+    with the parent links and agreement with the labels. Return the list of errors.
+    """
+    full = nodes is None
+    in_tree = array_forest.cluster_id != 0
+    if full:
+        nodes = np.flatnonzero(in_tree)
+    density, cluster_id, parent = array_forest.density, array_forest.cluster_id, \
+        array_forest.parent
+    errors = []
+
+    has_parent = nodes[parent[nodes] != forest.NO_NODE]
+    report(errors, "have a higher density than their parent",
+           has_parent[density[has_parent] > density[parent[has_parent]]],
+           lambda node: f"{node} has higher density ({density[node]}) than its parent "
+                        f"{parent[node]} ({density[parent[node]]})")
+    report(errors, "have a parent in another cluster or outside the trees",
+           has_parent[cluster_id[parent[has_parent]] != cluster_id[has_parent]],
+           lambda node: f"{node} is in cluster {cluster_id[node]}, its parent "
+                        f"{parent[node]} in cluster {cluster_id[parent[node]]}")
+    try:
+        # The child lists of the parents are walked too, to find the nodes missing from them
+        list_parents, list_children = array_forest.listed_children(
+            None if full else np.union1d(nodes, parent[has_parent]))
+    except ValueError as error:
+        list_parents = list_children = None
+        errors.append(str(error))
+    if list_parents is not None:
+        report(errors, "have a listed child with a higher density",
+               list_parents[density[list_children] > density[list_parents]],
+               lambda node: f"{node} has lower density ({density[node]}) "
+                            f"than one of its children")
+        linked = parent[list_children] == list_parents
+        report(errors, "list a child that has another parent", list_parents[~linked],
+               lambda node: f"{node} lists a child that has another parent")
+        listed = np.zeros(len(parent), dtype=bool)
+        listed[list_children[linked]] = True
+        report(errors, "are missing from the child list of their parent",
+               has_parent[~listed[has_parent]],
+               lambda node: f"{node} is not a listed child of its parent {parent[node]}")
+
+    if full:
+        try:
+            array_forest.tree_roots()
+        except ValueError as error:
+            errors.append(str(error))
+    elif not walk_to_roots(parent, nodes):
+        errors.append("The parent links of the forest contain a cycle")
+
+    if labels is not None:
+        labels = np.asarray(labels)
+        report(errors, "have a label other than their cluster",
+               nodes[labels[nodes] != cluster_id[nodes]],
+               lambda node: f"{node} is labeled {labels[node]} but is in cluster "
+                            f"{cluster_id[node]}")
+        if full:
+            report(errors, "are labeled with a cluster but are not in its tree",
+                   np.flatnonzero((labels > 0) & ~in_tree[:len(labels)]),
+                   lambda node: f"{node} is labeled {labels[node]} but is in no tree")
+    return errors
+
+
+def check_forest_structure(array_forest, labels=None, nodes=None):
+    """Test the validity of the tree structures of an ArrayForest."""
+    errors = find_forest_errors(array_forest, labels, nodes)
+    instrumentation.count('nodes_checked', int(np.sum(array_forest.cluster_id != 0))
+                          if nodes is None else len(nodes))
+    assert not errors, "Invalid tree structure: " + "; ".join(errors)
+
+
+def find_node_errors(node, node_map, cluster_id, labels, rooted=None):
+    """
+    Check one TreeNode of a cluster; return the list of errors. rooted is a
+    set of node indexes already known to reach a root, shared between calls.
+    """
+    errors = []
+    parent = node.get_parent()
+    if parent is not None and node.get_density() > parent.get_density():
+        errors.append(f"{node.index} has higher density than its parent {parent.index}")
+    if labels is not None and labels[node.index] != cluster_id:
+        errors.append(f"{node.index} is labeled {labels[node.index]} "
+                      f"but is in cluster {cluster_id}")
+    rooted = set() if rooted is None else rooted
+    ancestor, path = parent, []
+    while ancestor is not None and ancestor.index not in rooted and len(path) <= len(node_map):
+        path.append(ancestor.index)
+        ancestor = ancestor.get_parent()
+    if ancestor is None or ancestor.index in rooted:
+        rooted.update(path)
+    else:
+        errors.append(f"The parent links above {node.index} contain a cycle")
+    for child in node.get_children():
+        if child.get_density() > node.get_density():
+            errors.append(f"{node.index} has lower density than its child {child.index}")
+        if child.get_parent() is not node:
+            errors.append(f"{node.index} lists a child that has another parent")
+    if parent is not None and parent.index not in node_map:
+        errors.append(f"{node.index} has a parent outside cluster {cluster_id}")
+    if parent is not None and not any(child is node for child in parent.get_children()):
+        errors.append(f"{node.index} is not a listed child of its parent {parent.index}")
+    return errors
+
+
+def find_child_list_errors(all_node_maps):
+    """
+    Check that the child lists of TreeNode maps hold the same links as the
+    parent links, which are the only links read into an ArrayForest
+    """
+    listed = set()
+    linked = set()
+    for node_map in all_node_maps.values():
+        for node in node_map.values():
+            listed.update((id(node), id(child)) for child in node.get_children())
+            if node.get_parent() is not None:
+                linked.add((id(node.get_parent()), id(node)))
+    errors = []
+    if listed - linked:
+        errors.append(f"{len(listed - linked)} listed children have another parent")
+    if linked - listed:
+        errors.append(f"{len(linked - listed)} nodes are missing from the child list "
+                      f"of their parent")
+    return errors
+
+
+def check_node_sample(all_node_maps, labels, sample_size, random_state):
+    """Test the validity of a random sample of the nodes of TreeNode maps."""
+    node_maps = list(all_node_maps.items())
+    offsets = np.concatenate(([0], np.cumsum([len(node_map) for _, node_map in node_maps])))
+    picks = np.sort(random_state.choice(offsets[-1], min(sample_size, offsets[-1]),
+                                        replace=False))
+    clusters = np.searchsorted(offsets, picks, side='right') - 1
+    errors = []
+    rooted = set()
+    for cluster in np.unique(clusters).tolist():
+        cluster_id, node_map = node_maps[cluster]
+        nodes = list(node_map.values())
+        for pick in picks[clusters == cluster].tolist():
+            errors.extend(find_node_errors(nodes[pick - offsets[cluster]], node_map, cluster_id,
+                                           labels, rooted))
+    for error in errors[:MAX_REPORTED_NODES]:
+        instrumentation.log(error)
+    instrumentation.count('nodes_checked', len(picks))
+    assert not errors, f"Invalid tree structure: {len(errors)} errors in the sampled nodes"
+
+
+def check_tree_structure(all_node_maps, labels=None, level=None, sample_size=None, seed=90):
+    """
+    Test the validity of tree structures in all_node_maps (TreeNode maps or an
+    ArrayForest): no node is denser than its parent or its listed children,
+    the parent links reach a root within the cluster, the child lists agree
+    with the parent links and, when labels are given, every node is labeled
+    with its cluster id. level is 'full' (every node), 'sample' (sample_size
+    random nodes) or 'off'; both default to the values in constants.
+    """
+    level = constants.VALIDATION_LEVEL if level is None else level
+    if level not in VALIDATION_LEVELS:
+        raise ValueError(f"Unknown validation level {level!r}, expected one of "
+                         f"{VALIDATION_LEVELS}")
+    if level == 'off':
+        return
+    sample_size = constants.VALIDATION_SAMPLE_SIZE if sample_size is None else sample_size
+    random_state = np.random.RandomState(seed)  # pylint: disable=E1101
+
+    instrumentation.log("\nStarting tree structure validation...")
+    if isinstance(all_node_maps, forest.ArrayForest):
+        nodes = None
+        if level == 'sample':
+            in_tree = np.flatnonzero(all_node_maps.cluster_id != 0)
+            nodes = np.sort(random_state.choice(in_tree, min(sample_size, len(in_tree)),
+                                                replace=False))
+        check_forest_structure(all_node_maps, labels, nodes)
+    elif level == 'sample':
+        check_node_sample(all_node_maps, labels, sample_size, random_state)
+    else:
+        # The node attributes are read once into arrays, then checked together
+        num_points = max((max(node_map, default=-1) for node_map in all_node_maps.values()),
+                         default=-1) + 1
+        if labels is not None:
+            num_points = max(num_points, len(labels))
+        errors = find_child_list_errors(all_node_maps)
+        assert not errors, "Invalid tree structure: " + "; ".join(errors)
+        check_forest_structure(forest.ArrayForest.from_node_maps(all_node_maps, num_points),
+                               labels)
+    instrumentation.log("Tree structure validation passed successfully.")
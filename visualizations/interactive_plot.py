@@ -5,7 +5,7 @@ Contains the functions to plot the interactive density plot
 import matplotlib.pyplot as plt
 import numpy as np
 # pylint: disable=E0401
-from utils import data_utils, extract_data
+from utils import data_utils
 
 
 # pylint: disable=R0903
@@ -14,11 +14,11 @@ class InteractivePlot:
     Plots the interactive density plot
     """
 
-    def __init__(self, pruned_neighbors_list):
+    def __init__(self, pruned_neighbors_list, dataset=None):
         """
         Initializes with the required values
         """
-        self.data = data_utils.get_data(extract_data.get_raw_data_path())
+        self.data = data_utils.get_dataset_points(dataset)
         self.pruned_neighbors_list = pruned_neighbors_list
         self.selected_index = None
         self.fig, self.axes = plt.subplots()
@@ -47,7 +47,8 @@ class InteractivePlot:
             self.axes.scatter(self.data[:, 0], self.data[:, 1], s=10, c='black')
         else:
             self.selected_index = index
-            pruned_neighbors = [n for n in self.pruned_neighbors_list[index] if n != 0]
+            pruned_neighbors = self.pruned_neighbors_list[index]
+            pruned_neighbors = pruned_neighbors[pruned_neighbors != 0]
             self.axes.clear()
             self.axes.scatter(self.data[:, 0], self.data[:, 1], s=10, c='black', alpha=0.1)
             self.axes.scatter(self.data[pruned_neighbors][:, 0],
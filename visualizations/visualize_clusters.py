@@ -5,14 +5,14 @@ Contains helper functions to plot the clusters
 import matplotlib.pyplot as plt
 import numpy as np
 # pylint: disable=E0401
-from utils import data_utils, extract_data
+from utils import data_utils, forest
 
 
-def cluster_visualization(labels, all_node_maps):
+def cluster_visualization(labels, all_node_maps, dataset=None):
     """
     Plots the clusters
     """
-    data = data_utils.get_data(extract_data.get_raw_data_path())
+    data = data_utils.get_dataset_points(dataset)
     unique_labels = np.unique(labels)
 
     plt.figure(figsize=(12, 10))
@@ -38,9 +38,12 @@ def cluster_visualization(labels, all_node_maps):
                         color=colors[cluster_id],
                         label=f'Cluster {cluster_id}', s=10)
 
-            # pylint: disable=W0640
-            root_node = max(all_node_maps[cluster_id],
-                            key=lambda x: all_node_maps[cluster_id][x].get_density())
+            if isinstance(all_node_maps, forest.ArrayForest):
+                root_node = all_node_maps.roots[cluster_id]
+            else:
+                # pylint: disable=W0640
+                root_node = max(all_node_maps[cluster_id],
+                                key=lambda x: all_node_maps[cluster_id][x].get_density())
             root_coords = data[root_node]
             plt.scatter(root_coords[0], root_coords[1], color='red', edgecolor='black',
                         s=100, marker='o',